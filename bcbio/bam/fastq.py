@@ -0,0 +1,119 @@
+"""Utilities for working with fastq input files.
+"""
+from __future__ import print_function
+import os
+import collections
+
+def rstrip_extra(fname):
+    """Strip extraneous, non-discriminative filename info from the end of a file.
+    """
+    to_strip = ("_R", ".R", "-R", "_", "fastq", ".", "-")
+    while fname.endswith(to_strip):
+        for x in to_strip:
+            if fname.endswith(x):
+                fname = fname[:len(fname) - len(x)]
+                break
+    return fname
+
+PAIR_FILE_IDENTIFIERS = set(["1", "2", "3", "4"])
+
+PairMatches = collections.namedtuple("PairMatches", ["groups", "orphans", "ambiguous"])
+
+def combine_pairs(input_files, force_single=False, full_name=False, separators=None):
+    """Group fastq files into pairs, or read sets, matched by read number in the name.
+
+    Files are paired when their names are identical except for a read
+    identifier (1-4) following one of the `separators`, for instance
+    `sample_R1_001.fq.gz` and `sample_R2_001.fq.gz`. Returns a list of file
+    lists, one per sample: paired files in read order, or a single file.
+    """
+    matches = match_pairs(input_files, force_single, full_name, separators)
+    if matches.ambiguous:
+        print("WARNING: %s files could be paired in more than one way, for instance %s matches %s."
+              % (len(matches.ambiguous), matches.ambiguous[0]["file"],
+                 " or ".join(",".join(g) for g in matches.ambiguous[0]["groups"])))
+        print("Use --separators to specify only the separator before read numbers, for instance R.")
+    return matches.groups
+
+def match_pairs(input_files, force_single=False, full_name=False, separators=None):
+    """Match paired fastq files in linear time using a hash index of names.
+
+    Each name is normalized once into keys that mask a candidate read
+    identifier, and files sharing a key with different identifiers form a
+    group. When a file could pair in several ways, earlier separators in
+    `separators` win, then identifiers closer to the end of the name. Files
+    with the same name in different directories are grouped by directory.
+
+    Returns `PairMatches` with:
+    - `groups`: file lists, paired or single, sorted by first file.
+    - `orphans`: files with a read identifier but no mate, also returned as singles.
+    - `ambiguous`: dictionaries of `file` and the `groups` it could join,
+      for files matching more than one way, reported for checking.
+    """
+    separators = list(separators) if separators else ["R", "_", "-", "."]
+    input_files = sorted(set(input_files))
+    if force_single:
+        return PairMatches([[f] for f in input_files], [], [])
+    sep_rank = dict((s, i) for i, s in reversed(list(enumerate(separators))))
+    buckets = collections.defaultdict(list)
+    levels = collections.defaultdict(set)
+    for f in input_files:
+        name = f if full_name else os.path.basename(f)
+        for key, read in _pair_keys(name, sep_rank):
+            buckets[key].append((read, f))
+            levels[key[:2]].add(key)
+    used = {}
+    groups = []
+    possible = collections.defaultdict(list)
+    for level in sorted(levels.keys()):
+        for key in sorted(levels[level]):
+            for group in _bucket_groups(buckets[key]):
+                for f in group:
+                    possible[f].append(group)
+                if not any(f in used for f in group):
+                    for f in group:
+                        used[f] = group
+                    groups.append(group)
+    ambiguous = [{"file": f, "groups": gs} for f, gs in sorted(possible.items()) if len(gs) > 1]
+    has_id = set(f for bucket in buckets.values() for _, f in bucket)
+    singles = [f for f in input_files if f not in used]
+    groups.extend([f] for f in singles)
+    orphans = [f for f in singles if f in has_id]
+    groups.sort(key=lambda x: x[0])
+    return PairMatches(groups, orphans, ambiguous)
+
+def _pair_keys(name, sep_rank):
+    """Candidate (key, read identifier) pairs for a file name.
+
+    Read identifiers are digits 1-4 preceded by a separator and not followed
+    by another digit. Keys hold the separator rank, the distance of the
+    identifier from the end of the name and the name with it masked.
+    """
+    out = []
+    for i in range(1, len(name)):
+        c = name[i]
+        if c in PAIR_FILE_IDENTIFIERS and name[i - 1] in sep_rank and \
+                (i + 1 == len(name) or not name[i + 1].isdigit()):
+            masked = name[:i] + "\0" + name[i + 1:]
+            out.append(((sep_rank[name[i - 1]], len(name) - i, masked), c))
+    return out
+
+def _bucket_groups(bucket):
+    """Split files sharing a masked name into groups with one file per read identifier.
+
+    Same named files in different directories are split by directory.
+    """
+    reads = [r for r, _ in bucket]
+    if len(set(reads)) < 2:
+        return []
+    if len(set(reads)) == len(reads):
+        return [[f for _, f in sorted(bucket)]]
+    by_dir = collections.defaultdict(list)
+    for r, f in bucket:
+        by_dir[os.path.dirname(f)].append((r, f))
+    out = []
+    for _, cur in sorted(by_dir.items()):
+        cur_reads = [r for r, _ in cur]
+        if len(set(cur_reads)) > 1 and len(set(cur_reads)) == len(cur_reads):
+            out.append([f for _, f in sorted(cur)])
+    return out
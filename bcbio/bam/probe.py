@@ -0,0 +1,168 @@
+"""Probe BAM headers and fastq reads for sample information, in parallel with caching.
+
+BAM files report the read groups from their header, and fastq files the
+quality encoding and read length from their first records. Probing runs on
+a bounded thread pool, since on network filesystems opening each file costs
+far more than reading it. Results are cached on disk keyed by path, size
+and modification time, so repeat runs over the same inputs only probe new
+or changed files.
+
+The cache lives in `$BCBIO_PROBE_CACHE`, defaulting to
+`~/.cache/bcbio/probe.json`.
+"""
+from __future__ import print_function
+import os
+import bz2
+import gzip
+import json
+import struct
+import tempfile
+from concurrent import futures
+
+from bcbio import utils
+
+FASTQ_RECORDS = 100
+
+def default_cache_file():
+    return os.environ.get("BCBIO_PROBE_CACHE",
+                          os.path.join(os.path.expanduser("~"), ".cache", "bcbio", "probe.json"))
+
+def _open(fname):
+    if fname.endswith(".gz") or fname.endswith(".bam"):
+        return gzip.open(fname, "rb")
+    elif fname.endswith(".bz2"):
+        return bz2.BZ2File(fname, "rb")
+    else:
+        return open(fname, "rb")
+
+def bam_read_groups(bam_file):
+    """Retrieve @RG header lines from a BAM file as a list of tag dictionaries.
+
+    Reads only the start of the BGZF compressed header, without pysam.
+    """
+    with _open(bam_file) as in_handle:
+        magic = in_handle.read(4)
+        if magic != b"BAM\x01":
+            raise ValueError("Not a BAM file: %s" % bam_file)
+        l_text = struct.unpack("<i", in_handle.read(4))[0]
+        text = in_handle.read(l_text).decode("utf-8", "replace")
+    rgs = []
+    for line in text.split("\n"):
+        if line.startswith("@RG"):
+            rgs.append(dict(x.split(":", 1) for x in line.rstrip("\x00").split("\t")[1:] if ":" in x))
+    return rgs
+
+def fastq_info(fastq_file, num_records=FASTQ_RECORDS):
+    """Quality encoding and read length from the first records of a fastq file.
+
+    Quality scores below `;` (ASCII 59) only occur with Sanger/Illumina 1.8+
+    offsets (`standard`); files with all scores at `@` or above use the
+    older Illumina offset (`illumina`).
+    """
+    min_qual = None
+    read_length = 0
+    count = 0
+    with _open(fastq_file) as in_handle:
+        while count < num_records:
+            header = in_handle.readline()
+            if not header:
+                break
+            seq = in_handle.readline().rstrip()
+            in_handle.readline()
+            qual = in_handle.readline().rstrip()
+            if not header.startswith(b"@") or len(seq) != len(qual):
+                raise ValueError("Unexpected fastq record in %s: %s" % (fastq_file, header.strip()))
+            if qual:
+                cur_min = min(bytearray(qual))
+                min_qual = cur_min if min_qual is None else min(min_qual, cur_min)
+            read_length = max(read_length, len(seq))
+            count += 1
+    if min_qual is None:
+        quality_format = None
+    elif min_qual < 59:
+        quality_format = "standard"
+    elif min_qual >= 64:
+        quality_format = "illumina"
+    else:
+        quality_format = None
+    return {"quality_format": quality_format, "read_length": read_length, "records": count}
+
+PROBES = {"bam": lambda f: {"read_groups": bam_read_groups(f)},
+          "fastq": fastq_info}
+
+class ProbeCache(object):
+    """On-disk cache of probe results keyed by path, size and modification time.
+    """
+    def __init__(self, cache_file=None):
+        self.cache_file = os.path.abspath(cache_file or default_cache_file())
+        self._data = {}
+        self._changed = False
+        try:
+            with open(self.cache_file) as in_handle:
+                self._data = json.load(in_handle)
+        except (IOError, OSError, ValueError):
+            pass
+
+    @staticmethod
+    def _stat(fname):
+        st = os.stat(fname)
+        return [st.st_size, st.st_mtime]
+
+    def get(self, fname, kind):
+        cur = self._data.get(os.path.abspath(fname))
+        if cur and cur["kind"] == kind:
+            try:
+                if cur["stat"] == self._stat(fname):
+                    return cur["info"]
+            except OSError:
+                pass
+
+    def set(self, fname, kind, info):
+        self._data[os.path.abspath(fname)] = {"kind": kind, "stat": self._stat(fname), "info": info}
+        self._changed = True
+
+    def save(self):
+        """Write the cache if updated, merging with entries added by other runs.
+        """
+        if not self._changed:
+            return
+        try:
+            with open(self.cache_file) as in_handle:
+                data = json.load(in_handle)
+        except (IOError, OSError, ValueError):
+            data = {}
+        data.update(self._data)
+        cache_dir = utils.safe_makedir(os.path.dirname(self.cache_file))
+        fd, tx_file = tempfile.mkstemp(dir=cache_dir)
+        with os.fdopen(fd, "w") as out_handle:
+            json.dump(data, out_handle)
+        os.rename(tx_file, self.cache_file)
+        self._changed = False
+
+def probe_files(files, kind, num_threads=8, cache_file=None):
+    """Probe files of a `kind` (bam or fastq) on a thread pool, returning a dictionary by file.
+
+    Unreadable files are reported and left out of the results.
+    """
+    cache = ProbeCache(cache_file)
+    out = {}
+    to_probe = []
+    for f in files:
+        info = cache.get(f, kind)
+        if info is None:
+            to_probe.append(f)
+        else:
+            out[f] = info
+    if to_probe:
+        with futures.ThreadPoolExecutor(max_workers=max(1, min(num_threads, len(to_probe)))) as executor:
+            running = dict((executor.submit(PROBES[kind], f), f) for f in to_probe)
+            for future in futures.as_completed(running):
+                f = running[future]
+                try:
+                    out[f] = future.result()
+                except (IOError, OSError, EOFError, ValueError, struct.error) as e:
+                    print("WARNING: could not read %s header from %s: %s" % (kind, f, e))
+                    continue
+                cache.set(f, kind, out[f])
+        cache.save()
+    return out
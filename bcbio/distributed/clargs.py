@@ -11,7 +11,10 @@ def to_parallel(args, module="bcbio.distributed"):
                 "resources": args.resources, "timeout": args.timeout,
                 "retries": args.retries,
                 "run_local": args.queue == "localrun",
-                "local_controller": local_controller}
+                "local_controller": local_controller,
+                "worker": getattr(args, "worker_socket", None),
+                "task_cache": getattr(args, "task_cache", None),
+                "trace": getattr(args, "trace", None)}
     return parallel
 
 def _get_cores_and_type(numcores, paralleltype, scheduler):
@@ -21,6 +24,9 @@ def _get_cores_and_type(numcores, paralleltype, scheduler):
         paralleltype = "ipython"
     if paralleltype is None:
         paralleltype = "local"
+    if numcores is None:
+        from bcbio import hostprofile
+        numcores = hostprofile.default_cores()
     if not numcores or int(numcores) < 1:
         numcores = 1
     return paralleltype, int(numcores)
@@ -0,0 +1,654 @@
+"""Run distributed functions as job arrays on a cluster scheduler.
+
+Tasks are collected and submitted as one job array per resource class
+(cores and memory) instead of one job per task. Each array element runs
+`bcbio_nextgen.py runfn` on its own argument file and leaves marker files
+next to it when it starts and finishes, so status checks are one directory
+listing per array plus one scheduler query for all arrays.
+
+The `local` scheduler runs array elements as subprocesses on the current
+machine, exercising the same scripts and files without a cluster.
+"""
+from __future__ import print_function
+import os
+import re
+import sys
+import time
+import shlex
+import threading
+import subprocess
+import collections
+from concurrent import futures
+
+from bcbio import utils
+from bcbio.distributed import multitasks, runfn, taskcache, trace
+from bcbio.distributed import resources as dresources
+
+
+class ClusterTimeout(Exception):
+    """No job in an array started within the startup timeout.
+    """
+    pass
+
+
+class ClusterTaskError(Exception):
+    """A task failed on the cluster after all retries.
+    """
+    pass
+
+
+class _Scheduler(object):
+    """Base for scheduler backends: job script directives, submission and status.
+    """
+    name = None
+    index_var = None
+    prefix = None
+    # Column of the job state in status output, after the job id in the first
+    state_column = 4
+
+    def __init__(self, resources=None):
+        self.resources = _parse_resources(resources or [])
+
+    def directives(self, name, size, throttle, cores, memory, queue, log_dir):
+        raise NotImplementedError
+
+    def submit(self, script):
+        out = subprocess.check_output(self.submit_cmd(script)).decode()
+        return self.parse_jobid(out)
+
+    def submit_cmd(self, script):
+        return ["qsub", script]
+
+    def parse_jobid(self, out):
+        return out.strip().split()[-1].split(".")[0].split("[")[0]
+
+    def active(self, job_ids):
+        """Return the subset of job ids with array elements queued or running, with one query.
+
+        Only the status table is read. Messages about finished jobs, like
+        `Unknown Job Id` or `Job <id> is not found`, go to stderr and are
+        ignored, as are jobs the scheduler still lists in a finished state.
+        """
+        try:
+            out = subprocess.check_output(self.status_cmd(job_ids), stderr=subprocess.DEVNULL).decode()
+        except subprocess.CalledProcessError as e:
+            # Status commands exit with an error when any of the queried jobs has finished
+            out = e.output.decode() if e.output else ""
+        found = set(job_id for job_id, state in self.parse_status(out) if self.is_active(state))
+        return set(j for j in job_ids if j in found)
+
+    def status_cmd(self, job_ids):
+        return ["qstat"]
+
+    def parse_status(self, out):
+        """(job id, state) for each job or array element row of the status output.
+
+        Header and separator lines are skipped, and ids like `123[4].server`
+        are reduced to the array job id.
+        """
+        for line in out.splitlines():
+            parts = line.split()
+            if len(parts) > self.state_column and parts[0][:1].isdigit():
+                yield parts[0].split(".")[0].split("[")[0], parts[self.state_column]
+
+    def is_active(self, state):
+        return True
+
+    def cancel(self, job_ids):
+        if job_ids:
+            subprocess.call(self.cancel_cmd(job_ids))
+
+    def cancel_cmd(self, job_ids):
+        return ["qdel"] + list(job_ids)
+
+    def extra_directives(self):
+        return ["%s %s" % (self.prefix, v if k is None else "--%s=%s" % (k, v))
+                for k, v in self.resources]
+
+
+class Slurm(_Scheduler):
+    name = "slurm"
+    index_var = "SLURM_ARRAY_TASK_ID"
+    prefix = "#SBATCH"
+
+    def directives(self, name, size, throttle, cores, memory, queue, log_dir):
+        out = ["-J %s" % name,
+               "--array=1-%s%s" % (size, "%%%s" % throttle if throttle else ""),
+               "-c %s" % cores, "-o %s" % os.path.join(log_dir, "%A_%a.out")]
+        if memory:
+            out.append("--mem=%sM" % _to_mb(memory))
+        if queue:
+            out.append("-p %s" % queue)
+        return ["%s %s" % (self.prefix, x) for x in out] + self.extra_directives()
+
+    def submit_cmd(self, script):
+        return ["sbatch", "--parsable", script]
+
+    def parse_jobid(self, out):
+        return out.strip().split(";")[0]
+
+    state_column = 1
+    finished_states = set(["BOOT_FAIL", "CANCELLED", "COMPLETED", "DEADLINE", "FAILED", "NODE_FAIL",
+                           "OUT_OF_MEMORY", "PREEMPTED", "TIMEOUT"])
+
+    def status_cmd(self, job_ids):
+        return ["squeue", "-h", "-o", "%F %T", "-j", ",".join(job_ids)]
+
+    def is_active(self, state):
+        return state not in self.finished_states
+
+    def cancel_cmd(self, job_ids):
+        return ["scancel"] + list(job_ids)
+
+
+class SGE(_Scheduler):
+    name = "sge"
+    index_var = "SGE_TASK_ID"
+    prefix = "#$"
+
+    def directives(self, name, size, throttle, cores, memory, queue, log_dir):
+        resources = dict(self.resources)
+        out = ["-N %s" % name, "-t 1-%s" % size, "-cwd", "-j y", "-o %s" % log_dir, "-V"]
+        if throttle:
+            out.append("-tc %s" % throttle)
+        if cores > 1:
+            out.append("-pe %s %s" % (resources.get("pename", "smp"), cores))
+        if memory:
+            # SGE memory requests are per slot
+            out.append("-l %s=%sM" % (resources.get("memtype", "mem_free"), _to_mb(float(memory) / cores)))
+        if queue:
+            out.append("-q %s" % queue)
+        out += ["-l %s" % (v if k is None else "%s=%s" % (k, v)) for k, v in self.resources
+                if k not in ["pename", "memtype"]]
+        return ["%s %s" % (self.prefix, x) for x in out]
+
+    def submit_cmd(self, script):
+        return ["qsub", "-terse", script]
+
+    def is_active(self, state):
+        # Jobs in error (Eqw) never run and deleted ones (dr) are going away
+        return "E" not in state and "d" not in state
+
+
+class LSF(_Scheduler):
+    name = "lsf"
+    index_var = "LSB_JOBINDEX"
+    prefix = "#BSUB"
+
+    def directives(self, name, size, throttle, cores, memory, queue, log_dir):
+        out = ['-J "%s[1-%s]%s"' % (name, size, "%%%s" % throttle if throttle else ""),
+               "-n %s" % cores, "-o %s" % os.path.join(log_dir, "%J_%I.out")]
+        if memory:
+            out.append('-R "span[hosts=1] rusage[mem=%s]"' % _to_mb(memory))
+        else:
+            out.append('-R "span[hosts=1]"')
+        if queue:
+            out.append("-q %s" % queue)
+        return ["%s %s" % (self.prefix, x) for x in out] + \
+            ["%s %s" % (self.prefix, v if k is None else "-%s %s" % (k, v)) for k, v in self.resources]
+
+    def submit(self, script):
+        with open(script) as in_handle:
+            out = subprocess.check_output(["bsub"], stdin=in_handle).decode()
+        return re.search(r"<(\d+)>", out).group(1)
+
+    state_column = 1
+
+    def status_cmd(self, job_ids):
+        return ["bjobs", "-noheader", "-o", "jobid stat"] + list(job_ids)
+
+    def is_active(self, state):
+        # Finished jobs stay listed for a while as DONE or EXIT
+        return state not in ["DONE", "EXIT"]
+
+    def cancel_cmd(self, job_ids):
+        return ["bkill"] + list(job_ids)
+
+
+class Torque(_Scheduler):
+    name = "torque"
+    index_var = "PBS_ARRAYID"
+    prefix = "#PBS"
+
+    def directives(self, name, size, throttle, cores, memory, queue, log_dir):
+        out = ["-N %s" % name, "-t 1-%s%s" % (size, "%%%s" % throttle if throttle else ""),
+               "-l nodes=1:ppn=%s" % cores, "-j oe", "-o %s" % log_dir, "-V"]
+        if memory:
+            out.append("-l mem=%smb" % _to_mb(memory))
+        if queue:
+            out.append("-q %s" % queue)
+        return ["%s %s" % (self.prefix, x) for x in out] + \
+            ["%s -l %s" % (self.prefix, v if k is None else "%s=%s" % (k, v)) for k, v in self.resources]
+
+    def status_cmd(self, job_ids):
+        return ["qstat", "-t"] + ["%s[]" % j for j in job_ids]
+
+    def is_active(self, state):
+        # Completed jobs are kept for keep_completed seconds
+        return state != "C"
+
+
+class PBSPro(_Scheduler):
+    name = "pbspro"
+    index_var = "PBS_ARRAY_INDEX"
+    prefix = "#PBS"
+
+    def directives(self, name, size, throttle, cores, memory, queue, log_dir):
+        select = "select=1:ncpus=%s" % cores
+        if memory:
+            select += ":mem=%smb" % _to_mb(memory)
+        out = ["-N %s" % name, "-l %s" % select, "-j oe", "-o %s" % log_dir, "-V"]
+        # PBSPro arrays need at least two elements, single jobs default to index 1
+        if size > 1:
+            out.append("-J 1-%s" % size)
+        if queue:
+            out.append("-q %s" % queue)
+        return ["%s %s" % (self.prefix, x) for x in out] + \
+            ["%s -l %s" % (self.prefix, v if k is None else "%s=%s" % (k, v)) for k, v in self.resources]
+
+    def status_cmd(self, job_ids):
+        return ["qstat", "-t"] + ["%s[]" % j for j in job_ids]
+
+    def is_active(self, state):
+        # Finished elements show as X, and finished jobs as F with history enabled
+        return state not in ["F", "X"]
+
+
+class Local(_Scheduler):
+    """Stand in scheduler running array elements as local subprocesses.
+
+    Runs at most `max_cores` cores worth of elements at once and supports
+    the same scripts, marker files and status checks as a real scheduler.
+    """
+    name = "local"
+    index_var = "BCBIO_ARRAY_INDEX"
+    prefix = "#"
+
+    def __init__(self, resources=None, max_cores=1):
+        super(Local, self).__init__(resources)
+        self.max_cores = max(int(max_cores), 1)
+        self._jobs = {}
+        self._procs = collections.defaultdict(set)
+        self._cancelled = set()
+        self._lock = threading.Lock()
+        self._count = 0
+
+    def directives(self, name, size, throttle, cores, memory, queue, log_dir):
+        return ["# %s size=%s cores=%s memory=%s" % (name, size, cores, memory)]
+
+    def submit(self, script):
+        with self._lock:
+            self._count += 1
+            job_id = str(self._count)
+        size, cores = _read_local_header(script)
+        thread = threading.Thread(target=self._run_array, args=(job_id, script, size, cores))
+        thread.daemon = True
+        self._jobs[job_id] = thread
+        thread.start()
+        return job_id
+
+    def _run_array(self, job_id, script, size, cores):
+        workers = max(self.max_cores // cores, 1)
+        log_dir = os.path.join(os.path.dirname(script), "log")
+
+        def run_element(i):
+            env = dict(os.environ)
+            env[self.index_var] = str(i)
+            with open(os.path.join(log_dir, "%s.out" % i), "w") as out_handle:
+                with self._lock:
+                    if job_id in self._cancelled:
+                        return
+                    proc = subprocess.Popen(["bash", script], env=env, stdout=out_handle,
+                                            stderr=subprocess.STDOUT)
+                    self._procs[job_id].add(proc)
+                proc.wait()
+                with self._lock:
+                    self._procs[job_id].discard(proc)
+        with futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            list(executor.map(run_element, range(1, size + 1)))
+
+    def active(self, job_ids):
+        return set(j for j in job_ids if j in self._jobs and self._jobs[j].is_alive())
+
+    def cancel(self, job_ids):
+        """Stop running elements of the arrays and skip those not yet started.
+        """
+        with self._lock:
+            for job_id in job_ids:
+                self._cancelled.add(job_id)
+                for proc in self._procs.pop(job_id, set()):
+                    proc.terminate()
+
+
+SCHEDULERS = dict((x.name, x) for x in [Slurm, SGE, LSF, Torque, PBSPro, Local])
+
+
+def get_scheduler(parallel):
+    """Retrieve the scheduler backend for a parallel dictionary.
+
+    `-q localrun` selects the local stand in for any scheduler.
+    """
+    name = "local" if parallel.get("run_local") else parallel.get("scheduler")
+    if name not in SCHEDULERS:
+        raise ValueError("Unsupported scheduler %s, choose from: %s" % (name, ", ".join(sorted(SCHEDULERS))))
+    if name == "local":
+        return Local(parallel.get("resources"), max_cores=parallel.get("cores") or 1)
+    return SCHEDULERS[name](parallel.get("resources"))
+
+
+def _parse_resources(resources):
+    """Split `-r` resource specifications into (key, value), or (None, raw) for flags.
+    """
+    out = []
+    for r in resources:
+        for x in r.split(";"):
+            x = x.strip()
+            if x:
+                if "=" in x:
+                    k, v = x.split("=", 1)
+                    out.append((k.strip(), v.strip()))
+                else:
+                    out.append((None, x))
+    return out
+
+
+def _to_mb(memory):
+    return int(float(memory) * 1024)
+
+
+def _read_local_header(script):
+    with open(script) as in_handle:
+        for line in in_handle:
+            if line.startswith("# ") and "size=" in line:
+                parts = dict(x.split("=") for x in line.split() if "=" in x)
+                return int(parts["size"]), int(parts["cores"])
+    raise ValueError("Did not find array information in %s" % script)
+
+
+def _bcbio_cmd():
+    """Command line to run bcbio_nextgen.py with the current python.
+    """
+    for base_dir in [os.path.dirname(os.path.realpath(sys.executable)),
+                     os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))]:
+        script = os.path.join(base_dir, "bcbio_nextgen.py")
+        if os.path.exists(script):
+            return [sys.executable, script]
+    raise ValueError("Could not find bcbio_nextgen.py to run distributed tasks")
+
+
+_JOB_TEMPLATE = """#!/bin/bash
+{directives}
+IDX=${{{index_var}:-1}}
+cd {array_dir}
+touch started-$IDX
+{cmd} runfn {fn_name} task-$IDX{ext} -o task-$IDX-out{ext}{worker}{trace}
+echo $? > exit-$IDX.tx && mv exit-$IDX.tx exit-$IDX
+"""
+
+
+class _Task(object):
+    def __init__(self, fn_name, args, cores, memory):
+        self.fn_name = fn_name
+        self.args = args
+        self.cores = cores
+        self.memory = memory
+        self.attempts = 0
+        self.future = futures.Future()
+        self.key = None
+        self.submitted = time.time()
+
+
+class _Array(object):
+    def __init__(self, job_id, array_dir, tasks):
+        self.job_id = job_id
+        self.array_dir = array_dir
+        self.tasks = tasks
+        self.submitted = time.time()
+        self.started = False
+        self.missing_polls = 0
+
+
+class ClusterScheduler(object):
+    """Schedule named functions as cluster job arrays.
+
+    Provides the same `submit` and `map` interface as `multi.LocalScheduler`,
+    for functions registered in `multitasks` or importable from a module.
+    Tasks reach array elements as `module:function` import paths.
+    Submissions are batched and flushed every `poll_interval` seconds as one
+    array per resource class.
+    """
+    def __init__(self, parallel, work_dir=None, poll_interval=None, config=None):
+        self.parallel = parallel
+        self.config = config
+        self.scheduler = get_scheduler(parallel)
+        self.work_dir = utils.safe_makedir(os.path.abspath(
+            work_dir or os.path.join(os.getcwd(), "log", "cluster")))
+        self.tag = parallel.get("tag") or "bcbio"
+        self.retries = max(int(parallel.get("retries") or 0), 0)
+        self.timeout = float(parallel.get("timeout") or 15) * 60.0
+        self.cores = max(int(parallel.get("cores") or 1), 1)
+        self.poll_interval = poll_interval or (0.2 if self.scheduler.name == "local" else 10.0)
+        self.ext = ".pkl"
+        self.cache = taskcache.from_parallel(parallel)
+        self.trace = trace.from_parallel(parallel)
+        self._pending = []
+        self._arrays = []
+        self._narrays = 0
+        self._lock = threading.RLock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.shutdown(cancel=exc_type is not None)
+
+    def submit(self, fn_name, args, cores=1, memory=None):
+        # Array elements run in fresh processes without this process's registrations
+        fn_name = multitasks.import_path(fn_name)
+        task = _Task(fn_name, list(args), max(int(cores or 1), 1), dresources.parse_memory(memory, 0.0))
+        task.future.set_running_or_notify_cancel()
+        if self.cache is not None:
+            task.key = self.cache.key(fn_name, task.args)
+            found, result = self.cache.get(task.key)
+            if found:
+                task.future.set_result(result)
+                return task.future
+        with self._lock:
+            self._pending.append(task)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run)
+                self._thread.daemon = True
+                self._thread.start()
+        return task.future
+
+    def map(self, fn_name, items, resources=None):
+        items = list(items)
+        if resources is None and self.parallel.get("progs"):
+            items, resources = dresources.allocate(self.parallel, items, self.config)
+        if isinstance(resources, dict) or resources is None:
+            resources = [resources or {}] * len(items)
+        fs = [self.submit(fn_name, args, r.get("cores", 1), r.get("memory"))
+              for args, r in zip(items, resources)]
+        try:
+            return [f.result() for f in fs]
+        except BaseException:
+            self.cancel()
+            raise
+
+    def cancel(self):
+        with self._lock:
+            pending, self._pending = self._pending, []
+            arrays, self._arrays = self._arrays, []
+        for task in pending:
+            _fail(task, futures.CancelledError())
+        self.scheduler.cancel([a.job_id for a in arrays])
+        for a in arrays:
+            for task in a.tasks:
+                _fail(task, futures.CancelledError())
+
+    def shutdown(self, cancel=False):
+        if cancel:
+            self.cancel()
+        while True:
+            with self._lock:
+                thread = self._thread
+                if thread is None or (not self._pending and not self._arrays):
+                    break
+            time.sleep(self.poll_interval)
+        if thread is not None:
+            self._stop.set()
+            thread.join()
+        if self.cache is not None:
+            self.cache.close()
+            self.cache = None
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                self._flush()
+                self._poll()
+            except Exception as e:
+                print("Cluster scheduling failed: %s" % e)
+                self._abort(e)
+                return
+            self._stop.wait(self.poll_interval)
+
+    def _abort(self, exc):
+        """Fail all queued and running tasks with `exc`, cancelling submitted arrays.
+
+        The next submission starts a new dispatch thread.
+        """
+        with self._lock:
+            pending, self._pending = self._pending, []
+            arrays, self._arrays = self._arrays, []
+            self._thread = None
+        try:
+            self.scheduler.cancel([a.job_id for a in arrays])
+        finally:
+            for task in pending + [t for a in arrays for t in a.tasks]:
+                _fail(task, exc)
+
+    def _flush(self):
+        """Submit pending tasks, one job array per function and resource class.
+        """
+        with self._lock:
+            pending, self._pending = self._pending, []
+        groups = collections.OrderedDict()
+        for task in pending:
+            groups.setdefault((task.fn_name, task.cores, task.memory), []).append(task)
+        groups = list(groups.items())
+        for i, ((fn_name, cores, memory), tasks) in enumerate(groups):
+            try:
+                array = self._submit_array(fn_name, cores, memory, tasks)
+            except Exception:
+                # Return unsubmitted tasks to the queue so they fail with the error instead of waiting forever
+                with self._lock:
+                    self._pending = [t for _, ts in groups[i:] for t in ts] + self._pending
+                raise
+            with self._lock:
+                self._arrays.append(array)
+
+    def _submit_array(self, fn_name, cores, memory, tasks):
+        with self._lock:
+            self._narrays += 1
+            name = "%s-%s-%s" % (self.tag, fn_name.split(":")[-1], self._narrays)
+        array_dir = utils.safe_makedir(os.path.join(self.work_dir, name))
+        log_dir = utils.safe_makedir(os.path.join(array_dir, "log"))
+        for i, task in enumerate(tasks):
+            task.attempts += 1
+            runfn.write_out(os.path.join(array_dir, "task-%s%s" % (i + 1, self.ext)), task.args)
+        throttle = max(self.cores // cores, 1) if self.cores else None
+        script = os.path.join(array_dir, "%s.sh" % name)
+        with open(script, "w") as out_handle:
+            out_handle.write(_JOB_TEMPLATE.format(
+                directives="\n".join(self.scheduler.directives(name, len(tasks), throttle, cores, memory,
+                                                                self.parallel.get("queue"), log_dir)),
+                index_var=self.scheduler.index_var, array_dir=shlex.quote(array_dir),
+                cmd=" ".join(shlex.quote(x) for x in _bcbio_cmd()), fn_name=shlex.quote(fn_name), ext=self.ext,
+                worker=(" --worker %s" % shlex.quote(self.parallel["worker"])
+                        if self.parallel.get("worker") else ""),
+                trace=" --trace task-$IDX-trace.json" if self.trace is not None else ""))
+        job_id = self.scheduler.submit(script)
+        print("Submitted job array %s of %s %s tasks: %s" % (job_id, len(tasks), fn_name, name))
+        return _Array(job_id, array_dir, tasks)
+
+    def _poll(self):
+        """Check all running arrays, with one directory listing per array and one scheduler query.
+        """
+        with self._lock:
+            arrays = list(self._arrays)
+        if not arrays:
+            return
+        active = self.scheduler.active([a.job_id for a in arrays])
+        finished = []
+        for a in arrays:
+            files = set(os.listdir(a.array_dir))
+            a.started = a.started or any(f.startswith("started-") for f in files)
+            remaining = [i for i, t in enumerate(a.tasks) if not t.future.done()
+                         and "exit-%s" % (i + 1) not in files]
+            for i, task in enumerate(a.tasks):
+                if not task.future.done() and "exit-%s" % (i + 1) in files:
+                    self._finish_task(a, i, task)
+            if not remaining:
+                finished.append(a)
+            elif not a.started and time.time() - a.submitted > self.timeout:
+                self.scheduler.cancel([a.job_id])
+                for i in remaining:
+                    _fail(a.tasks[i], ClusterTimeout(
+                        "No jobs in array %s started within %s minutes" % (a.job_id, self.timeout / 60.0)))
+                finished.append(a)
+            elif a.job_id not in active:
+                # Elements without exit markers after the array leaves the queue were
+                # killed. Allow one extra poll for markers delayed on shared filesystems.
+                a.missing_polls += 1
+                if a.missing_polls > 1:
+                    for i in remaining:
+                        self._retry_or_fail(a.tasks[i], "job %s[%s] exited without a status"
+                                            % (a.job_id, i + 1), job_id="%s[%s]" % (a.job_id, i + 1))
+                    finished.append(a)
+        with self._lock:
+            self._arrays = [a for a in self._arrays if a not in finished]
+
+    def _finish_task(self, array, i, task):
+        base = os.path.join(array.array_dir, "task-%s" % (i + 1))
+        with open(os.path.join(array.array_dir, "exit-%s" % (i + 1))) as in_handle:
+            code = in_handle.read().strip()
+        stats = trace.read_stats("%s-trace.json" % base) if self.trace is not None else None
+        job_id = "%s[%s]" % (array.job_id, i + 1)
+        if code == "0":
+            result = runfn.read_args("%s-out%s" % (base, self.ext))
+            if stats:
+                self.trace.record(stats, task.fn_name, task.submitted, attempt=task.attempts, job_id=job_id)
+            if task.key:
+                self.cache.put(task.key, task.fn_name, result)
+            task.future.set_result(result)
+        else:
+            self._retry_or_fail(task, "exit code %s, see logs in %s" % (code, os.path.join(array.array_dir,
+                                                                                         "log")),
+                                stats, job_id)
+
+    def _retry_or_fail(self, task, msg, stats=None, job_id=None):
+        """Record a failed attempt in the trace, then queue it again or fail it after all retries.
+        """
+        if self.trace is not None:
+            if stats:
+                stats = dict(stats, status="error", error=stats.get("error") or msg)
+            else:
+                stats = trace.error_stats(task.fn_name, time.time(), msg)
+            self.trace.record(stats, task.fn_name, task.submitted, attempt=task.attempts, job_id=job_id)
+        if task.attempts <= self.retries:
+            print("Retrying failed task %s (attempt %s of %s): %s" %
+                  (task.fn_name, task.attempts + 1, self.retries + 1, msg))
+            task.submitted = time.time()
+            with self._lock:
+                self._pending.append(task)
+        else:
+            _fail(task, ClusterTaskError("Task %s failed: %s" % (task.fn_name, msg)))
+
+
+def _fail(task, exc):
+    if not task.future.done():
+        task.future.set_exception(exc)
+
@@ -0,0 +1,174 @@
+"""Run samples through a pipeline of stages without barriers between them.
+
+A pipeline is an ordered list of stages. Sample stages run on one sample
+at a time, taking and returning a sample dictionary, as produced by
+`template.setup`. Batch stages join the samples sharing a `metadata:
+batch`, taking and returning the list of sample dictionaries, for steps
+like joint variant calling. Each sample moves to its next stage as soon as
+its current one finishes, so one sample can be aligning while another is
+already calling variants; the only waits are batch stages, until every
+sample in the batch reaches them:
+
+    pipeline = dag.Pipeline([dag.Stage("align", "align_sample", progs=["bwa"]),
+                             dag.Stage("recalibrate", "recalibrate_sample", progs=["gatk"],
+                                       when=lambda x: x["algorithm"].get("recalibrate")),
+                             dag.Stage("variantcall", "variantcall_batch", progs=["gatk"], batch=True)])
+    with prun.start(parallel, config) as scheduler:
+        samples = pipeline.run(samples, scheduler)
+
+Stage functions are registered `multitasks` names, `module:function`
+paths or module level functions; the cluster scheduler runs them in fresh
+processes through `multitasks.import_path`, so lambdas and nested
+functions only run locally. Tasks are sized per stage from the programs
+the stage runs (see `resources.calculate`).
+"""
+from __future__ import print_function
+import time
+import collections
+from concurrent import futures
+
+from bcbio.distributed import resources as dresources
+
+
+class Stage(object):
+    """A pipeline step.
+
+    `fn` runs one sample, or with `batch` the list of samples in a batch.
+    `progs` are the programs it runs, used to size tasks, and `when` an
+    optional test on a sample dictionary choosing the samples it applies
+    to; other samples pass straight through.
+    """
+    def __init__(self, name, fn, progs=None, batch=False, when=None):
+        self.name = name
+        self.fn = fn
+        self.progs = list(progs or [])
+        self.batch = batch
+        self.when = when
+
+    def applies(self, data):
+        return self.when is None or bool(self.when(data))
+
+
+def batch_key(data):
+    """Batch a sample is called in: its `metadata: batch`, or itself when unbatched.
+    """
+    batch = (data.get("metadata") or {}).get("batch")
+    if isinstance(batch, (list, tuple)):
+        batch = tuple(batch)
+    return batch if batch else ("sample", data.get("description"))
+
+
+class _Sample(object):
+    def __init__(self, data):
+        self.data = data
+        self.stage = 0
+        self.batch = batch_key(data)
+        self.failed = None
+        self.running = False
+
+
+class Pipeline(object):
+    """Ordered stages run over a set of samples.
+    """
+    def __init__(self, stages):
+        self.stages = list(stages)
+        names = [s.name for s in self.stages]
+        if len(set(names)) != len(names):
+            raise ValueError("Pipeline stage names must be unique: %s" % names)
+
+    def run(self, samples, scheduler, keep_going=False):
+        """Run samples through all stages on a scheduler from `prun.start`, returning them in input order.
+
+        The first failing task raises its exception, cancelling queued
+        work. With `keep_going`, samples in failed tasks are reported and
+        dropped while the others carry on.
+        """
+        samples = [_Sample(x) for x in samples]
+        batches = collections.defaultdict(list)
+        for s in samples:
+            batches[s.batch].append(s)
+        sizes = {}
+        running = {}
+        start = time.time()
+
+        def submit(stage, args, group, num_tasks):
+            for s in group:
+                s.running = True
+            running[self._submit(scheduler, sizes, num_tasks, stage, args)] = group
+
+        def advance(ready):
+            """Move samples past stages that do not apply, then queue or join them.
+            """
+            for s in ready:
+                if s.failed is not None:
+                    continue
+                while s.stage < len(self.stages) and not self.stages[s.stage].applies(s.data):
+                    s.stage += 1
+                if s.stage < len(self.stages) and not self.stages[s.stage].batch:
+                    submit(self.stages[s.stage], [s.data], [s], len(samples))
+            for key in set(s.batch for s in ready):
+                members = [s for s in batches[key] if s.failed is None]
+                waiting = [s for s in members if not s.running and s.stage < len(self.stages)
+                           and self.stages[s.stage].batch]
+                if not waiting:
+                    continue
+                stage_i = min(s.stage for s in waiting)
+                # Join once no live member of the batch can still arrive at this stage
+                if all(s.stage >= stage_i for s in members):
+                    joined = [s for s in waiting if s.stage == stage_i]
+                    submit(self.stages[stage_i], [[s.data for s in joined]], joined, len(batches))
+
+        advance(samples)
+        try:
+            while running:
+                done, _ = futures.wait(list(running), return_when=futures.FIRST_COMPLETED)
+                finished = []
+                for f in done:
+                    group = running.pop(f)
+                    for s in group:
+                        s.running = False
+                    stage = self.stages[group[0].stage]
+                    try:
+                        result = f.result()
+                    except Exception as e:
+                        if not keep_going:
+                            raise
+                        for s in group:
+                            s.failed = "%s: %s" % (stage.name, e)
+                            print("Sample %s failed in %s: %s" % (s.data.get("description"), stage.name, e))
+                        finished.extend(group)
+                        continue
+                    if stage.batch:
+                        if len(result) != len(group):
+                            raise ValueError("Batch stage %s returned %s samples for %s inputs"
+                                             % (stage.name, len(result), len(group)))
+                        for s, data in zip(group, result):
+                            s.data = data
+                    else:
+                        group[0].data = result
+                    for s in group:
+                        s.stage += 1
+                    finished.extend(group)
+                advance(finished)
+        except BaseException:
+            scheduler.cancel()
+            raise
+        failed = [s for s in samples if s.failed]
+        print("Pipeline finished %s of %s samples in %.1fs" % (len(samples) - len(failed), len(samples),
+                                                               time.time() - start))
+        return [s.data for s in samples if s.failed is None]
+
+    def _submit(self, scheduler, sizes, num_tasks, stage, args):
+        """Queue a stage task, sizing it from the stage programs on first use.
+        """
+        if stage.progs:
+            if stage.name not in sizes:
+                sizes[stage.name] = dresources.calculate(dict(scheduler.parallel, progs=stage.progs),
+                                                         [[]] * num_tasks, scheduler.config)
+            parallel = sizes[stage.name]
+            datas = args[0] if stage.batch else args
+            datas = [x[0] for x in dresources.update_items([[d] for d in datas], parallel)]
+            args = [datas] if stage.batch else datas
+            return scheduler.submit(stage.fn, args, parallel["cores_per_job"], parallel["mem_per_job"])
+        return scheduler.submit(stage.fn, args)
+
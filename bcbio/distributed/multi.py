@@ -0,0 +1,274 @@
+"""Run distributed functions on multiple cores of the local machine.
+
+Tasks go onto a process pool sized to the available cores. Each task
+requests a number of cores and an amount of memory, and is only started
+when both are free, so multicore programs and single core tasks can
+share a machine without oversubscribing it.
+"""
+from __future__ import print_function
+import time
+import collections
+import threading
+from concurrent import futures
+from concurrent.futures.process import BrokenProcessPool
+
+from bcbio.distributed import multitasks, taskcache, trace
+from bcbio.distributed import resources as dresources
+
+
+def runner(parallel, config=None):
+    """Run functions on multiple cores of the current machine.
+
+    Returns a `run_parallel` function taking the function to run, as a
+    callable or a name registered in `multitasks`, a list of
+    argument lists and optional resource requests (see `LocalScheduler.map`).
+    """
+    def run_parallel(fn, items, resources=None):
+        items = [x for x in items if x is not None]
+        if len(items) == 0:
+            return []
+        with LocalScheduler(parallel, config) as scheduler:
+            return scheduler.map(fn, items, resources)
+    return run_parallel
+
+
+class _Task(object):
+    def __init__(self, fn, args, cores, memory):
+        self.fn = fn
+        self.args = args
+        self.cores = cores
+        self.memory = memory
+        self.attempts = 0
+        self.future = futures.Future()
+        self.key = None
+        self.submitted = time.time()
+        self.started = None
+
+
+class LocalScheduler(object):
+    """Schedule function calls on a local process pool with core and memory accounting.
+
+    `parallel` is the dictionary from `clargs.to_parallel`. `cores` is the
+    total cores to use, `retries` the number of times a failed task is
+    resubmitted. Total memory defaults to the physical memory of the machine
+    and can be set with a `mem` key, in Gb or as a specification like `64G`. With a `task_cache`, tasks
+    finished by an earlier run return their recorded results, and with
+    `trace` each task's resource use is recorded (see `trace.from_parallel`).
+
+    `config` is the system configuration with per-program `resources`.
+    When `parallel["progs"]` lists the programs tasks run, `map` sizes
+    tasks from their resource specifications (see `resources.calculate`).
+    """
+    def __init__(self, parallel, config=None):
+        self.parallel = parallel
+        self.config = config
+        self.cores = max(int(parallel.get("cores") or 1), 1)
+        self.memory = float(dresources.parse_memory(parallel.get("mem")) or dresources.get_total_memory() or 0)
+        self.retries = max(int(parallel.get("retries") or 0), 0)
+        self.cache = taskcache.from_parallel(parallel)
+        self.trace = trace.from_parallel(parallel)
+        self._free_cores = self.cores
+        self._free_memory = self.memory
+        self._pending = collections.deque()
+        self._lock = threading.RLock()
+        self._idle = threading.Condition(self._lock)
+        self._dispatching = False
+        self._redispatch = False
+        self._pool = None
+        self._closed = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.shutdown(cancel=exc_type is not None)
+
+    def submit(self, fn, args, cores=1, memory=None):
+        """Queue `fn(*args)` needing `cores` cores and `memory` Gb, returning a Future.
+
+        Requests larger than the machine are clamped so the task runs on its own.
+        """
+        cores = min(max(int(cores or 1), 1), self.cores)
+        memory = min(dresources.parse_memory(memory, 0.0), self.memory) if self.memory else 0
+        task = _Task(fn, list(args), cores, memory)
+        if self.cache is not None:
+            task.key = self.cache.key(fn, task.args)
+            found, result = self.cache.get(task.key)
+            if found:
+                task.future.set_result(result)
+                return task.future
+        with self._lock:
+            if self._closed:
+                raise RuntimeError("Cannot submit tasks to a shut down scheduler")
+            self._pending.append(task)
+            self._dispatch()
+        return task.future
+
+    def map(self, fn, items, resources=None):
+        """Run `fn` on each argument list in `items`, returning results in order.
+
+        `resources` is a dictionary of `cores` and `memory` (Gb) applied to
+        every task, or a list of dictionaries with one entry per item.
+        Without `resources`, tasks are sized from the programs they run.
+        Larger tasks are queued first, so smaller ones fill the remaining
+        cores and memory. The first task to fail after all retries raises
+        its exception.
+        """
+        items = list(items)
+        if resources is None and self.parallel.get("progs"):
+            items, resources = dresources.allocate(self.parallel, items, self.config)
+        if isinstance(resources, dict) or resources is None:
+            resources = [resources or {}] * len(items)
+        assert len(resources) == len(items), (len(resources), len(items))
+        if self.cores == 1:
+            return [self._run_serial(fn, args) for args in items]
+        order = sorted(range(len(items)), key=lambda i: (-int(resources[i].get("cores") or 1),
+                                                         -float(resources[i].get("memory") or 0)))
+        fs = {}
+        for i in order:
+            fs[i] = self.submit(fn, items[i], resources[i].get("cores", 1), resources[i].get("memory"))
+        fs = [fs[i] for i in range(len(items))]
+        try:
+            return [f.result() for f in fs]
+        except BaseException:
+            self.cancel()
+            raise
+
+    def cancel(self):
+        """Cancel all queued tasks that have not yet started.
+        """
+        with self._lock:
+            while self._pending:
+                self._pending.popleft().future.cancel()
+
+    def shutdown(self, cancel=False):
+        with self._lock:
+            self._closed = True
+            if cancel:
+                self.cancel()
+            while self._pending or self._free_cores < self.cores:
+                self._idle.wait()
+            pool, self._pool = self._pool, None
+        if pool is not None:
+            pool.shutdown(wait=True)
+        if self.cache is not None:
+            self.cache.close()
+            self.cache = None
+
+    def _run_serial(self, fn, args):
+        key = None
+        if self.cache is not None:
+            key = self.cache.key(fn, args)
+            found, result = self.cache.get(key)
+            if found:
+                return result
+        fn_name = fn
+        if not callable(fn):
+            fn = multitasks.get(fn)
+        attempts = 0
+        while True:
+            submitted = time.time()
+            try:
+                if self.trace is not None:
+                    result, stats = trace.measure(fn, args)
+                    self.trace.record(stats, fn_name, submitted, attempt=attempts + 1)
+                else:
+                    result = fn(*args)
+                if key:
+                    self.cache.put(key, fn_name, result)
+                return result
+            except Exception as e:
+                if self.trace is not None and getattr(e, "trace_stats", None):
+                    self.trace.record(e.trace_stats, fn_name, submitted, attempt=attempts + 1)
+                attempts += 1
+                if attempts > self.retries:
+                    raise
+                print("Retrying failed task %s (attempt %s of %s)" %
+                      (getattr(fn, "__name__", fn), attempts + 1, self.retries + 1))
+
+    def _get_pool(self):
+        if self._pool is None:
+            self._pool = futures.ProcessPoolExecutor(max_workers=self.cores)
+        return self._pool
+
+    def _dispatch(self):
+        """Start queued tasks, in order, that fit in the currently free cores and memory.
+        """
+        if self._dispatching:
+            self._redispatch = True
+            return
+        self._dispatching = True
+        try:
+            self._redispatch = True
+            while self._redispatch:
+                self._redispatch = False
+                waiting = collections.deque()
+                while self._pending:
+                    task = self._pending.popleft()
+                    if task.future.cancelled():
+                        continue
+                    if task.cores <= self._free_cores and task.memory <= self._free_memory + 1e-6:
+                        self._start(task)
+                    else:
+                        waiting.append(task)
+                self._pending.extend(waiting)
+        finally:
+            self._dispatching = False
+
+    def _start(self, task):
+        self._free_cores -= task.cores
+        self._free_memory -= task.memory
+        if task.attempts == 0:
+            task.future.set_running_or_notify_cancel()
+        task.attempts += 1
+        task.started = time.time()
+        measure = self.trace is not None
+        try:
+            pool_future = self._get_pool().submit(_run_task, task.fn, task.args, measure)
+        except BrokenProcessPool:
+            self._pool = None
+            pool_future = self._get_pool().submit(_run_task, task.fn, task.args, measure)
+        pool_future.add_done_callback(lambda f: self._finished(task, f))
+
+    def _finished(self, task, pool_future):
+        result = None
+        if not pool_future.cancelled() and pool_future.exception() is None:
+            result = pool_future.result()
+            if self.trace is not None:
+                result, stats = result
+                self.trace.record(stats, task.fn, task.submitted, attempt=task.attempts)
+            if task.key:
+                self.cache.put(task.key, task.fn, result)
+        with self._lock:
+            self._free_cores += task.cores
+            self._free_memory += task.memory
+            # exception() raises for cancelled futures, which would leave the cores in use
+            exc = futures.CancelledError() if pool_future.cancelled() else pool_future.exception()
+            if isinstance(exc, BrokenProcessPool) and self._pool is not None:
+                # A worker died, for instance from being killed when out of memory.
+                # Replace the pool so retried and queued tasks can still run.
+                self._pool.shutdown(wait=False)
+                self._pool = None
+            if exc is not None and self.trace is not None:
+                stats = getattr(exc, "trace_stats", None) or trace.error_stats(task.fn, task.started, exc)
+                self.trace.record(stats, task.fn, task.submitted, attempt=task.attempts)
+            if exc is None:
+                task.future.set_result(result)
+            elif task.attempts <= self.retries:
+                print("Retrying failed task %s (attempt %s of %s): %s" %
+                      (getattr(task.fn, "__name__", task.fn), task.attempts + 1,
+                       self.retries + 1, exc))
+                task.submitted = time.time()
+                self._pending.appendleft(task)
+            else:
+                task.future.set_exception(exc)
+            self._dispatch()
+            self._idle.notify_all()
+
+
+def _run_task(fn, args, measure=False):
+    if not callable(fn):
+        fn = multitasks.get(fn)
+    if measure:
+        return trace.measure(fn, args)
+    return fn(*args)
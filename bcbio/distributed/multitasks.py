@@ -0,0 +1,70 @@
+"""Registry of functions exposed for distributed processing through `runfn`.
+
+Functions are looked up by name so the submitting process and workers only
+need to agree on a string. Entries are `module:function` paths imported on
+first use, so a worker only imports what its function needs. Unregistered
+`module:function` names are imported directly, which is how tasks reach
+workers in fresh processes that never saw the submitting process's
+registrations (see `import_path`).
+"""
+import importlib
+
+_FUNCTIONS = {}
+
+
+def register(name, fn):
+    """Expose a function under `name`, as a callable or a `module:function` path.
+    """
+    _FUNCTIONS[name] = fn
+    return fn
+
+
+def _import(path):
+    module_name, fn_name = path.split(":")
+    return getattr(importlib.import_module(module_name), fn_name)
+
+
+def get(name):
+    """Retrieve the function registered under `name`, or importable as a `module:function` path.
+    """
+    fn = _FUNCTIONS.get(name)
+    if fn is None:
+        if ":" not in name:
+            raise AttributeError("Did not find exposed function in bcbio.distributed.multitasks named '%s'"
+                                 % name)
+        try:
+            fn = _import(name)
+        except (ImportError, AttributeError, ValueError) as e:
+            raise AttributeError("Could not import distributed function %s: %s" % (name, e))
+    elif not callable(fn):
+        fn = _import(fn)
+    _FUNCTIONS[name] = fn
+    return fn
+
+
+def import_path(fn):
+    """`module:function` path a fresh process can import `fn` from.
+
+    `fn` is a registered name, a `module:function` path or a module level
+    function. Raises ValueError for functions other processes cannot import,
+    such as lambdas or functions defined in a script run as `__main__`.
+    """
+    if not callable(fn):
+        registered = _FUNCTIONS.get(fn, fn)
+        if not callable(registered):
+            if ":" not in registered:
+                raise ValueError("Did not find exposed function in bcbio.distributed.multitasks named '%s'"
+                                 % fn)
+            return registered
+        fn = registered
+    module_name = getattr(fn, "__module__", None)
+    fn_name = getattr(fn, "__name__", None)
+    if not module_name or module_name == "__main__" or not fn_name or "<" in fn_name \
+            or getattr(importlib.import_module(module_name), fn_name, None) is not fn:
+        raise ValueError("Distributed function %r is not importable from another process; "
+                         "define it at module level" % fn)
+    return "%s:%s" % (module_name, fn_name)
+
+
+def available():
+    return sorted(_FUNCTIONS.keys())
@@ -0,0 +1,26 @@
+"""Start parallel processing based on the `parallel` dictionary from the command line.
+"""
+import contextlib
+
+from bcbio.distributed import multi
+
+
+@contextlib.contextmanager
+def start(parallel, config=None):
+    """Provide a scheduler for running functions, shutting it down when finished.
+
+    The scheduler has `map(fn, items, resources)` for running a set of
+    function calls and `submit(fn, args, cores, memory)` for single calls.
+    `ipython` runs named functions as job arrays on the cluster scheduler.
+    `config` is the system configuration, whose per-program `resources`
+    size tasks for the programs listed in `parallel["progs"]`.
+    """
+    if parallel["type"] == "local":
+        with multi.LocalScheduler(parallel, config) as scheduler:
+            yield scheduler
+    elif parallel["type"] == "ipython":
+        from bcbio.distributed import cluster
+        with cluster.ClusterScheduler(parallel, config=config) as scheduler:
+            yield scheduler
+    else:
+        raise NotImplementedError("Unsupported parallel type: %s" % parallel["type"])
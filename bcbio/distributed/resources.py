@@ -0,0 +1,170 @@
+"""Allocate cores and memory to distributed tasks from per-program resource specifications.
+
+The `resources` section of `bcbio_system.yaml` gives, for each program, the
+cores it can use, the memory it needs per core and JVM options:
+
+    resources:
+      default: {cores: 16, memory: 3G, jvm_opts: [-Xms750m, -Xmx3500m]}
+      bwa: {cores: 16, memory: 2G}
+      gatk: {jvm_opts: [-Xms500m, -Xmx3500m]}
+
+For a set of tasks running some programs, `calculate` picks the cores and
+memory per task that fit the most tasks onto the available cores and
+memory of a machine or cluster node, spreading left over cores across
+running tasks instead of leaving them idle. `update_items` then sets each
+task's thread counts and JVM heap from what was allocated. Schedulers
+queue the largest tasks first so smaller ones fill the remaining space,
+packing tasks of differing sizes by first fit decreasing.
+"""
+import os
+import re
+import copy
+import math
+
+# Fraction of a task's memory given to the JVM heap, leaving room for
+# off-heap memory and child processes.
+JVM_HEAP_FRACTION = 0.85
+
+
+def parse_memory(val, default=None):
+    """Convert memory specifications like 3G, 3500M or 3.5 (Gb) to Gb.
+    """
+    if val is None or val == "":
+        return default
+    if isinstance(val, (int, float)):
+        return float(val)
+    m = re.match(r"^\s*([\d.]+)\s*([kmgt]?)b?\s*$", str(val).lower())
+    if not m:
+        raise ValueError("Could not parse memory specification: %s" % val)
+    scale = {"k": 1.0 / 1024 ** 2, "m": 1.0 / 1024, "g": 1.0, "t": 1024.0, "": 1.0}
+    return float(m.group(1)) * scale[m.group(2)]
+
+
+def get_total_memory():
+    """Total physical memory of the machine, in Gb.
+    """
+    try:
+        return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES") / float(1024 ** 3)
+    except (ValueError, OSError, AttributeError):
+        return None
+
+
+def program_resources(config, program):
+    """Resources for a program, filling unspecified values from the `default` entry.
+    """
+    resources = (config or {}).get("resources", {}) or {}
+    out = copy.deepcopy(resources.get("default", {}) or {})
+    out.update(copy.deepcopy(resources.get(program, {}) or {}))
+    return out
+
+
+def _jvm_heap(jvm_opts):
+    """Maximum JVM heap in Gb from -Xmx options, or None.
+    """
+    for opt in jvm_opts or []:
+        if str(opt).startswith("-Xmx"):
+            return parse_memory(str(opt)[4:])
+
+
+def calculate(parallel, items, config):
+    """Choose the cores and memory for each task running the programs in `parallel["progs"]`.
+
+    Each task wants the largest core count of its programs, with the
+    largest per-core memory, where -Xmx JVM options count as per task
+    memory needs. Cores come from `cores_per_node` or `cores`, and memory
+    in Gb from `mem` or the physical memory of this machine. Returns an
+    updated copy of `parallel` with `cores_per_job`, `mem_per_job` (Gb)
+    and `num_jobs`, the number of tasks running at once on a node.
+    """
+    parallel = copy.deepcopy(parallel)
+    num_tasks = max(len([x for x in items if x is not None]), 1)
+    node_cores = max(int(parallel.get("cores_per_node") or parallel.get("cores") or 1), 1)
+    node_mem = float(parse_memory(parallel.get("mem")) or get_total_memory() or 0)
+    want_cores = 1
+    mem_per_core = 0.0
+    min_mem = 0.0
+    for prog in parallel.get("progs", []) or []:
+        r = program_resources(config, prog)
+        want_cores = max(want_cores, int(r.get("cores") or 1))
+        mem_per_core = max(mem_per_core, parse_memory(r.get("memory"), 0.0))
+        min_mem = max(min_mem, (_jvm_heap(r.get("jvm_opts")) or 0.0) / JVM_HEAP_FRACTION)
+    cores = min(want_cores, node_cores)
+    # Tasks that fit on a node at once, limited by cores then by memory
+    num_jobs = min(num_tasks, max(node_cores // cores, 1))
+    task_mem = max(cores * mem_per_core, min_mem)
+    if node_mem and task_mem:
+        while num_jobs > 1 and num_jobs * task_mem > node_mem:
+            num_jobs -= 1
+    # Spread cores left idle by fewer tasks over the running ones, up to what the programs use
+    cores = min(max(node_cores // num_jobs, cores), want_cores)
+    task_mem = max(cores * mem_per_core, min_mem)
+    if node_mem:
+        task_mem = min(task_mem, node_mem / num_jobs) if task_mem else node_mem / num_jobs
+    parallel["cores_per_job"] = cores
+    parallel["mem_per_job"] = round(task_mem, 2)
+    parallel["num_jobs"] = num_jobs
+    return parallel
+
+
+def allocate(parallel, items, config):
+    """Allocate resources for a set of tasks, returning updated items and the per-task request.
+
+    The request is the `resources` dictionary for scheduler `map` calls.
+    """
+    parallel = calculate(parallel, items, config)
+    return (update_items(items, parallel),
+            {"cores": parallel["cores_per_job"], "memory": parallel["mem_per_job"]})
+
+
+def update_items(items, parallel):
+    """Set thread counts and JVM heap in each item's configuration from the allocation.
+
+    Items are lists of task arguments. Argument dictionaries with a `config`
+    get `algorithm: num_cores` and, for each program in `parallel["progs"]`,
+    `resources` cores, memory per core and -Xmx/-Xms options scaled to the
+    task memory.
+    """
+    cores = parallel["cores_per_job"]
+    mem = parallel["mem_per_job"]
+    out = []
+    for item in items:
+        if item is None:
+            out.append(item)
+            continue
+        item = copy.deepcopy(item)
+        for data in item:
+            if isinstance(data, dict) and isinstance(data.get("config"), dict):
+                _update_config(data["config"], parallel.get("progs", []) or [], cores, mem)
+        out.append(item)
+    return out
+
+
+def _update_config(config, progs, cores, mem):
+    config.setdefault("algorithm", {})["num_cores"] = cores
+    resources = config.setdefault("resources", {})
+    for prog in progs:
+        r = program_resources(config, prog)
+        r["cores"] = cores
+        if mem:
+            r["memory"] = "%sM" % int(math.floor(mem * 1024 / cores))
+            if r.get("jvm_opts"):
+                r["jvm_opts"] = scale_jvm_opts(r["jvm_opts"], mem)
+        resources[prog] = r
+
+
+def scale_jvm_opts(jvm_opts, mem):
+    """Set -Xmx to the allocated heap, keeping -Xms no larger than it.
+    """
+    heap = int(math.floor(mem * 1024 * JVM_HEAP_FRACTION))
+    out = []
+    for opt in jvm_opts:
+        opt = str(opt)
+        if opt.startswith("-Xmx"):
+            opt = "-Xmx%sm" % heap
+        elif opt.startswith("-Xms"):
+            opt = "-Xms%sm" % min(heap, int(parse_memory(opt[4:], 0) * 1024))
+        out.append(opt)
+    if not any(x.startswith("-Xmx") for x in out):
+        out.append("-Xmx%sm" % heap)
+    return out
+
@@ -1,12 +1,141 @@
+"""Run a named bcbio-nextgen function with arguments from a file.
+
+Intended for distributed use: the submitting process writes the function
+arguments to a file, a worker runs `bcbio_nextgen.py runfn name argfile`
+and the results are written to an output file for the submitter to read.
+Argument files are JSON, YAML, msgpack or pickle, picked by extension;
+the binary formats avoid slow YAML handling of large sample dictionaries.
+"""
 import os
-import sys
+import json
+import pickle
+
+from bcbio import utils
+from bcbio.distributed import multitasks
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+FORMATS = {".json": "json", ".yaml": "yaml", ".yml": "yaml",
+           ".msgpack": "msgpack", ".mpk": "msgpack",
+           ".pkl": "pickle", ".pickle": "pickle"}
+PICKLE_PROTOCOL = min(5, pickle.HIGHEST_PROTOCOL)
 
 def add_subparser(subparser):
     parser = subparser.add_parser("runfn", help=("Run a specific bcbio-nextgen function."
                                                   "Intended for distributed use."))
-    parser.add_argument("name", help="Name of the function to run")
-    parser.add_argument("argfile", help="JSON file with arguments to the function")
+    parser.add_argument("name", help="Registered name or module:function path of the function to run")
+    parser.add_argument("argfile", help=("File with arguments to the function: JSON, YAML, "
+                                         "msgpack (.msgpack) or pickle (.pkl)"))
     parser.add_argument("moreargs", nargs="*", help="Additional arguments to pass in the case of raw input")
     parser.add_argument("--raw", action="store_true", default=False,
                         help="Treat the inputs as raw file arguments to the function, instead of parsing them.")
-    parser.add_argument("-o", "--outfile", help="Output file to write, defaults to inputfile-out.yaml")
+    parser.add_argument("--batch", action="store_true", default=False,
+                        help=("The argument file contains a list of argument sets. Run the function "
+                              "on each and write a list of results."))
+    parser.add_argument("-o", "--outfile",
+                        help="Output file to write, defaults to inputfile-out with the input format")
+    parser.add_argument("--worker",
+                        help=("Unix socket of a warm worker daemon (bcbio_nextgen.py worker) to run "
+                              "the function in. Runs in this process if the daemon is not available."))
+    parser.add_argument("--trace",
+                        help="Write the run time, CPU, memory and I/O statistics of the function to this JSON file")
+
+def process(args):
+    """Run the function in args.name given arguments in args.argfile.
+
+    Returns the function output when run in this process.
+    """
+    if args.moreargs or args.raw:
+        fn = multitasks.get(args.name)
+        return fn(*([args.argfile] + args.moreargs))
+    outfile = args.outfile if args.outfile else "%s-out%s" % os.path.splitext(args.argfile)
+    if args.worker:
+        from bcbio.distributed import worker
+        if worker.run_on(args.worker, args.name, args.argfile, outfile, args.batch, args.trace):
+            return None
+    return run(args.name, args.argfile, outfile, args.batch, args.trace)
+
+def run(name, argfile, outfile, batch=False, trace_file=None):
+    """Run a named function on arguments from `argfile`, writing results to `outfile`.
+
+    Runs inside the argument file directory, where relative paths in the
+    arguments are resolved. With `trace_file`, resource statistics for the
+    function call are written there, including for a call that fails.
+    """
+    fn = multitasks.get(name)
+    fnargs = read_args(argfile)
+    outfile = os.path.abspath(outfile)
+    trace_file = os.path.abspath(trace_file) if trace_file else None
+    with utils.chdir(os.path.dirname(os.path.abspath(argfile))):
+        if batch:
+            call = lambda: [fn(*x) for x in fnargs]
+        else:
+            call = lambda: fn(*fnargs)
+        if trace_file:
+            from bcbio.distributed import trace
+            try:
+                out, stats = trace.measure(call, [])
+            except Exception as e:
+                trace.write_stats(trace_file, dict(e.trace_stats, fn=name))
+                raise
+            stats["fn"] = name
+        else:
+            out = call()
+    write_out(outfile, out)
+    if trace_file:
+        trace.write_stats(trace_file, stats)
+    return out
+
+def _get_format(fname):
+    ext = os.path.splitext(fname)[-1].lower()
+    try:
+        fmt = FORMATS[ext]
+    except KeyError:
+        raise ValueError("Unexpected argument file extension %s, supported: %s"
+                         % (fname, ", ".join(sorted(FORMATS.keys()))))
+    if fmt == "msgpack" and msgpack is None:
+        raise ImportError("msgpack argument files require the msgpack python package: %s" % fname)
+    return fmt
+
+def read_args(fname):
+    """Read function arguments, or results, from a file in any supported format.
+    """
+    fmt = _get_format(fname)
+    if fmt in ["msgpack", "pickle"]:
+        with open(fname, "rb") as in_handle:
+            if fmt == "msgpack":
+                return msgpack.unpack(in_handle, raw=False)
+            return pickle.load(in_handle)
+    with open(fname) as in_handle:
+        if fmt == "json":
+            return json.load(in_handle)
+        import yaml
+        return yaml.load(in_handle, Loader=getattr(yaml, "CSafeLoader", yaml.SafeLoader))
+
+def write_out(fname, data):
+    """Write function arguments or results to a file, atomically.
+
+    Writes go to a temporary file renamed into place, so readers polling
+    for outputs on shared filesystems never see partial files.
+    """
+    fmt = _get_format(fname)
+    tx_file = "%s.tx%s" % (fname, os.getpid())
+    if fmt in ["msgpack", "pickle"]:
+        with open(tx_file, "wb") as out_handle:
+            if fmt == "msgpack":
+                msgpack.pack(data, out_handle, use_bin_type=True)
+            else:
+                pickle.dump(data, out_handle, protocol=PICKLE_PROTOCOL)
+    else:
+        with open(tx_file, "w") as out_handle:
+            if fmt == "json":
+                json.dump(data, out_handle)
+            else:
+                import yaml
+                yaml.dump(data, out_handle, Dumper=getattr(yaml, "CSafeDumper", yaml.SafeDumper),
+                          default_flow_style=False, allow_unicode=False)
+    os.rename(tx_file, fname)
+    return fname
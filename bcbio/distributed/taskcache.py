@@ -0,0 +1,205 @@
+"""Record finished distributed tasks so restarted runs skip completed work.
+
+Each task is keyed by its function name and its arguments normalized to
+canonical JSON. Results are stored in a SQLite index along with
+fingerprints (path, size and modification time, or content checksums) of
+the files the arguments referred to when the task was submitted, its
+inputs, and of the files the result refers to, its outputs. A cached result
+is only reused while its inputs are unchanged and its outputs still exist.
+Argument paths that did not exist at submission, like output files passed
+in to be written, are not inputs, so they do not change the key on restart.
+Files the task returns or rewrites, such as a partial output left by an
+earlier run, are recorded as outputs after the run rather than as inputs.
+
+The index defaults to `checkpoints_parallel/taskcache.db` in the working
+directory.
+"""
+from __future__ import print_function
+import os
+import json
+import time
+import pickle
+import sqlite3
+import hashlib
+import threading
+
+from bcbio import utils
+
+PICKLE_PROTOCOL = min(4, pickle.HIGHEST_PROTOCOL)
+DEFAULT_MAX_SIZE = 5 * 1024 ** 3
+_COLUMNS = ["key", "fn_name", "inputs", "outputs", "result", "size", "created", "used"]
+_SCHEMA = """CREATE TABLE IF NOT EXISTS tasks (
+    key TEXT PRIMARY KEY, fn_name TEXT, inputs TEXT, outputs TEXT, result BLOB,
+    size INTEGER, created REAL, used REAL)"""
+
+
+def default_cache_file(work_dir=None):
+    return os.path.join(work_dir or os.getcwd(), "checkpoints_parallel", "taskcache.db")
+
+
+def from_parallel(parallel):
+    """Task cache configured by the `task_cache` key of a parallel dictionary, or None.
+
+    The value is the index file to use, or True for the default location.
+    """
+    cache_file = parallel.get("task_cache")
+    if not cache_file:
+        return None
+    return TaskCache(None if cache_file is True else cache_file)
+
+
+def _files_in(data, found):
+    """Collect strings in nested arguments that name existing files.
+    """
+    if isinstance(data, dict):
+        for v in data.values():
+            _files_in(v, found)
+    elif isinstance(data, (list, tuple)):
+        for v in data:
+            _files_in(v, found)
+    elif isinstance(data, str) and 0 < len(data) < 4096 and "\n" not in data and os.path.isfile(data):
+        found.add(os.path.abspath(data))
+    return found
+
+
+def _fn_name(fn):
+    if callable(fn):
+        return "%s.%s" % (fn.__module__, fn.__name__)
+    return fn
+
+
+def _sha256(fname):
+    hasher = hashlib.sha256()
+    with open(fname, "rb") as in_handle:
+        for chunk in iter(lambda: in_handle.read(1024 * 1024), b""):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+class TaskCache(object):
+    """SQLite index of finished task results.
+
+    `max_size` bounds the stored results in bytes, removing the least
+    recently used entries first. With `checksum`, files are fingerprinted
+    by content instead of size and modification time.
+    """
+    def __init__(self, cache_file=None, max_size=DEFAULT_MAX_SIZE, checksum=False):
+        self.cache_file = os.path.abspath(cache_file or default_cache_file())
+        self.max_size = max_size
+        self.checksum = checksum
+        utils.safe_makedir(os.path.dirname(self.cache_file))
+        self._lock = threading.Lock()
+        self._inputs = {}
+        self._conn = sqlite3.connect(self.cache_file, timeout=60, check_same_thread=False)
+        with self._lock, self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            columns = [x[1] for x in self._conn.execute("PRAGMA table_info(tasks)")]
+            if columns and columns != _COLUMNS:
+                # Index from an earlier version, results are recomputed
+                self._conn.execute("DROP TABLE tasks")
+            self._conn.execute(_SCHEMA)
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    def _fingerprint(self, fname):
+        st = os.stat(fname)
+        if self.checksum:
+            return [fname, st.st_size, _sha256(fname)]
+        return [fname, st.st_size, st.st_mtime]
+
+    def key(self, fn_name, args):
+        """Key of a task from its function name and normalized arguments.
+
+        Fingerprints the input files the arguments refer to now, at
+        submission, to record with the result in `put`.
+        """
+        normalized = json.dumps([_fn_name(fn_name), args], sort_keys=True, default=repr)
+        key = hashlib.sha256(normalized.encode("utf-8")).hexdigest()
+        inputs = [self._fingerprint(f) for f in sorted(_files_in(args, set()))]
+        with self._lock:
+            self._inputs[key] = inputs
+        return key
+
+    def get(self, key):
+        """Return (True, result) for a finished task with unchanged files, or (False, None).
+        """
+        with self._lock:
+            row = self._conn.execute("SELECT inputs, outputs, result FROM tasks WHERE key = ?",
+                                     (key,)).fetchone()
+        if row is None:
+            return False, None
+        try:
+            valid = all(self._fingerprint(x[0]) == x for x in json.loads(row[0]) + json.loads(row[1]))
+        except OSError:
+            valid = False
+        if not valid:
+            self.invalidate(key=key)
+            return False, None
+        with self._lock, self._conn:
+            self._conn.execute("UPDATE tasks SET used = ? WHERE key = ?", (time.time(), key))
+            self._inputs.pop(key, None)
+        return True, pickle.loads(row[2])
+
+    def put(self, key, fn_name, result):
+        """Record the result of a finished task, with fingerprints of the files it refers to.
+
+        Submitted files the task returned or changed while running are
+        outputs, fingerprinted as they are now. Results that cannot be
+        pickled are not cached.
+        """
+        with self._lock:
+            submitted = self._inputs.pop(key, [])
+        try:
+            data = pickle.dumps(result, protocol=PICKLE_PROTOCOL)
+        except (pickle.PicklingError, TypeError, AttributeError):
+            return
+        output_files = _files_in(result, set())
+        inputs = []
+        for x in submitted:
+            if x[0] in output_files:
+                continue
+            try:
+                cur = self._fingerprint(x[0])
+            except OSError:
+                continue
+            if cur == x:
+                inputs.append(x)
+            else:
+                output_files.add(x[0])
+        outputs = [self._fingerprint(f) for f in sorted(output_files) if os.path.exists(f)]
+        now = time.time()
+        with self._lock, self._conn:
+            self._conn.execute("INSERT OR REPLACE INTO tasks VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                               (key, _fn_name(fn_name), json.dumps(inputs), json.dumps(outputs),
+                                sqlite3.Binary(data), len(data), now, now))
+        self.evict()
+
+    def invalidate(self, fn_name=None, key=None):
+        """Remove cached results for one task key, all tasks of a function, or everything.
+        """
+        with self._lock, self._conn:
+            if key:
+                self._conn.execute("DELETE FROM tasks WHERE key = ?", (key,))
+            elif fn_name:
+                self._conn.execute("DELETE FROM tasks WHERE fn_name = ?", (fn_name,))
+            else:
+                self._conn.execute("DELETE FROM tasks")
+
+    def evict(self, max_size=None, max_age=None):
+        """Remove entries unused for `max_age` seconds, then least recently used ones over the size limit.
+        """
+        max_size = self.max_size if max_size is None else max_size
+        with self._lock, self._conn:
+            if max_age:
+                self._conn.execute("DELETE FROM tasks WHERE used < ?", (time.time() - max_age,))
+            total = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM tasks").fetchone()[0]
+            if max_size and total > max_size:
+                remove = []
+                for key, size in self._conn.execute("SELECT key, size FROM tasks ORDER BY used"):
+                    if total <= max_size:
+                        break
+                    remove.append((key,))
+                    total -= size
+                self._conn.executemany("DELETE FROM tasks WHERE key = ?", remove)
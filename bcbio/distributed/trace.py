@@ -0,0 +1,302 @@
+"""Per-task performance traces for distributed runs.
+
+Every task attempt run by the local or cluster schedulers, or by `runfn`,
+failed or not, can record its wall time, CPU time, peak resident memory,
+bytes read and written (from `/proc/self/io`) and time spent queued.
+Records go to a JSON lines file per run, named by the run tag, and can be
+exported as Chrome trace events (for chrome://tracing or Perfetto) or
+summarized to find the slowest functions, failed attempts and the chain of
+tasks that bound total run time:
+
+    bcbio_nextgen.py trace log/trace/bcbio.jsonl --chrome bcbio-trace.json
+"""
+from __future__ import print_function
+import os
+import sys
+import json
+import time
+import socket
+import threading
+import collections
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+from bcbio import utils
+
+
+def add_subparser(subparser):
+    parser = subparser.add_parser("trace", help="Summarize a distributed run performance trace.")
+    parser.add_argument("trace_file", help="JSON lines trace written by a run with --trace")
+    parser.add_argument("-n", "--top", type=int, default=10, help="Number of slowest functions and tasks to report")
+    parser.add_argument("--chrome", help="Also export the trace as Chrome trace events to this file")
+
+
+def process(args):
+    if args.chrome:
+        to_chrome(args.trace_file, args.chrome)
+        print("Chrome trace written to %s" % args.chrome)
+    print(summarize(args.trace_file, args.top))
+
+
+def default_trace_file(tag=None, work_dir=None):
+    return os.path.join(work_dir or os.getcwd(), "log", "trace", "%s.jsonl" % (tag or "bcbio"))
+
+
+def from_parallel(parallel):
+    """Trace configured by the `trace` key of a parallel dictionary, or None.
+
+    The value is the trace file to use, or True for `log/trace/<tag>.jsonl`.
+    """
+    trace_file = parallel.get("trace")
+    if not trace_file:
+        return None
+    return Trace(default_trace_file(parallel.get("tag")) if trace_file is True else trace_file,
+                 parallel.get("tag"))
+
+
+def _read_io():
+    io = {}
+    try:
+        with open("/proc/self/io") as in_handle:
+            for line in in_handle:
+                key, val = line.split(":")
+                io[key] = int(val)
+    except (IOError, OSError, ValueError):
+        pass
+    return io
+
+
+def _max_rss_mb():
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return round(rss / (1024.0 * 1024.0 if sys.platform == "darwin" else 1024.0), 1)
+
+
+def _reset_peak_rss():
+    """Reset the peak resident memory of this process, where Linux (4.0+) allows it.
+    """
+    try:
+        with open("/proc/self/clear_refs", "w") as out_handle:
+            out_handle.write("5")
+        return True
+    except (IOError, OSError):
+        return False
+
+
+def _peak_rss_mb():
+    """Peak resident memory since the last reset, from /proc/self/status.
+    """
+    try:
+        with open("/proc/self/status") as in_handle:
+            for line in in_handle:
+                if line.startswith("VmHWM:"):
+                    return round(int(line.split()[1]) / 1024.0, 1)
+    except (IOError, OSError, ValueError, IndexError):
+        pass
+
+
+def measure(fn, args):
+    """Run `fn(*args)`, returning the result and a dictionary of resource statistics.
+
+    Peak memory is reset before the task where Linux allows it, so reused
+    worker processes report the task's own peak. Elsewhere the process
+    high-water mark is only attributed to a task that raised it, and
+    otherwise left unset. A failing task re-raises its exception, with the
+    statistics of the failed attempt in its `trace_stats` attribute.
+    """
+    fn_name = getattr(fn, "__name__", str(fn))
+    reset = _reset_peak_rss()
+    rss_start = _max_rss_mb()
+    io_start = _read_io()
+    cpu_start = time.process_time()
+    start = time.time()
+    try:
+        result = fn(*args)
+    except Exception as e:
+        e.trace_stats = _stats(fn_name, start, cpu_start, io_start, reset, rss_start)
+        e.trace_stats.update({"status": "error", "error": "%s: %s" % (type(e).__name__, e)})
+        raise
+    return result, _stats(fn_name, start, cpu_start, io_start, reset, rss_start)
+
+
+def _stats(fn_name, start, cpu_start, io_start, reset, rss_start):
+    end = time.time()
+    io_end = _read_io()
+    max_rss = _peak_rss_mb() if reset else None
+    if max_rss is None:
+        rss_end = _max_rss_mb()
+        max_rss = rss_end if rss_end is not None and rss_start is not None and rss_end > rss_start else None
+    return {"fn": fn_name, "start": start, "end": end, "status": "ok",
+            "wall": round(end - start, 6), "cpu": round(time.process_time() - cpu_start, 6),
+            "max_rss_mb": max_rss,
+            "read_bytes": io_end.get("read_bytes", 0) - io_start.get("read_bytes", 0),
+            "write_bytes": io_end.get("write_bytes", 0) - io_start.get("write_bytes", 0),
+            "rchar": io_end.get("rchar", 0) - io_start.get("rchar", 0),
+            "wchar": io_end.get("wchar", 0) - io_start.get("wchar", 0),
+            "host": socket.gethostname(), "pid": os.getpid()}
+
+
+def error_stats(fn_name, start, error):
+    """Statistics for an attempt that failed without reporting its own, such as a killed process.
+    """
+    end = time.time()
+    return {"fn": fn_name, "start": min(start, end), "end": end, "wall": round(max(end - start, 0), 6),
+            "status": "error", "error": str(error)}
+
+
+def write_stats(out_file, stats):
+    tx_file = "%s.tx%s" % (out_file, os.getpid())
+    with open(tx_file, "w") as out_handle:
+        json.dump(stats, out_handle)
+    os.rename(tx_file, out_file)
+
+
+def read_stats(in_file):
+    try:
+        with open(in_file) as in_handle:
+            return json.load(in_handle)
+    except (IOError, OSError, ValueError):
+        return None
+
+
+class Trace(object):
+    """Append-only JSON lines trace of task statistics, safe to share between threads.
+    """
+    def __init__(self, trace_file, tag=None):
+        self.trace_file = os.path.abspath(trace_file)
+        self.tag = tag
+        utils.safe_makedir(os.path.dirname(self.trace_file))
+        self._lock = threading.Lock()
+
+    def record(self, stats, fn_name=None, submitted=None, **extra):
+        """Write a task attempt's statistics, with queue wait from its submission time.
+        """
+        stats = dict(stats)
+        if fn_name is not None:
+            stats["fn"] = fn_name if isinstance(fn_name, str) else getattr(fn_name, "__name__", str(fn_name))
+        if submitted is not None and stats.get("start"):
+            stats["submitted"] = submitted
+            stats["queue_wait"] = round(max(stats["start"] - submitted, 0), 6)
+        if self.tag:
+            stats["tag"] = self.tag
+        stats.update(extra)
+        line = json.dumps(stats, sort_keys=True) + "\n"
+        with self._lock:
+            with open(self.trace_file, "a") as out_handle:
+                out_handle.write(line)
+
+
+def read_trace(trace_file):
+    out = []
+    with open(trace_file) as in_handle:
+        for line in in_handle:
+            if line.strip():
+                out.append(json.loads(line))
+    return out
+
+
+def to_chrome(trace_file, out_file):
+    """Export a trace as Chrome trace events, one process row per host and thread per process.
+
+    Chrome trace ids are numeric, so hosts are numbered in order of first
+    appearance and named with metadata events. Failed attempts are colored.
+    """
+    events = read_trace(trace_file)
+    t0 = min([e["start"] for e in events] or [0])
+    hosts = collections.OrderedDict()
+    out = []
+    for e in events:
+        host = e.get("host") or "localhost"
+        if host not in hosts:
+            hosts[host] = len(hosts) + 1
+            out.append({"name": "process_name", "ph": "M", "pid": hosts[host], "args": {"name": host}})
+        args = dict((k, v) for k, v in e.items() if k not in ["start", "end", "fn", "host", "pid"])
+        event = {"name": e["fn"], "cat": e.get("tag") or "task", "ph": "X",
+                 "ts": int((e["start"] - t0) * 1e6), "dur": int(max(e["end"] - e["start"], 0) * 1e6),
+                 "pid": hosts[host], "tid": int(e.get("pid") or 0), "args": args}
+        if e.get("status") == "error":
+            event["cname"] = "terrible"
+        out.append(event)
+    tx_file = "%s.tx%s" % (out_file, os.getpid())
+    with open(tx_file, "w") as out_handle:
+        json.dump({"traceEvents": out, "displayTimeUnit": "ms"}, out_handle)
+    os.rename(tx_file, out_file)
+    return out_file
+
+
+def _submitted(e):
+    return e.get("submitted", e["start"] - e.get("queue_wait", 0))
+
+
+def critical_path(events, slack=0.05):
+    """Chain of task attempts ending with the last to finish, that bounded total run time.
+
+    Dependencies between tasks are not recorded, so each task is taken to
+    wait on the latest task finishing before it was submitted, allowing
+    `slack` seconds for the submitting scheduler to react; tasks are only
+    submitted once their inputs are ready. Returns tasks in run order, each
+    with `waited`, the time from its predecessor finishing to its own start.
+    """
+    events = sorted(events, key=lambda x: x["end"])
+    if not events:
+        return []
+    path = [events[-1]]
+    while True:
+        cur = path[-1]
+        before = [e for e in events if e["end"] <= _submitted(cur) + slack and e is not cur
+                  and e["end"] <= cur["start"]]
+        if not before:
+            break
+        path.append(max(before, key=lambda x: x["end"]))
+    path.reverse()
+    out = []
+    for i, e in enumerate(path):
+        prev_end = path[i - 1]["end"] if i > 0 else _submitted(e)
+        out.append({"task": e, "waited": max(e["start"] - prev_end, 0)})
+    return out
+
+
+def summarize(trace_file, top=10):
+    """Text report of the slowest functions and tasks, and the critical path through stages.
+    """
+    events = read_trace(trace_file)
+    if not events:
+        return "No tasks in %s" % trace_file
+    by_fn = collections.defaultdict(list)
+    for e in events:
+        by_fn[e["fn"]].append(e)
+    total = max(e["end"] for e in events) - min(e["start"] for e in events)
+    failed = [e for e in events if e.get("status") == "error"]
+    lines = ["%s task attempts, %s failed, %.1fs elapsed" % (len(events), len(failed), total), "",
+             "Slowest functions by total wall time:",
+             "  %-30s %6s %10s %9s %9s %9s %9s %10s" % ("function", "tasks", "wall", "mean", "max", "cpu",
+                                                         "queue", "peak Mb")]
+    fns = sorted(by_fn.items(), key=lambda x: -sum(e["wall"] for e in x[1]))
+    for fn, es in fns[:top]:
+        wall = sum(e["wall"] for e in es)
+        lines.append("  %-30s %6s %9.1fs %8.1fs %8.1fs %8.1fs %8.1fs %10s" % (
+            fn, len(es), wall, wall / len(es), max(e["wall"] for e in es), sum(e.get("cpu", 0) for e in es),
+            sum(e.get("queue_wait", 0) for e in es), max([e.get("max_rss_mb") or 0 for e in es])))
+    lines += ["", "Slowest tasks:"]
+    for e in sorted(events, key=lambda x: -x["wall"])[:top]:
+        lines.append("  %-30s %9.1fs on %s:%s, read %.1fMb, wrote %.1fMb" % (
+            e["fn"], e["wall"], e.get("host"), e.get("pid"), e.get("read_bytes", 0) / 1048576.0,
+            e.get("write_bytes", 0) / 1048576.0))
+    if failed:
+        lines += ["", "Failed attempts:"]
+        for e in failed[:top]:
+            lines.append("  %-30s attempt %s on %s:%s: %s" % (e["fn"], e.get("attempt", 1), e.get("host"),
+                                                           e.get("pid"), e.get("error")))
+    lines += ["", "Critical path:"]
+    t0 = min(e["start"] for e in events)
+    for step in critical_path(events):
+        e = step["task"]
+        lines.append("  %-30s %8.1fs to %8.1fs (%5.1f%% of run) after waiting %.1fs, on %s:%s%s" % (
+            e["fn"], e["start"] - t0, e["end"] - t0, 100.0 * e["wall"] / total if total else 100.0,
+            step["waited"], e.get("host"), e.get("pid"), " (failed)" if e.get("status") == "error" else ""))
+    return "\n".join(lines)
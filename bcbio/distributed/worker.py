@@ -0,0 +1,204 @@
+"""Warm worker daemon running distributed tasks in forked children.
+
+A long lived `bcbio_nextgen.py worker SOCKET` process imports the task
+functions once and listens on a Unix socket. Each request forks a child
+from this warm parent, so tasks start without interpreter startup, imports
+or configuration parsing. Functions given with `--preload` are imported
+before serving, and the parent imports the function of each request before
+forking, so only the first task of a `module:function` pays for its
+imports. Children run the function exactly as `runfn` does, reading
+arguments from the argument file and writing results to the output file,
+then report back over the connection.
+
+The socket is only accessible to the user running the daemon, since
+requests name functions to import and pickle files to load.
+
+Requests and replies are single JSON lines:
+
+    {"name": "fn", "argfile": "/path/task-1.pkl", "outfile": "/path/task-1-out.pkl", "batch": false,
+     "trace": null}
+    {"status": "ok"} or {"status": "error", "error": "traceback"}
+"""
+from __future__ import print_function
+import os
+import sys
+import json
+import time
+import errno
+import socket
+import traceback
+
+from bcbio.distributed import multitasks, runfn
+
+def add_subparser(subparser):
+    parser = subparser.add_parser("worker", help=("Run a warm worker daemon for runfn tasks on this machine. "
+                                                   "Intended for distributed use."))
+    parser.add_argument("socket", help="Unix socket path to listen on")
+    parser.add_argument("-n", "--cores", type=int, default=1,
+                        help="Maximum number of tasks to run at once")
+    parser.add_argument("--idle-timeout", type=float, default=0,
+                        help="Exit after this many minutes without requests. Defaults to running until stopped.")
+    parser.add_argument("--preload", action="append", default=[],
+                        help=("Function names or module:function paths to import before serving requests. "
+                              "Defaults to all exposed functions. Can be specified multiple times."))
+
+def process(args):
+    serve(args.socket, args.cores, args.idle_timeout * 60.0, args.preload or None)
+
+def preload(names=None):
+    """Import task functions, and their modules, ahead of forking workers.
+
+    Defaults to the functions registered in `multitasks`.
+    """
+    for name in names or multitasks.available():
+        multitasks.get(name)
+
+def _warm(name):
+    """Import the function of a request in the parent, so later children inherit it.
+
+    Import failures are left for the child to report.
+    """
+    try:
+        multitasks.get(name)
+    except Exception:
+        pass
+
+def serve(socket_path, cores=1, idle_timeout=0, names=None):
+    """Accept task requests on a Unix socket, running up to `cores` forked children at once.
+    """
+    preload(names)
+    server = _listen(socket_path)
+    children = set()
+    last_request = time.time()
+    print("Worker %s listening on %s with %s cores" % (os.getpid(), socket_path, cores))
+    server.settimeout(1.0)
+    try:
+        while True:
+            _reap(children, block=len(children) >= max(cores, 1))
+            if len(children) >= max(cores, 1):
+                continue
+            try:
+                conn, _ = server.accept()
+            except socket.timeout:
+                if idle_timeout and not children and time.time() - last_request > idle_timeout:
+                    break
+                continue
+            last_request = time.time()
+            request = _read_request(conn)
+            if request is None:
+                conn.close()
+                continue
+            _warm(request["name"])
+            pid = os.fork()
+            if pid == 0:
+                server.close()
+                os._exit(_handle(conn, request))
+            conn.close()
+            children.add(pid)
+    finally:
+        server.close()
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        while children:
+            _reap(children, block=True)
+
+def _listen(socket_path):
+    """Bind the daemon socket, replacing a stale socket left by a stopped daemon.
+    """
+    if os.path.exists(socket_path):
+        conn = _connect(socket_path)
+        if conn is not None:
+            conn.close()
+            raise ValueError("Worker already running on %s" % socket_path)
+        os.remove(socket_path)
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    # Create the socket readable and writable only by this user
+    old_umask = os.umask(0o177)
+    try:
+        server.bind(socket_path)
+    finally:
+        os.umask(old_umask)
+    server.listen(128)
+    return server
+
+def _reap(children, block=False):
+    while children:
+        try:
+            pid, _ = os.waitpid(-1, 0 if block else os.WNOHANG)
+        except OSError as e:
+            if e.errno == errno.ECHILD:
+                children.clear()
+                return
+            raise
+        if pid == 0:
+            return
+        children.discard(pid)
+        block = False
+
+def _read_request(conn, timeout=30.0):
+    """Read the request line of a connection, replying with an error if it is invalid.
+    """
+    conn.settimeout(timeout)
+    try:
+        with conn.makefile("r") as in_handle:
+            request = json.loads(in_handle.readline())
+        if not isinstance(request, dict) or "name" not in request:
+            raise ValueError("Invalid worker request: %s" % request)
+        return request
+    except Exception:
+        try:
+            conn.sendall((json.dumps({"status": "error", "error": traceback.format_exc()}) + "\n")
+                         .encode("utf-8"))
+        except (IOError, OSError):
+            pass
+
+def _handle(conn, request):
+    """Run one request in a forked child, returning the child exit code.
+    """
+    conn.settimeout(None)
+    try:
+        runfn.run(request["name"], request["argfile"], request["outfile"], request.get("batch", False),
+                  request.get("trace"))
+        reply = {"status": "ok"}
+    except BaseException:
+        reply = {"status": "error", "error": traceback.format_exc()}
+    try:
+        conn.sendall((json.dumps(reply) + "\n").encode("utf-8"))
+        conn.close()
+    except (IOError, OSError):
+        pass
+    sys.stdout.flush()
+    sys.stderr.flush()
+    return 0 if reply["status"] == "ok" else 1
+
+def _connect(socket_path):
+    conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        conn.connect(socket_path)
+    except (IOError, OSError):
+        conn.close()
+        return None
+    return conn
+
+def run_on(socket_path, name, argfile, outfile, batch=False, trace_file=None):
+    """Run a task on the worker daemon at `socket_path`.
+
+    Returns False when no daemon is listening, so callers can run the task
+    themselves, and raises ValueError when the task fails in the worker.
+    """
+    conn = _connect(socket_path)
+    if conn is None:
+        return False
+    with conn:
+        request = {"name": name, "argfile": os.path.abspath(argfile),
+                   "outfile": os.path.abspath(outfile), "batch": batch,
+                   "trace": os.path.abspath(trace_file) if trace_file else None}
+        conn.sendall((json.dumps(request) + "\n").encode("utf-8"))
+        with conn.makefile("r") as in_handle:
+            reply = in_handle.readline()
+    if not reply:
+        raise ValueError("Worker on %s exited without running %s" % (socket_path, name))
+    reply = json.loads(reply)
+    if reply["status"] != "ok":
+        raise ValueError("Task %s failed in worker %s:\n%s" % (name, socket_path, reply["error"]))
+    return True
@@ -0,0 +1,208 @@
+"""Local cache of downloaded files, shared by installs, upgrades and templates.
+
+Downloads are stored once by the sha256 of their content and looked up by
+URL. Cached URLs are revalidated with the server using ETag and
+Last-Modified headers, so unchanged files are not transferred again, and
+the cached copy is used when the network is unavailable. Writes are atomic
+and the least recently used files are removed once the cache grows past its
+size limit.
+
+The cache lives in `$BCBIO_DOWNLOAD_CACHE`, defaulting to
+`~/.cache/bcbio/downloads`.
+"""
+from __future__ import print_function
+import os
+import json
+import errno
+import time
+import shutil
+import hashlib
+import tempfile
+import contextlib
+
+from bcbio import download, utils
+
+DEFAULT_MAX_SIZE = 20 * 1024 ** 3
+
+
+def default_cache_dir():
+    return os.environ.get("BCBIO_DOWNLOAD_CACHE",
+                          os.path.join(os.path.expanduser("~"), ".cache", "bcbio", "downloads"))
+
+
+class DownloadCache(object):
+    """Content addressed download cache.
+
+    `max_size` is the cache size limit in bytes. URLs fetched within the last
+    `max_age` seconds are used without revalidating with the server.
+    """
+    def __init__(self, base_dir=None, max_size=DEFAULT_MAX_SIZE, max_age=0):
+        self.base_dir = os.path.abspath(base_dir or default_cache_dir())
+        self.max_size = max_size
+        self.max_age = max_age
+        for subdir in ["objects", "urls", "tmp"]:
+            utils.safe_makedir(os.path.join(self.base_dir, subdir))
+
+    def _url_file(self, url):
+        return os.path.join(self.base_dir, "urls", "%s.json" % hashlib.sha1(url.encode("utf-8")).hexdigest())
+
+    def _object_file(self, digest):
+        return os.path.join(self.base_dir, "objects", digest[:2], digest)
+
+    def _read_record(self, url):
+        url_file = self._url_file(url)
+        try:
+            with open(url_file) as in_handle:
+                record = json.load(in_handle)
+        except (IOError, OSError, ValueError):
+            return None
+        if record.get("url") == url and os.path.exists(self._object_file(record["sha256"])):
+            return record
+
+    def _write_record(self, record):
+        self._atomic_write(self._url_file(record["url"]), json.dumps(record).encode("utf-8"))
+
+    def _atomic_write(self, out_file, data):
+        fd, tx_file = tempfile.mkstemp(dir=os.path.join(self.base_dir, "tmp"))
+        with os.fdopen(fd, "wb") as out_handle:
+            out_handle.write(data)
+        os.rename(tx_file, out_file)
+
+    def fetch(self, url, max_age=None):
+        """Return the path to a cached copy of `url`, downloading or revalidating as needed.
+
+        `max_age` overrides the cache's revalidation interval for this URL.
+        """
+        max_age = self.max_age if max_age is None else max_age
+        record = self._read_record(url)
+        if record and max_age and time.time() - record.get("checked", 0) < max_age:
+            return self._use(record)
+        headers = {}
+        if record:
+            if record.get("etag"):
+                headers["If-None-Match"] = record["etag"]
+            if record.get("last_modified"):
+                headers["If-Modified-Since"] = record["last_modified"]
+        try:
+            resp = download.open_url(url, headers)
+        except download.urllib_error.HTTPError as e:
+            if e.code == 304 and record:
+                record["checked"] = time.time()
+                return self._use(record)
+            raise
+        except download.urllib_error.URLError as e:
+            if record:
+                print("Using cached copy of %s, could not revalidate: %s" % (url, e))
+                return self._use(record)
+            raise
+        with contextlib.closing(resp):
+            record = self._store(url, resp)
+        self.evict(keep=record["sha256"])
+        return self._object_file(record["sha256"])
+
+    def _store(self, url, resp):
+        hasher = hashlib.sha256()
+        size = 0
+        fd, tx_file = tempfile.mkstemp(dir=os.path.join(self.base_dir, "tmp"))
+        try:
+            with os.fdopen(fd, "wb") as out_handle:
+                for chunk in iter(lambda: resp.read(download.CHUNK_SIZE), b""):
+                    out_handle.write(chunk)
+                    hasher.update(chunk)
+                    size += len(chunk)
+            digest = hasher.hexdigest()
+            obj_file = self._object_file(digest)
+            utils.safe_makedir(os.path.dirname(obj_file))
+            os.rename(tx_file, obj_file)
+        except BaseException:
+            if os.path.exists(tx_file):
+                os.remove(tx_file)
+            raise
+        headers = resp.info()
+        record = {"url": url, "sha256": digest, "size": size,
+                  "etag": headers.get("ETag"), "last_modified": headers.get("Last-Modified"),
+                  "checked": time.time(), "used": time.time()}
+        self._write_record(record)
+        return record
+
+    def _use(self, record):
+        record["used"] = time.time()
+        self._write_record(record)
+        return self._object_file(record["sha256"])
+
+    def fetch_to(self, url, out_file):
+        """Place a copy of `url` at `out_file`, hard linking from the cache when possible.
+        """
+        cached = self.fetch(url)
+        tx_file = "%s.tx%s" % (out_file, os.getpid())
+        try:
+            os.link(cached, tx_file)
+        except OSError:
+            shutil.copyfile(cached, tx_file)
+        os.rename(tx_file, out_file)
+        return out_file
+
+    def read(self, url, max_age=None):
+        with open(self.fetch(url, max_age), "rb") as in_handle:
+            return in_handle.read()
+
+    def evict(self, keep=None):
+        """Remove least recently used files until the cache is under its size limit.
+
+        `keep` is the content hash of a file to retain, such as the one just downloaded.
+        """
+        records = []
+        for fname in os.listdir(os.path.join(self.base_dir, "urls")):
+            try:
+                with open(os.path.join(self.base_dir, "urls", fname)) as in_handle:
+                    records.append((fname, json.load(in_handle)))
+            except (IOError, OSError, ValueError):
+                continue
+        objects = {}
+        for fname, record in records:
+            cur = objects.setdefault(record["sha256"], {"size": record.get("size", 0), "used": 0, "urls": []})
+            cur["used"] = max(cur["used"], record.get("used", 0))
+            cur["urls"].append(fname)
+        total = sum(x["size"] for x in objects.values())
+        for digest, info in sorted(objects.items(), key=lambda x: x[1]["used"]):
+            if total <= self.max_size:
+                break
+            if digest == keep:
+                continue
+            for fname in info["urls"]:
+                _remove(os.path.join(self.base_dir, "urls", fname))
+            _remove(self._object_file(digest))
+            total -= info["size"]
+
+
+def _remove(fname):
+    """Remove a cache file, which another process evicting at the same time may have removed first.
+    """
+    try:
+        os.remove(fname)
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
+
+
+_caches = {}
+
+def get_cache(base_dir=None):
+    """Shared cache instance for a directory, defaulting to the standard location.
+    """
+    base_dir = os.path.abspath(base_dir or default_cache_dir())
+    if base_dir not in _caches:
+        _caches[base_dir] = DownloadCache(base_dir)
+    return _caches[base_dir]
+
+
+def fetch(url, out_file=None):
+    """Retrieve `url` through the default cache, returning the cached path or `out_file`.
+    """
+    if out_file:
+        return get_cache().fetch_to(url, out_file)
+    return get_cache().fetch(url)
+
+
+def read(url, max_age=None):
+    return get_cache().read(url, max_age)
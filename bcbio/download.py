@@ -0,0 +1,416 @@
+"""Download files over HTTP, resuming partial downloads and verifying checksums.
+
+Checksums are given as `md5:<hex>` or `sha256:<hex>`, or as a bare hex
+digest where the length picks the algorithm. Tarballs can be extracted
+while streaming, without first writing the archive to disk.
+"""
+from __future__ import print_function
+import os
+import time
+import fcntl
+import shutil
+import hashlib
+import tarfile
+import threading
+import contextlib
+from concurrent import futures
+
+try:
+    import urllib.request as urllib_request
+    import urllib.error as urllib_error
+except ImportError:
+    import urllib2 as urllib_request
+    urllib_error = urllib_request
+
+from bcbio import utils
+
+CHUNK_SIZE = 1024 * 1024
+# Extracted file data held in memory waiting for writer threads. Only
+# members up to MAX_BUFFERED_MEMBER are buffered; larger ones are copied
+# straight from the stream to disk.
+MAX_PENDING_WRITES = 256 * 1024 * 1024
+MAX_BUFFERED_MEMBER = 4 * 1024 * 1024
+
+
+class ChecksumError(Exception):
+    pass
+
+
+def open_url(url, headers=None, timeout=60):
+    """Open a URL for reading, with optional extra request headers.
+    """
+    req = urllib_request.Request(url, headers=headers or {})
+    return urllib_request.urlopen(req, timeout=timeout)
+
+
+def url_exists(url, timeout=60):
+    """Check that the server has `url`, without downloading it.
+
+    Missing files are reported as not found or, on S3 without list
+    permission, forbidden. Other errors are raised.
+    """
+    req = urllib_request.Request(url)
+    req.get_method = lambda: "HEAD"
+    try:
+        urllib_request.urlopen(req, timeout=timeout).close()
+    except urllib_error.HTTPError as e:
+        if e.code in (403, 404, 410):
+            return False
+        raise
+    return True
+
+
+def get_checksum(url, extensions=(".md5", ".sha256")):
+    """Retrieve the checksum for a URL from a sidecar file next to it, if present.
+    """
+    for ext in extensions:
+        try:
+            with contextlib.closing(open_url(url + ext)) as in_handle:
+                digest = in_handle.read().decode().split()
+        except (urllib_error.HTTPError, urllib_error.URLError):
+            continue
+        if digest:
+            return "%s:%s" % (ext[1:], digest[0])
+
+
+def _new_hasher(checksum):
+    if not checksum:
+        return None, None
+    if ":" in checksum:
+        algorithm, digest = checksum.split(":", 1)
+    else:
+        digest = checksum
+        algorithm = "md5" if len(digest) == 32 else "sha256"
+    return hashlib.new(algorithm), digest.lower()
+
+
+def _check_hasher(hasher, digest, url):
+    if hasher is not None and hasher.hexdigest() != digest:
+        raise ChecksumError("Checksum mismatch for %s: expected %s, found %s"
+                            % (url, digest, hasher.hexdigest()))
+
+
+def download(url, out_file, checksum=None, retries=3):
+    """Download a URL to a file, resuming partial downloads with HTTP Range requests.
+
+    Data goes into `out_file.part`, kept between attempts and runs, and is
+    renamed into place once complete and verified. Servers that ignore Range
+    requests restart the download from the beginning. Client errors, like a
+    missing file, fail without retrying.
+    """
+    if utils.file_exists(out_file):
+        return out_file
+    utils.safe_makedir(os.path.dirname(os.path.abspath(out_file)))
+    part_file = out_file + ".part"
+    for attempt in range(retries + 1):
+        try:
+            _download_part(url, part_file, checksum)
+            break
+        except ChecksumError:
+            os.remove(part_file)
+            if attempt >= retries:
+                raise
+        except (urllib_error.URLError, IOError, OSError) as e:
+            if attempt >= retries or _is_client_error(e):
+                raise
+            print("Retrying download of %s after error: %s" % (url, e))
+            time.sleep(2 ** attempt)
+    os.rename(part_file, out_file)
+    return out_file
+
+
+def _is_client_error(e):
+    """HTTP 4xx errors, like missing files, that retrying will not fix.
+    """
+    return isinstance(e, urllib_error.HTTPError) and 400 <= e.code < 500
+
+
+def _download_part(url, part_file, checksum):
+    hasher, digest = _new_hasher(checksum)
+    offset = os.path.getsize(part_file) if os.path.exists(part_file) else 0
+    headers = {"Range": "bytes=%s-" % offset} if offset else {}
+    try:
+        resp = open_url(url, headers)
+    except urllib_error.HTTPError as e:
+        # Requested range past the end: the partial file is already complete
+        if e.code == 416 and offset:
+            resp = None
+        else:
+            raise
+    if resp is not None and offset and resp.getcode() != 206:
+        offset = 0
+    mode = "ab" if offset else "wb"
+    if hasher is not None and offset:
+        with open(part_file, "rb") as in_handle:
+            for chunk in iter(lambda: in_handle.read(CHUNK_SIZE), b""):
+                hasher.update(chunk)
+    if resp is not None:
+        with contextlib.closing(resp):
+            with open(part_file, mode) as out_handle:
+                for chunk in iter(lambda: resp.read(CHUNK_SIZE), b""):
+                    out_handle.write(chunk)
+                    if hasher is not None:
+                        hasher.update(chunk)
+    _check_hasher(hasher, digest, url)
+
+
+class _HashingReader(object):
+    """File-like wrapper that hashes data as it is read.
+    """
+    def __init__(self, handle, hasher):
+        self.handle = handle
+        self.hasher = hasher
+
+    def read(self, size=-1):
+        data = self.handle.read(size)
+        if self.hasher is not None:
+            self.hasher.update(data)
+        return data
+
+    def drain(self):
+        for _ in iter(lambda: self.read(CHUNK_SIZE), b""):
+            pass
+
+
+def _safe_members(members, out_dir):
+    """Stream tar members, rejecting paths and links that would escape the output directory.
+
+    Checks names as they will be written, so run after `_select_members`
+    renames them.
+    """
+    base = os.path.realpath(out_dir)
+
+    def inside(path):
+        target = os.path.realpath(path)
+        return target == base or target.startswith(base + os.sep)
+    for member in members:
+        out_file = os.path.join(base, member.name)
+        if not inside(out_file):
+            raise ValueError("Unsafe path in tarball: %s" % member.name)
+        if member.issym() and (os.path.isabs(member.linkname) or
+                               not inside(os.path.join(os.path.dirname(out_file), member.linkname))):
+            raise ValueError("Unsafe symlink in tarball: %s -> %s" % (member.name, member.linkname))
+        if member.islnk() and (os.path.isabs(member.linkname) or not inside(os.path.join(base, member.linkname))):
+            raise ValueError("Unsafe hard link in tarball: %s -> %s" % (member.name, member.linkname))
+        yield member
+
+
+def _strip(name, strip_components):
+    return "/".join([x for x in name.split("/") if x not in ["", "."]][strip_components:])
+
+
+def _select_members(members, subpaths=None, strip_components=0):
+    """Rename members to drop leading directories, keeping only those under `subpaths`.
+
+    Hard link targets, which name other members, are renamed to match.
+    """
+    for member in members:
+        name = _strip(member.name, strip_components)
+        if not name:
+            continue
+        if subpaths and not any(name == p or name.startswith(p.rstrip("/") + "/") for p in subpaths):
+            continue
+        member.name = name
+        if member.islnk():
+            member.linkname = _strip(member.linkname, strip_components)
+        yield member
+
+
+def _finish_file(out_file, mode, mtime):
+    os.chmod(out_file, mode)
+    os.utime(out_file, (mtime, mtime))
+
+
+def _write_file(out_file, data, mode, mtime):
+    with open(out_file, "wb") as out_handle:
+        out_handle.write(data)
+    _finish_file(out_file, mode, mtime)
+
+
+def _extract_members(tar, out_dir, subpaths=None, strip_components=0, threads=4):
+    """Extract a streamed tarball, handing small file writes to a thread pool.
+
+    Reading is sequential, as the stream requires. Small files, the bulk of
+    source trees, are written in parallel with a bounded amount of data
+    waiting in memory, while large files like genome sequences and indices
+    are copied from the stream to disk in blocks. Members outside `subpaths`
+    are read past without being written.
+    """
+    members = _safe_members(_select_members(tar, subpaths, strip_components), out_dir)
+    budget = threading.BoundedSemaphore(MAX_PENDING_WRITES // CHUNK_SIZE)
+    with futures.ThreadPoolExecutor(max_workers=max(int(threads), 1)) as executor:
+        writes = []
+
+        def write(out_file, data, mode, mtime, units):
+            try:
+                _write_file(out_file, data, mode, mtime)
+            finally:
+                for _ in range(units):
+                    budget.release()
+        for member in members:
+            out_file = os.path.join(out_dir, member.name)
+            if member.isdir():
+                utils.safe_makedir(out_file)
+            elif member.isfile():
+                utils.safe_makedir(os.path.dirname(out_file))
+                mode = member.mode & 0o7777 or 0o644
+                if member.size > MAX_BUFFERED_MEMBER:
+                    with open(out_file, "wb") as out_handle:
+                        shutil.copyfileobj(tar.extractfile(member), out_handle, CHUNK_SIZE)
+                    _finish_file(out_file, mode, member.mtime)
+                    continue
+                units = max(-(-member.size // CHUNK_SIZE), 1)
+                for _ in range(units):
+                    budget.acquire()
+                data = tar.extractfile(member).read()
+                writes.append(executor.submit(write, out_file, data, mode, member.mtime, units))
+            elif member.issym() or member.islnk():
+                utils.safe_makedir(os.path.dirname(out_file))
+                if member.issym():
+                    os.symlink(member.linkname, out_file)
+                else:
+                    # Hard links refer to earlier members, which must be written first
+                    for w in writes:
+                        w.result()
+                    os.link(os.path.join(out_dir, member.linkname), out_file)
+        for w in writes:
+            w.result()
+
+
+def extract_stream(url, out_dir, checksum=None, retries=3, subpaths=None, strip_components=0, threads=4):
+    """Download and extract a tarball into `out_dir` in a single streaming pass.
+
+    Extraction goes to a temporary directory next to `out_dir` and the
+    extracted top level entries are moved into place only after the
+    download completes and the checksum matches. Streams cannot be resumed,
+    so failed attempts start over. `subpaths` limits extraction to those
+    paths in the archive, after removing `strip_components` leading
+    directories from member names.
+    """
+    utils.safe_makedir(out_dir)
+    tx_dir = os.path.join(out_dir, ".tx-%s" % os.path.basename(url))
+    _stream_to_dir(url, tx_dir, checksum, retries, subpaths, strip_components, threads)
+    _move_into_place(tx_dir, out_dir)
+    return out_dir
+
+
+def fetch_directory(url, out_dir, checksum=None, retries=3, subpaths=None, strip_components=1, threads=4):
+    """Stream a tarball into a new directory `out_dir`, renamed into place once complete.
+
+    By default the single top level directory of the archive, such as
+    `name-master` in GitHub archives, becomes `out_dir`. Existing
+    directories are left as they are.
+    """
+    out_dir = os.path.abspath(out_dir)
+    if os.path.exists(out_dir):
+        return out_dir
+    tx_dir = "%s.tx%s" % (out_dir, os.getpid())
+    _stream_to_dir(url, tx_dir, checksum, retries, subpaths, strip_components, threads)
+    os.rename(tx_dir, out_dir)
+    return out_dir
+
+
+def extract_directory(tar_file, out_dir, subpaths=None, strip_components=1, threads=4):
+    """Extract a local tarball into a new directory `out_dir`, renamed into place once complete.
+
+    Takes the same options as `fetch_directory`, for archives already on
+    disk such as those in the download cache.
+    """
+    out_dir = os.path.abspath(out_dir)
+    if os.path.exists(out_dir):
+        return out_dir
+    tx_dir = "%s.tx%s" % (out_dir, os.getpid())
+    if os.path.exists(tx_dir):
+        shutil.rmtree(tx_dir)
+    utils.safe_makedir(tx_dir)
+    try:
+        with tarfile.open(tar_file, mode="r|*") as tar:
+            _extract_members(tar, tx_dir, subpaths, strip_components, threads)
+    except BaseException:
+        shutil.rmtree(tx_dir, ignore_errors=True)
+        raise
+    os.rename(tx_dir, out_dir)
+    return out_dir
+
+
+def _stream_to_dir(url, tx_dir, checksum, retries, subpaths, strip_components, threads):
+    for attempt in range(retries + 1):
+        if os.path.exists(tx_dir):
+            shutil.rmtree(tx_dir)
+        utils.safe_makedir(tx_dir)
+        hasher, digest = _new_hasher(checksum)
+        try:
+            with contextlib.closing(open_url(url)) as resp:
+                reader = _HashingReader(resp, hasher)
+                with tarfile.open(fileobj=reader, mode="r|*") as tar:
+                    _extract_members(tar, tx_dir, subpaths, strip_components, threads)
+                reader.drain()
+            _check_hasher(hasher, digest, url)
+            return tx_dir
+        except (urllib_error.URLError, IOError, OSError, tarfile.TarError, ChecksumError) as e:
+            if attempt >= retries or _is_client_error(e):
+                shutil.rmtree(tx_dir)
+                raise
+            print("Retrying download of %s after error: %s" % (url, e))
+            time.sleep(2 ** attempt)
+        except BaseException:
+            shutil.rmtree(tx_dir, ignore_errors=True)
+            raise
+
+
+def extract_tarball(tar_file, out_dir):
+    """Extract a downloaded tarball into `out_dir`, via a temporary directory.
+    """
+    tx_dir = os.path.join(out_dir, ".tx-%s" % os.path.basename(tar_file))
+    if os.path.exists(tx_dir):
+        shutil.rmtree(tx_dir)
+    utils.safe_makedir(tx_dir)
+    with tarfile.open(tar_file) as tar:
+        for member in _safe_members(tar.getmembers(), tx_dir):
+            tar.extract(member, tx_dir)
+    _move_into_place(tx_dir, out_dir)
+    return out_dir
+
+
+def _is_real_dir(path):
+    return os.path.isdir(path) and not os.path.islink(path)
+
+
+@contextlib.contextmanager
+def _install_lock(out_dir):
+    """Hold an exclusive lock on a directory, shared with other threads and processes installing there.
+    """
+    with open(os.path.join(out_dir, ".install.lock"), "a") as lock_handle:
+        fcntl.flock(lock_handle, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_handle, fcntl.LOCK_UN)
+
+
+def _move_into_place(tx_dir, out_dir):
+    """Move extracted files into `out_dir`, merging into directories already installed there.
+
+    Extracted files replace installed files of the same name and other
+    installed files are kept, so archives sharing a top level directory,
+    like `seq` or `variation`, add to it rather than replacing it. Installs
+    into the same directory merge one at a time.
+    """
+    with _install_lock(out_dir):
+        _merge_dir(tx_dir, out_dir)
+
+
+def _merge_dir(tx_dir, out_dir):
+    for name in os.listdir(tx_dir):
+        cur = os.path.join(tx_dir, name)
+        final = os.path.join(out_dir, name)
+        if _is_real_dir(final):
+            if not _is_real_dir(cur):
+                raise ValueError("Tarball file %s would replace installed directory %s" % (name, final))
+            _merge_dir(cur, final)
+            continue
+        if _is_real_dir(cur) and os.path.lexists(final):
+            os.remove(final)
+        # Renaming over an installed file replaces it atomically
+        os.rename(cur, final)
+    os.rmdir(tx_dir)
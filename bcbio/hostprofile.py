@@ -0,0 +1,267 @@
+"""Profile the resources of this machine and size bcbio_system.yaml to fit them.
+
+Measures the CPUs this process may use, cgroup (v1 and v2) CPU and memory
+limits, NUMA layout and scratch disk throughput. Program resources in
+`bcbio_system.yaml` are then limited to the usable cores and memory, so
+jobs in containers or batch slots with cgroup limits do not oversubscribe
+them. The profile is saved per host, providing the default core count
+when `--numcores` is not given.
+
+Profiles are stored in `$BCBIO_HOST_PROFILE_DIR`, defaulting to
+`~/.cache/bcbio/hosts`.
+"""
+from __future__ import print_function
+import os
+import glob
+import time
+import socket
+import tempfile
+
+from bcbio import utils
+
+# Fraction of usable memory given to programs, leaving room for the system
+MEMORY_FRACTION = 0.9
+DISK_TEST_SIZE = 256 * 1024 * 1024
+
+def add_subparser(subparser):
+    parser = subparser.add_parser("profile", help=("Measure cores, memory limits, NUMA layout and disk "
+                                                    "throughput of this machine and tune bcbio_system.yaml "
+                                                    "resources to fit."))
+    parser.add_argument("system_config", nargs="?",
+                        help="bcbio_system.yaml to tune. Defaults to the installed configuration.")
+    parser.add_argument("--scratch", default=None,
+                        help="Scratch directory to measure disk throughput in. Defaults to the temporary directory.")
+    parser.add_argument("--no-disk", action="store_true", default=False,
+                        help="Skip the disk throughput measurement.")
+    parser.add_argument("-o", "--outfile",
+                        help="Write the tuned configuration here instead of updating system_config in place.")
+
+def process(args):
+    system_config = args.system_config or _installed_system_config()
+    host = profile(None if args.no_disk else (args.scratch or tempfile.gettempdir()))
+    save_profile(host)
+    _print_profile(host)
+    if system_config:
+        config = tune_config(utils.load_yaml(system_config), host)
+        out_file = write_config(config, args.outfile or system_config)
+        print("Tuned resources written to %s" % out_file)
+
+def _installed_system_config():
+    from bcbio import install
+    config_file = os.path.join(install._get_data_dir(), "galaxy", "bcbio_system.yaml")
+    return config_file if os.path.exists(config_file) else None
+
+def _read(fname):
+    try:
+        with open(fname) as in_handle:
+            return in_handle.read().strip()
+    except (IOError, OSError):
+        return None
+
+def cpu_count():
+    """CPUs this process is allowed to run on.
+    """
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+def physical_memory():
+    """Physical memory of the machine in Gb.
+    """
+    from bcbio.distributed import resources
+    return resources.get_total_memory()
+
+def _cgroup_paths():
+    """Map of cgroup controller to this process's cgroup path, "" for the v2 unified hierarchy.
+    """
+    paths = {}
+    for line in (_read("/proc/self/cgroup") or "").splitlines():
+        parts = line.split(":", 2)
+        if len(parts) == 3:
+            for controller in parts[1].split(","):
+                paths[controller] = parts[2]
+    return paths
+
+def _cgroup_file(controller_dir, cgroup_path, fname):
+    """Find a cgroup control file, checking our own cgroup then the namespace root.
+    """
+    for cur in [os.path.join(controller_dir, cgroup_path.lstrip("/"), fname),
+                os.path.join(controller_dir, fname)]:
+        if os.path.exists(cur):
+            return cur
+
+def cgroup_limits(root="/sys/fs/cgroup"):
+    """CPU (fractional cores) and memory (Gb) limits from cgroups, None when unlimited.
+    """
+    paths = _cgroup_paths()
+    out = {"version": None, "cpus": None, "memory": None}
+    if os.path.exists(os.path.join(root, "cgroup.controllers")):
+        out["version"] = 2
+        cpu_max = _read(_cgroup_file(root, paths.get("", "/"), "cpu.max") or "")
+        if cpu_max and not cpu_max.startswith("max"):
+            quota, period = cpu_max.split()[:2]
+            out["cpus"] = float(quota) / float(period)
+        mem_max = _read(_cgroup_file(root, paths.get("", "/"), "memory.max") or "")
+        if mem_max and mem_max != "max":
+            out["memory"] = int(mem_max) / float(1024 ** 3)
+    elif os.path.isdir(os.path.join(root, "memory")) or os.path.isdir(os.path.join(root, "cpu")):
+        out["version"] = 1
+        cpu_dir = os.path.join(root, "cpu")
+        quota = _read(_cgroup_file(cpu_dir, paths.get("cpu", "/"), "cpu.cfs_quota_us") or "")
+        period = _read(_cgroup_file(cpu_dir, paths.get("cpu", "/"), "cpu.cfs_period_us") or "")
+        if quota and period and int(quota) > 0:
+            out["cpus"] = float(quota) / float(period)
+        limit = _read(_cgroup_file(os.path.join(root, "memory"), paths.get("memory", "/"),
+                                   "memory.limit_in_bytes") or "")
+        # Unlimited v1 memory is reported as a value near the maximum 64-bit integer
+        if limit and int(limit) < 2 ** 60:
+            out["memory"] = int(limit) / float(1024 ** 3)
+    return out
+
+def _parse_cpulist(cpulist):
+    count = 0
+    for part in (cpulist or "").split(","):
+        if "-" in part:
+            start, end = part.split("-")
+            count += int(end) - int(start) + 1
+        elif part.strip():
+            count += 1
+    return count
+
+def numa_nodes(root="/sys/devices/system/node"):
+    """CPUs and memory (Gb) of each NUMA node.
+    """
+    out = []
+    for node_dir in sorted(glob.glob(os.path.join(root, "node[0-9]*"))):
+        memory = None
+        for line in (_read(os.path.join(node_dir, "meminfo")) or "").splitlines():
+            if "MemTotal:" in line:
+                memory = int(line.split()[-2]) / float(1024 ** 2)
+        out.append({"cpus": _parse_cpulist(_read(os.path.join(node_dir, "cpulist"))), "memory": memory})
+    return out
+
+def disk_throughput(scratch_dir, size=DISK_TEST_SIZE):
+    """Sequential write and read throughput, in Mb/s, of a scratch directory.
+
+    Writes are synced to disk and the file dropped from the page cache
+    before reading, where the platform allows it.
+    """
+    utils.safe_makedir(scratch_dir)
+    fd, test_file = tempfile.mkstemp(dir=scratch_dir, prefix=".bcbio-disktest")
+    chunk = os.urandom(4 * 1024 * 1024)
+    try:
+        start = time.time()
+        with os.fdopen(fd, "wb") as out_handle:
+            for _ in range(max(size // len(chunk), 1)):
+                out_handle.write(chunk)
+            out_handle.flush()
+            os.fsync(out_handle.fileno())
+        write_time = time.time() - start
+        with open(test_file, "rb") as in_handle:
+            if hasattr(os, "posix_fadvise"):
+                os.posix_fadvise(in_handle.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+            start = time.time()
+            for _ in iter(lambda: in_handle.read(len(chunk)), b""):
+                pass
+            read_time = time.time() - start
+    finally:
+        os.remove(test_file)
+    size_mb = max(size // len(chunk), 1) * len(chunk) / float(1024 ** 2)
+    return {"dir": os.path.abspath(scratch_dir),
+            "write_mbps": round(size_mb / max(write_time, 1e-6), 1),
+            "read_mbps": round(size_mb / max(read_time, 1e-6), 1)}
+
+def profile(scratch_dir=None):
+    """Measure usable cores and memory, taking the lowest of the machine and cgroup limits.
+    """
+    cgroup = cgroup_limits()
+    numa = numa_nodes()
+    cores = cpu_count()
+    if cgroup["cpus"]:
+        cores = min(cores, max(int(cgroup["cpus"]), 1))
+    memory = physical_memory()
+    if cgroup["memory"]:
+        memory = min(memory, cgroup["memory"]) if memory else cgroup["memory"]
+    out = {"hostname": socket.gethostname(), "cores": cores,
+           "memory": round(memory, 2) if memory else None,
+           "cgroup": cgroup, "numa": numa}
+    if scratch_dir:
+        out["disk"] = disk_throughput(scratch_dir)
+    return out
+
+def tune_config(config, host):
+    """Limit per-program cores, per core memory and JVM heap in a system config to a host profile.
+
+    Multicore programs are kept within the largest NUMA node, and memory
+    per core is reduced where a program at full core count would not fit
+    in usable memory.
+    """
+    from bcbio.distributed import resources
+    config = dict(config or {})
+    progs = config.setdefault("resources", {})
+    cores = host["cores"]
+    numa_cpus = [n["cpus"] for n in host.get("numa", []) if n.get("cpus")]
+    if len(numa_cpus) > 1:
+        cores = min(cores, max(numa_cpus))
+    memory = (host.get("memory") or 0) * MEMORY_FRACTION
+    progs.setdefault("default", {})
+    for name, prog in progs.items():
+        if name in ["log", "tmp"] or not isinstance(prog, dict):
+            continue
+        cur_cores = min(int(prog.get("cores") or resources.program_resources(config, name).get("cores")
+                            or cores), cores)
+        if "cores" in prog or name == "default":
+            prog["cores"] = cur_cores
+        if memory:
+            spec = resources.parse_memory(prog.get("memory"))
+            if spec is not None or name == "default":
+                per_core = memory / cur_cores
+                if spec is None or spec > per_core:
+                    prog["memory"] = "%sM" % int(per_core * 1024)
+            heaps = [resources.parse_memory(str(x)[4:]) for x in prog.get("jvm_opts") or []
+                     if str(x).startswith("-Xmx")]
+            if heaps and max(heaps) > memory:
+                prog["jvm_opts"] = resources.scale_jvm_opts(prog["jvm_opts"], memory)
+    return config
+
+def write_config(config, out_file):
+    import yaml
+    tx_file = "%s.tx%s" % (out_file, os.getpid())
+    with open(tx_file, "w") as out_handle:
+        yaml.safe_dump(config, out_handle, default_flow_style=False, allow_unicode=False)
+    os.rename(tx_file, out_file)
+    return out_file
+
+def _profile_dir():
+    return os.environ.get("BCBIO_HOST_PROFILE_DIR",
+                          os.path.join(os.path.expanduser("~"), ".cache", "bcbio", "hosts"))
+
+def _profile_file(hostname=None):
+    return os.path.join(_profile_dir(), "%s.yaml" % (hostname or socket.gethostname()))
+
+def save_profile(host):
+    return write_config(host, os.path.join(utils.safe_makedir(_profile_dir()), "%s.yaml" % host["hostname"]))
+
+def load_profile(hostname=None):
+    """Saved profile for a host, defaulting to this one, or None if not yet profiled.
+    """
+    profile_file = _profile_file(hostname)
+    if os.path.exists(profile_file):
+        return utils.load_yaml(profile_file)
+
+def default_cores():
+    """Cores to use when not given on the command line: the profiled cores of this host, or 1.
+    """
+    host = load_profile()
+    return int(host["cores"]) if host and host.get("cores") else 1
+
+def _print_profile(host):
+    print("Host %s: %s usable cores, %s Gb usable memory" % (host["hostname"], host["cores"], host["memory"]))
+    if host["cgroup"]["version"]:
+        print("cgroup v%s limits: cpus %s, memory %s Gb" % (host["cgroup"]["version"], host["cgroup"]["cpus"],
+                                                         host["cgroup"]["memory"]))
+    if host["numa"]:
+        print("NUMA nodes: %s" % ", ".join("%s cpus" % n["cpus"] for n in host["numa"]))
+    if host.get("disk"):
+        print("Scratch %s: write %s Mb/s, read %s Mb/s" % (host["disk"]["dir"], host["disk"]["write_mbps"],
+                                                          host["disk"]["read_mbps"]))
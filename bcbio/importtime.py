@@ -0,0 +1,53 @@
+"""Report module import time for each bcbio_nextgen.py subcommand.
+
+Runs `python -X importtime` in a fresh interpreter that loads the
+command line entry point and the module for one subcommand, then totals
+the self times of every imported module. Run with:
+
+    python -m bcbio.importtime [subcommand ...]
+"""
+from __future__ import print_function
+import os
+import sys
+import subprocess
+
+COMMANDS = ["main", "upgrade", "runfn", "template"]
+
+def _script_dir():
+    return os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def import_time(name, python=None):
+    """Total import time in seconds and module count for loading a subcommand.
+    """
+    code = "import bcbio_nextgen"
+    if name != "main":
+        code += "; bcbio_nextgen.load_subcommand(%r)" % name
+    proc = subprocess.Popen([python or sys.executable, "-X", "importtime", "-c", code],
+                            cwd=_script_dir(), stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                            universal_newlines=True)
+    _, stderr = proc.communicate()
+    if proc.returncode != 0:
+        raise ValueError("Could not load subcommand %s:\n%s" % (name, stderr))
+    total = 0
+    count = 0
+    for line in stderr.splitlines():
+        if line.startswith("import time:"):
+            parts = line.split(":", 1)[1].split("|")
+            try:
+                total += int(parts[0])
+            except ValueError:
+                continue
+            count += 1
+    return total / 1e6, count
+
+def main(names=None):
+    for name in names or COMMANDS:
+        try:
+            total, count = import_time(name)
+        except ValueError as e:
+            print(e)
+            continue
+        print("%-10s %6.3fs %5d modules" % (name, total, count))
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -1,7 +1,8 @@
 from __future__ import print_function
 import os,sys
-import utils
+from bcbio import utils
 import yaml
+import inspect
 import contextlib
 import subprocess
 
@@ -10,6 +11,7 @@ REMOTES = {
     "gitrepo": "https://github.com/bcbio/bcbio-nextgen.git",
     "cloudbiolinux": "https://github.com/chapmanb/cloudbiolinux/archive/master.tar.gz",
     "genome_resources": "https://raw.github.com/bcbio/bcbio-nextgen/master/config/genomes/%s-resources.yaml",
+    "genome_data": "https://s3.amazonaws.com/biodata/genomes/{genome}-{target}.tar.gz",
     "snpeff_dl_url": ("http://downloads.sourceforge.net/project/snpeff/databases/v{snpeff_ver}/"
                       "snpEff_v{snpeff_ver}_{genome}.zip")}
 SUPPORTED_GENOMES = ["GRCh37", "hg19", "hg38", "hg38-noalt", "mm10", "mm9",
@@ -17,6 +19,9 @@ SUPPORTED_GENOMES = ["GRCh37", "hg19", "hg38", "hg38-noalt", "mm10", "mm9",
                      "pseudomonas_aeruginosa_ucbpp_pa14", "sacCer3", "TAIR10",
                      "WBcel235", "xenTro3", "GRCz10", "GRCz11", "Sscrofa11.1", "BDGP6"]
 TARBALL_DIRECTORIES = ["bwa", "rtg", "hisat2"]
+# Parts of the cloudbiolinux archive used for upgrades: the python package,
+# conda package lists and data configuration
+CLOUDBIOLINUX_SUBPATHS = ["cloudbio", "contrib/flavor/ngs_pipeline_minimal", "config"]
 SUPPORTED_INDEXES = TARBALL_DIRECTORIES + ["bbmap", "bowtie", "bowtie2", "minimap2", "novoalign", "twobit",
                                            "snap", "star", "seq"]
 
@@ -42,6 +47,12 @@ def add_subparser(subparser):
                         choices=["variation", "rnaseq", "smallrna", "gemini", "cadd", "vep", "dbnsfp", "dbscsnv", "battenberg", "kraken", "ericscript", "gnomad"])
     parser.add_argument("--isolate", help="Created an isolated installation without PATH updates",
                         dest="isolate", action="store_true", default=False)
+    parser.add_argument("--cores", default=1, type=int,
+                        help="Number of cores to use when extracting data files.")
+    parser.add_argument("--connections", default=4, type=int,
+                        help="Number of data downloads to run at once.")
+    parser.add_argument("--conda-jobs", default=4, type=int,
+                        help="Number of named conda environments to install at once, after the base environment.")
 def upgrade_bcbio(args):
     print("Upgrading bcbio")
     args = add_install_defaults(args)
@@ -58,6 +69,16 @@ def upgrade_bcbio(args):
                 _symlink_bcbio(args, "python", "bcbiovm", "bcbiovm")
             upgrade_thirdparty_tools(args, REMOTES)
             print("Third party tools upgrade complete.")
+    if args.install_data:
+        upgrade_bcbio_data(args, REMOTES)
+
+def upgrade_bcbio_data(args, remotes):
+    """Install genomes, aligner indexes and data targets into the data directory.
+    """
+    from bcbio import install_data
+    print("Upgrading bcbio-nextgen data files")
+    install_data.upgrade_data(args, _get_data_dir(), remotes, TARBALL_DIRECTORIES)
+    print("Data upgrade complete.")
 
 def upgrade_thirdparty_tools(args, remotes):
     cbl = get_cloudbiolinux(remotes)
@@ -65,7 +86,11 @@ def upgrade_thirdparty_tools(args, remotes):
                             "ngs_pipeline_minimal", "packages-conda.yaml")
     sys.path.insert(0,cbl['dir'])
     cbl_conda = __import__("cloudbio.package.conda", fromlist=['conda'])
-    cbl_conda.install_in(_get_conda_bin(),args.tooldir, package_yaml)
+    kwargs = {}
+    # Older cloudbiolinux releases install environments one at a time
+    if "max_workers" in inspect.signature(cbl_conda.install_in).parameters:
+        kwargs["max_workers"] = getattr(args, "conda_jobs", 4)
+    cbl_conda.install_in(_get_conda_bin(),args.tooldir, package_yaml, **kwargs)
     manifest_dir = os.path.join(_get_data_dir(), 'manifest')
     print("Creating manifest of installed packages in %s" % manifest_dir)
     cbl_manifest = __import__("cloudbio.manifest", fromlist=["manifest"])
@@ -84,9 +109,10 @@ def _get_conda_bin():
 def get_cloudbiolinux(remotes):
     base_dir = os.path.join(os.getcwd(),"cloudbiolinux")
     if not os.path.exists(base_dir):
-        subprocess.check_call("wget --progress=dot:mega --no-check-certificate -O- %s | tar xz && "
-                              "(mv cloudbiolinux-master cloudbiolinux || mv master cloudbiolinux)"
-                              % remotes["cloudbiolinux"], shell=True)
+        from bcbio import dlcache, download
+        # The cached tarball is revalidated, not downloaded again, on later upgrades
+        download.extract_directory(dlcache.fetch(remotes["cloudbiolinux"]), base_dir,
+                                   subpaths=CLOUDBIOLINUX_SUBPATHS)
     return {"biodata": os.path.join(base_dir, "config", "biodata.yaml"),
             "dir": base_dir}
 
@@ -119,8 +145,7 @@ def add_install_defaults(args):
     if install_config is None or not utils.file_exists(install_config):
         default_args = {}
     else:
-        with open(install_config) as in_handle:
-            default_args = yaml.safe_load(in_handle)
+        default_args = utils.load_yaml(install_config) or {}
 
     if args.upgrade in ['development'] and (args.tooldir or "tooldir" in default_args):
         args.tooldir = True
@@ -190,10 +215,13 @@ def _get_install_config():
     # config_dir = utils.safe_makedir(os.path.join(data_dir, "config"))
     return os.path.join(config_dir, "install-params.yaml")
 
+_DATA_DIR = {}
+
 def _get_data_dir():
-    print(sys.executable)
-    base_dir = os.path.realpath(os.path.dirname(os.path.dirname(os.path.realpath(sys.executable))))
-    return os.path.dirname(base_dir)
+    if sys.executable not in _DATA_DIR:
+        base_dir = os.path.realpath(os.path.dirname(os.path.dirname(os.path.realpath(sys.executable))))
+        _DATA_DIR[sys.executable] = os.path.dirname(base_dir)
+    return _DATA_DIR[sys.executable]
 
 @contextlib.contextmanager
 def bcbio_tmpdir():
@@ -0,0 +1,136 @@
+"""Install genome sequences, aligner indexes and data targets in parallel.
+
+Builds a task graph of genome x (sequence, index, data target) downloads of
+prepared tarballs. The genome sequence is installed first and the indexes
+and data targets for that genome follow, with a bounded number of
+downloads running at once across all genomes. Finished installs leave a
+marker so later upgrades skip them.
+"""
+from __future__ import print_function
+import os
+import json
+from concurrent import futures
+
+from bcbio import download, utils
+
+GENOME_ORGANISMS = {"GRCh37": "Hsapiens", "hg19": "Hsapiens", "hg38": "Hsapiens", "hg38-noalt": "Hsapiens",
+                    "mm10": "Mmusculus", "mm9": "Mmusculus", "rn6": "Rnorvegicus", "rn5": "Rnorvegicus",
+                    "canFam3": "Cfamiliaris", "dm3": "Dmelanogaster", "BDGP6": "Dmelanogaster",
+                    "galGal4": "Ggallus", "phix": "phiX174",
+                    "pseudomonas_aeruginosa_ucbpp_pa14": "Paeruginosa_UCBPP-PA14",
+                    "sacCer3": "Scerevisiae", "TAIR10": "Athaliana", "WBcel235": "Celegans",
+                    "xenTro3": "Xtropicalis", "GRCz10": "Drerio", "GRCz11": "Drerio",
+                    "Sscrofa11.1": "Sscrofa"}
+
+
+def upgrade_data(args, data_dir, remotes, tarball_dirs):
+    """Install data for the genomes, aligners and data targets in `args`.
+
+    `remotes["genome_data"]` is the URL template for prepared tarballs, with
+    `{genome}` and `{target}` placeholders. Targets in `tarball_dirs` are
+    extracted while streaming, writing files with `args.cores` threads.
+    Others are downloaded with resume support and then extracted.
+    """
+    genome_dir = os.path.join(data_dir, "genomes")
+    data_targets = available_targets(args.genomes, args.datatarget, remotes["genome_data"], args.connections)
+    tasks = build_tasks(args.genomes, ["seq"] + args.aligners, data_targets)
+    return run_tasks(tasks, genome_dir, remotes["genome_data"], tarball_dirs, args.connections, args.cores)
+
+
+def available_targets(genomes, targets, url_template, connections=4):
+    """Data targets with a prepared tarball for each genome, as a dictionary of genome to targets.
+
+    Not every genome has every data target, such as smallrna for yeast, so
+    missing ones are reported and skipped instead of failing the install.
+    """
+    keys = [(genome, target) for genome in genomes for target in targets]
+    with futures.ThreadPoolExecutor(max_workers=max(int(connections or 1), 1)) as executor:
+        found = list(executor.map(lambda k: download.url_exists(url_template.format(genome=k[0], target=k[1])),
+                                  keys))
+    out = dict((genome, []) for genome in genomes)
+    for (genome, target), exists in zip(keys, found):
+        if exists:
+            out[genome].append(target)
+        else:
+            print("Skipping %s %s: no prepared data available" % (genome, target))
+    return out
+
+
+def build_tasks(genomes, targets, genome_targets=None):
+    """Task graph of (genome, target) keys mapped to the keys they depend on.
+
+    `targets` are installed for every genome and `genome_targets` adds
+    targets for specific genomes. Every target of a genome depends on its
+    `seq` task.
+    """
+    tasks = {}
+    for genome in genomes:
+        tasks[(genome, "seq")] = []
+        for target in list(targets) + list((genome_targets or {}).get(genome, [])):
+            if target != "seq":
+                tasks[(genome, target)] = [(genome, "seq")]
+    return tasks
+
+
+def run_tasks(tasks, genome_dir, url_template, tarball_dirs, connections=4, cores=1):
+    """Run install tasks with at most `connections` concurrent downloads.
+
+    Tasks start once all their dependencies finish. A failure stops new
+    tasks from starting and is raised after running downloads finish.
+    """
+    done = set()
+    failed = []
+    started = set()
+    with futures.ThreadPoolExecutor(max_workers=max(int(connections or 1), 1)) as executor:
+        running = {}
+
+        def start_ready():
+            for key, deps in sorted(tasks.items()):
+                if key not in started and all(d in done for d in deps):
+                    started.add(key)
+                    running[executor.submit(install_target, key[0], key[1], genome_dir, url_template,
+                                            tarball_dirs, cores)] = key
+        start_ready()
+        while running:
+            finished, _ = futures.wait(list(running.keys()), return_when=futures.FIRST_COMPLETED)
+            for f in finished:
+                key = running.pop(f)
+                if f.exception() is not None:
+                    print("Failed to install %s %s: %s" % (key[0], key[1], f.exception()))
+                    failed.append(f.exception())
+                else:
+                    done.add(key)
+            if not failed:
+                start_ready()
+    if failed:
+        raise failed[0]
+    return sorted(done)
+
+
+def _target_dir(genome_dir, genome):
+    return os.path.join(genome_dir, GENOME_ORGANISMS.get(genome, genome), genome)
+
+
+def install_target(genome, target, genome_dir, url_template, tarball_dirs, cores=1):
+    """Download and extract one prepared tarball into the genome directory.
+    """
+    out_dir = utils.safe_makedir(_target_dir(genome_dir, genome))
+    marker = os.path.join(out_dir, ".installed-%s" % target)
+    url = url_template.format(genome=genome, target=target)
+    if utils.file_exists(marker):
+        with open(marker) as in_handle:
+            if json.load(in_handle).get("url") == url:
+                return out_dir
+    checksum = download.get_checksum(url)
+    if not checksum:
+        print("No checksum available for %s, skipping verification" % url)
+    print("Installing %s %s from %s" % (genome, target, url))
+    if target in tarball_dirs:
+        download.extract_stream(url, out_dir, checksum, threads=cores)
+    else:
+        tar_file = download.download(url, os.path.join(out_dir, os.path.basename(url)), checksum)
+        download.extract_tarball(tar_file, out_dir)
+        os.remove(tar_file)
+    with open(marker, "w") as out_handle:
+        json.dump({"url": url, "checksum": checksum}, out_handle)
+    return out_dir
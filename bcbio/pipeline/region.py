@@ -0,0 +1,280 @@
+"""Split a sample's work into genomic region shards and merge the results in order.
+
+Regions come from a BED file of targets, such as `variant_regions`, or a
+genome `.fai` index for whole genome work. Shards are runs of consecutive
+regions with close to equal weight, measured in bases or, with a
+precomputed coverage BED (`chrom start end depth`, as written by mosdepth
+or `bedtools genomecov -bg`), in bases times depth. Target intervals are
+never cut, so calls spanning a target stay in one shard; whole chromosomes
+from a `.fai` are cut at shard boundaries.
+
+    shards = region.shard_regions("regions.bed", 128)
+    items = region.shard_items(data, shards, "sample-calls.vcf.gz", work_dir)
+    region.concatenate(scheduler.map("variantcall_region", items), "sample-calls.vcf.gz")
+
+Shards keep the order of the region file, so concatenating per-shard
+outputs in shard order gives sorted output.
+"""
+from __future__ import print_function
+import os
+import gzip
+import shutil
+import bisect
+import subprocess
+import collections
+
+from bcbio import utils
+
+# Shards per core, letting quickly finishing shards free cores for slower ones
+SHARDS_PER_CORE = 2
+
+Region = collections.namedtuple("Region", ["chrom", "start", "end"])
+
+
+def _open(fname, mode="rt"):
+    return gzip.open(fname, mode) if fname.endswith(".gz") else open(fname, mode)
+
+
+def read_regions(fname):
+    """Read regions from a BED or `.fai` file, merging overlapping and adjacent intervals.
+
+    Chromosomes are kept in file order, with intervals sorted by position
+    within each.
+    """
+    by_chrom = collections.OrderedDict()
+    is_fai = fname.endswith(".fai")
+    with _open(fname) as in_handle:
+        for line in in_handle:
+            if not line.strip() or line.startswith(("#", "track", "browser")):
+                continue
+            parts = line.rstrip("\r\n").split("\t")
+            if is_fai:
+                chrom, start, end = parts[0], 0, int(parts[1])
+            else:
+                chrom, start, end = parts[0], int(parts[1]), int(parts[2])
+            if end > start:
+                by_chrom.setdefault(chrom, []).append((start, end))
+    out = []
+    for chrom, intervals in by_chrom.items():
+        intervals.sort()
+        cur_start, cur_end = intervals[0]
+        for start, end in intervals[1:]:
+            if start <= cur_end:
+                cur_end = max(cur_end, end)
+            else:
+                out.append(Region(chrom, cur_start, cur_end))
+                cur_start, cur_end = start, end
+        out.append(Region(chrom, cur_start, cur_end))
+    return out
+
+
+class CoverageWeights(object):
+    """Weight of regions from a coverage BED: bases times depth, summed over overlaps.
+    """
+    def __init__(self, fname):
+        self._starts = {}
+        self._intervals = {}
+        by_chrom = collections.defaultdict(list)
+        with _open(fname) as in_handle:
+            for line in in_handle:
+                if not line.strip() or line.startswith(("#", "track", "browser")):
+                    continue
+                parts = line.rstrip("\r\n").split("\t")
+                by_chrom[parts[0]].append((int(parts[1]), int(parts[2]), float(parts[-1])))
+        for chrom, intervals in by_chrom.items():
+            intervals.sort()
+            # Cumulative weight up to the end of each interval, for constant time range sums
+            cum = []
+            total = 0.0
+            for start, end, depth in intervals:
+                total += (end - start) * depth
+                cum.append(total)
+            self._starts[chrom] = [x[0] for x in intervals]
+            self._intervals[chrom] = (intervals, cum)
+
+    def _cum_at(self, chrom, pos):
+        """Weight of the chromosome before `pos`.
+        """
+        starts = self._starts.get(chrom)
+        if not starts:
+            return 0.0
+        intervals, cum = self._intervals[chrom]
+        i = bisect.bisect_right(starts, pos) - 1
+        if i < 0:
+            return 0.0
+        start, end, depth = intervals[i]
+        before = cum[i - 1] if i > 0 else 0.0
+        return before + (min(pos, end) - start) * depth
+
+    def weight(self, region):
+        return self._cum_at(region.chrom, region.end) - self._cum_at(region.chrom, region.start)
+
+
+def _base_weight(region):
+    return float(region.end - region.start)
+
+
+def _cut_position(region, weight, weight_fn):
+    """Position in a region where the weight from its start reaches `weight`.
+    """
+    lo, hi = region.start, region.end
+    while hi - lo > 1:
+        mid = (lo + hi) // 2
+        if weight_fn(Region(region.chrom, region.start, mid)) < weight:
+            lo = mid
+        else:
+            hi = mid
+    return hi
+
+
+def shard_regions(region_file, num_shards, weight_file=None, split=None):
+    """Group regions into up to `num_shards` shards of consecutive regions with balanced weight.
+
+    `weight_file` is a coverage BED weighting regions by depth, and `split`
+    allows cutting regions at shard boundaries, defaulting to true for a
+    genome `.fai` and false for BED targets. Returns a list of shards,
+    each a list of `Region`.
+    """
+    regions = read_regions(region_file)
+    if not regions:
+        return []
+    weight_fn = CoverageWeights(weight_file).weight if weight_file else _base_weight
+    num_shards = max(int(num_shards), 1)
+    if split is None:
+        split = region_file.endswith(".fai")
+    weights = [weight_fn(r) for r in regions]
+    if not sum(weights):
+        weight_fn = _base_weight
+        weights = [weight_fn(r) for r in regions]
+    total = sum(weights)
+    todo = collections.deque(zip(regions, weights))
+    shards = []
+    cur = []
+    cum = 0.0
+    # Each shard aims for an equal share of the weight not yet assigned
+    boundary = total / num_shards
+    tolerance = total * 1e-9
+    while todo:
+        r, w = todo.popleft()
+        last_shard = len(shards) >= num_shards - 1
+        # Close the shard once it reaches its share or, for regions that cannot be
+        # cut, at the region boundary nearest to it
+        if cur and not last_shard and (cum >= boundary - tolerance or
+                                       (not split and abs(cum - boundary) < abs(cum + w - boundary))):
+            shards.append(cur)
+            cur = []
+            boundary = cum + (total - cum) / (num_shards - len(shards))
+            last_shard = len(shards) >= num_shards - 1
+        if split and not last_shard and cum < boundary - tolerance and boundary < cum + w:
+            pos = _cut_position(r, boundary - cum, weight_fn)
+            if r.start < pos < r.end:
+                first, rest = Region(r.chrom, r.start, pos), Region(r.chrom, pos, r.end)
+                cur.append(first)
+                cum += weight_fn(first)
+                todo.appendleft((rest, weight_fn(rest)))
+                continue
+        cur.append(r)
+        cum += w
+    shards.append(cur)
+    return shards
+
+
+def write_shard_bed(shard, out_file):
+    tx_file = "%s.tx%s" % (out_file, os.getpid())
+    with open(tx_file, "w") as out_handle:
+        for r in shard:
+            out_handle.write("%s\t%s\t%s\n" % (r.chrom, r.start, r.end))
+    os.rename(tx_file, out_file)
+    return out_file
+
+
+def shard_file(out_file, i):
+    base, ext = utils.splitext_plus(out_file)
+    return "%s-shard%04d%s" % (base, i, ext)
+
+
+def shard_items(data, shards, out_file, work_dir):
+    """Work items for running a function per shard: `[data, region_bed, shard_out_file]`.
+
+    Shard BED files and outputs go in a `regions` directory of `work_dir`.
+    Run them with `scheduler.map` and merge with `concatenate`.
+    """
+    shard_dir = utils.safe_makedir(os.path.join(work_dir, "regions"))
+    shard_out = os.path.join(shard_dir, os.path.basename(out_file))
+    items = []
+    for i, shard in enumerate(shards):
+        bed_file = write_shard_bed(shard, shard_file(os.path.join(shard_dir, "%s.bed" % data["description"]), i))
+        items.append([data, bed_file, shard_file(shard_out, i)])
+    return items
+
+
+def _is_header(line):
+    return line.startswith(b"#")
+
+
+def concatenate(in_files, out_file):
+    """Concatenate per-shard outputs in order, keeping the header of the first.
+
+    Shards without output (None or missing files) are skipped. Output
+    ending in `.gz` is bgzip compressed when `bgzip` is available, so it
+    can be indexed, and gzip compressed otherwise.
+    """
+    if utils.file_exists(out_file):
+        return out_file
+    in_files = [x for x in in_files if x and os.path.exists(x)]
+    tx_file = "%s.tx%s%s" % (utils.splitext_plus(out_file)[0], os.getpid(), utils.splitext_plus(out_file)[1])
+    bgzip = shutil.which("bgzip") if out_file.endswith(".gz") else None
+    proc = None
+    if bgzip:
+        out_handle = open(tx_file, "wb")
+        proc = subprocess.Popen([bgzip, "-c"], stdin=subprocess.PIPE, stdout=out_handle)
+        write_handle = proc.stdin
+    elif out_file.endswith(".gz"):
+        write_handle = gzip.open(tx_file, "wb")
+    else:
+        write_handle = open(tx_file, "wb")
+    try:
+        for i, in_file in enumerate(in_files):
+            with _open(in_file, "rb") as in_handle:
+                if i > 0:
+                    # Skip repeated headers, copying the remainder in blocks
+                    for line in in_handle:
+                        if not _is_header(line):
+                            write_handle.write(line)
+                            break
+                shutil.copyfileobj(in_handle, write_handle, 1024 * 1024)
+    finally:
+        write_handle.close()
+        if proc is not None:
+            proc.wait()
+            out_handle.close()
+    if proc is not None and proc.returncode != 0:
+        raise subprocess.CalledProcessError(proc.returncode, [bgzip, "-c"])
+    os.rename(tx_file, out_file)
+    return out_file
+
+
+def get_region_file(data, fai_file=None):
+    """Regions to split a sample by: its `variant_regions` targets, or the whole genome.
+    """
+    region_file = ((data.get("config") or {}).get("algorithm") or data.get("algorithm") or {}).get("variant_regions")
+    if region_file:
+        return region_file
+    if not fai_file:
+        raise ValueError("Sample %s has no variant_regions and no genome .fai was given"
+                         % data.get("description"))
+    return fai_file
+
+
+def run_by_region(scheduler, fn, data, region_file, out_file, work_dir, weight_file=None, num_shards=None):
+    """Run `fn(data, region_bed, out_file)` per shard on a scheduler and merge the outputs.
+
+    Shards default to `SHARDS_PER_CORE` per core of the scheduler, and `fn`
+    returns its output file, or None when a shard has no output.
+    """
+    if utils.file_exists(out_file):
+        return out_file
+    num_shards = num_shards or SHARDS_PER_CORE * max(int(scheduler.parallel.get("cores") or 1), 1)
+    shards = shard_regions(region_file, num_shards, weight_file)
+    items = shard_items(data, shards, out_file, work_dir)
+    return concatenate(scheduler.map(fn, items), out_file)
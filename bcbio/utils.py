@@ -1,6 +1,15 @@
 import os
+import copy
+import hashlib
+import pickle
+import tempfile
+import threading
+import contextlib
 import time
 
+_YAML_CACHE = {}
+_YAML_LOCK = threading.Lock()
+
 def safe_makedir(dname):
     if not dname:
         return dname
@@ -22,3 +31,99 @@ def file_exists(fname):
         return fname and os.path.exists(fname) and os.path.getsize(fname) > 0
     except OSError:
         return False
+
+@contextlib.contextmanager
+def chdir(new_dir):
+    """Context manager to temporarily change to a new directory.
+    """
+    cur_dir = os.getcwd()
+    safe_makedir(new_dir)
+    os.chdir(new_dir)
+    try:
+        yield
+    finally:
+        os.chdir(cur_dir)
+
+def splitext_plus(f):
+    """Split on file extensions, allowing for zipped extensions.
+    """
+    base, ext = os.path.splitext(f)
+    if ext in [".gz", ".bz2", ".zip"]:
+        base, ext2 = os.path.splitext(base)
+        ext = ext2 + ext
+    return base, ext
+
+def _yaml_cache_dir():
+    return os.environ.get("BCBIO_YAML_CACHE", os.path.join(os.path.expanduser("~"), ".cache", "bcbio", "yaml"))
+
+def _private_dir(dname):
+    """Check a cache directory is owned by this user and not writable by others.
+    """
+    try:
+        st = os.stat(dname)
+    except OSError:
+        return False
+    return (not hasattr(os, "getuid") or st.st_uid == os.getuid()) and not st.st_mode & 0o022
+
+def _yaml_pickle_file(fname):
+    """Pickled copy of a parsed YAML file in the per-user cache, keyed by its absolute path.
+    """
+    return os.path.join(_yaml_cache_dir(), "%s.pkl" % hashlib.sha256(fname.encode("utf-8")).hexdigest())
+
+def load_yaml(fname, shared=False):
+    """Parse a YAML file once per process, using the libyaml loader when available.
+
+    Parsed data is cached by path, modification time and size, and pickled to
+    a per-user cache directory (`$BCBIO_YAML_CACHE`, defaulting to
+    `~/.cache/bcbio/yaml`) so later processes skip parsing. Returns a
+    copy callers can modify, or with `shared` the cached data itself, which
+    must not be changed.
+    """
+    fname = os.path.abspath(fname)
+    stat = os.stat(fname)
+    stamp = (stat.st_mtime, stat.st_size)
+    with _YAML_LOCK:
+        cached = _YAML_CACHE.get(fname)
+    if cached is None or cached[0] != stamp:
+        data = _read_yaml_pickle(fname, stamp)
+        if data is None:
+            import yaml
+            with open(fname) as in_handle:
+                data = yaml.load(in_handle, Loader=getattr(yaml, "CSafeLoader", yaml.SafeLoader))
+            _write_yaml_pickle(fname, stamp, data)
+        cached = (stamp, data)
+        with _YAML_LOCK:
+            _YAML_CACHE[fname] = cached
+    return cached[1] if shared else copy.deepcopy(cached[1])
+
+def _read_yaml_pickle(fname, stamp):
+    # Only unpickle files this user wrote, in a directory others cannot write to
+    if not _private_dir(_yaml_cache_dir()):
+        return None
+    try:
+        with open(_yaml_pickle_file(fname), "rb") as in_handle:
+            cur = pickle.load(in_handle)
+    except Exception:
+        return None
+    if isinstance(cur, dict) and cur.get("fname") == fname and cur.get("stamp") == stamp:
+        return cur.get("data")
+
+def _write_yaml_pickle(fname, stamp, data):
+    """Save parsed YAML to the per-user cache, skipping it when the cache is not usable.
+    """
+    cache_dir = _yaml_cache_dir()
+    try:
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir, 0o700)
+        if not _private_dir(cache_dir):
+            return
+        fd, tx_file = tempfile.mkstemp(dir=cache_dir, prefix=".tx")
+    except (IOError, OSError):
+        return
+    try:
+        with os.fdopen(fd, "wb") as out_handle:
+            pickle.dump({"fname": fname, "stamp": stamp, "data": data}, out_handle, protocol=2)
+        os.rename(tx_file, _yaml_pickle_file(fname))
+    except (IOError, OSError, pickle.PicklingError):
+        if os.path.exists(tx_file):
+            os.remove(tx_file)
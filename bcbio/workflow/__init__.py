@@ -1,10 +1,14 @@
-from bcbio.workflow import template
+import importlib
 
+# Workflow name -> module, imported when the workflow is used
 workflows = {
-    "template": template
+    "template": "bcbio.workflow.template"
 }
 
+def get_workflow(name):
+    return importlib.import_module(workflows[name])
+
 def setup(name, inputs):
-    workflow = workflows[name]
+    workflow = get_workflow(name)
     args = workflow.parse_args(inputs)
     return workflow.setup(args)
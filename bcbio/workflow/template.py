@@ -1,8 +1,48 @@
 import argparse
 import sys,os,yaml
-import contextlib
-from six.moves import urllib
 import collections
+import copy
+import csv
+import re
+import shutil
+import datetime
+import fnmatch
+import glob
+import hashlib
+import pickle
+from concurrent import futures
+
+from bcbio import dlcache, download, utils
+from bcbio.bam import fastq, probe
+
+KNOWN_EXTS = {".bam": "bam", ".cram": "bam", ".fq": "fastq",
+              ".fastq": "fastq", ".txt": "fastq",
+              ".fastq.gz": "fastq", ".fq.gz": "fastq",
+              ".txt.gz": "fastq", ".gz": "fastq",
+              ".fastq.bz2": "fastq", ".fq.bz2": "fastq",
+              ".txt.bz2": "fastq", ".bz2": "fastq",
+              ".vcf.gz": "vcf", ".vcf": "vcf"}
+COMPRESSED_EXTS = set([".gz", ".bz2"])
+# Extensions picked up from input directories, leaving out ambiguous ones like .txt and .gz
+DIR_EXTS = set([".bam", ".cram", ".fq", ".fastq", ".fq.gz", ".fastq.gz", ".fq.bz2", ".fastq.bz2",
+                ".vcf", ".vcf.gz"])
+ALGORITHM_KEYS = set(["platform", "aligner", "bam_clean", "bam_sort", "trim_reads", "adapters",
+                      "custom_trim", "species", "kraken", "align_split_size", "save_diskspace",
+                      "transcriptome_align", "quality_format", "strandedness", "expression_caller",
+                      "fusion_mode", "fusion_caller", "min_read_length", "coverage_interval",
+                      "maxcov_downsample", "coverage", "variant_regions", "sv_regions", "effects",
+                      "effects_transcripts", "mark_duplicates", "recalibrate", "realign", "phasing",
+                      "validate", "validate_regions", "validate_genome_build", "validate_method",
+                      "nomap_split_size", "nomap_split_targets", "ensemble", "background",
+                      "disambiguate", "svcaller", "svprioritize", "variantcaller", "jointcaller",
+                      "vcfanno", "peakcaller", "umi_type", "archive", "tools_off", "tools_on",
+                      "mixup_check", "exclude_regions", "min_allele_fraction", "qc", "hlacaller"])
+
+# Parsed templates as pickles, keyed by sha256 of the template text
+_PARSED_TEMPLATES = {}
+_BUILTIN_TEMPLATES = {}
+# Seconds a downloaded standard template is used before checking GitHub for changes
+TEMPLATE_MAX_AGE = 24 * 60 * 60
 
 class HelpArgParser(argparse.ArgumentParser):
     def error(self, message):
@@ -34,6 +74,8 @@ def setup_args(parser):
                         action="store_true", default=False)
     parser.add_argument("--separators", help="semicolon separated list of separators that indicates paired files.",
                         default="R,_,-,.")
+    parser.add_argument("--recursive", help="Also look for input files in subdirectories of input directories",
+                        action="store_true", default=False)
     # setup_script_logging()
     return parser
 
@@ -41,11 +83,66 @@ def setup(args):
     template, template_txt = name_to_config(args.template)
     base_item = template["details"][0]
     project_name, metadata, global_vars, md_file = _pname_and_metadata(args.metadata)
+    metadata = MetadataIndex(metadata)
     remotes = {}
     inputs = args.input_files
-    raw_items = [_add_metadata(item, metadata, remotes, args.only_metadata)
+    raw_items = (_add_metadata(item, metadata, remotes, args.only_metadata)
                  for item in _prep_items_from_base(base_item, inputs, metadata,
-                                                   args.separators.split(","), args.force_single)]
+                                                   args.separators.split(","), args.force_single,
+                                                   args.recursive))
+    items = (x for x in raw_items if x)
+    out_dir = os.path.join(os.getcwd(), project_name)
+    work_dir = utils.safe_makedir(os.path.join(out_dir, "work"))
+    if md_file:
+        shutil.copyfile(md_file, os.path.join(utils.safe_makedir(os.path.join(out_dir, "config")),
+                                              os.path.basename(md_file)))
+    out_config_file = _write_config_file(items, global_vars, template, project_name, out_dir)
+    print("Configuration file created at: %s" % out_config_file)
+    print("Edit to finalize and run with:")
+    print("  cd %s" % work_dir)
+    print("  bcbio_nextgen.py ../config/%s" % os.path.basename(out_config_file))
+
+def _yaml_dumper():
+    return getattr(yaml, "CSafeDumper", yaml.SafeDumper)
+
+def _write_config_file(items, global_vars, template, project_name, out_dir):
+    """Write the sample configuration, streaming items to disk one at a time.
+
+    Top level options are written first, followed by a `details` block
+    sequence with each item dumped as it is generated, so memory use does
+    not grow with the number of samples. Output goes to a temporary file
+    renamed into place once all items are written.
+    """
+    config_dir = utils.safe_makedir(os.path.join(out_dir, "config"))
+    out_config_file = os.path.join(config_dir, "%s.yaml" % project_name)
+    out = collections.OrderedDict([("fc_name", project_name), ("upload", {"dir": "../final"})])
+    if global_vars:
+        out["globals"] = global_vars
+    for k, v in template.items():
+        if k not in ["details"]:
+            out[k] = v
+    tx_file = "%s.tx%s" % (out_config_file, os.getpid())
+    count = 0
+    try:
+        with open(tx_file, "w") as out_handle:
+            for k, v in out.items():
+                yaml.dump({k: v}, out_handle, Dumper=_yaml_dumper(), default_flow_style=False,
+                          allow_unicode=False)
+            out_handle.write("details:\n")
+            for item in items:
+                yaml.dump([item], out_handle, Dumper=_yaml_dumper(), default_flow_style=False,
+                          allow_unicode=False)
+                count += 1
+        if count == 0:
+            raise ValueError("Did not find samples in metadata file or input files")
+    except BaseException:
+        os.remove(tx_file)
+        raise
+    if os.path.exists(out_config_file):
+        shutil.move(out_config_file,
+                    out_config_file + ".bak%s" % datetime.datetime.now().strftime("%Y-%m-%d-%H-%M-%S"))
+    os.rename(tx_file, out_config_file)
+    return out_config_file
 
 def _add_metadata(item, metadata, remotes, only_metadata=False):
     """Add metadata information from CSV file to current item.
@@ -56,13 +153,16 @@ def _add_metadata(item, metadata, remotes, only_metadata=False):
        based on the pre-determined description from fastq name or BAM read groups.
     - Keys matching supported names in the algorithm section map
       to key/value pairs there instead of metadata.
+
+    `metadata` is a `MetadataIndex` built once for all items.
     """
+    item_md = None
     for check_key in [item["description"]] + _get_file_keys(item) + _get_vrn_keys(item):
         item_md = metadata.get(check_key)
         if item_md:
             break
-    if not item_md:
-        item_md = _find_glob_metadata(item["files"], metadata)
+    if not item_md and item.get("files"):
+        item_md = metadata.find_glob(item["files"])
     if remotes.get("region"):
         item["algorithm"]["variant_regions"] = remotes["region"]
     TOP_LEVEL = set(["description", "genome_build", "lane", "vrn_file", "files", "analysis"])
@@ -74,7 +174,7 @@ def _add_metadata(item, metadata, remotes, only_metadata=False):
             if v:
                 if k in TOP_LEVEL:
                     item[k] = v
-                elif k in run_info.ALGORITHM_KEYS:
+                elif k in ALGORITHM_KEYS:
                     v = _handle_special_yaml_cases(v)
                     item["algorithm"][k] = v
                 else:
@@ -85,38 +185,306 @@ def _add_metadata(item, metadata, remotes, only_metadata=False):
         print("WARNING: %s: metadata not found for %s, %s" % (warn, item["description"],
                                                               [os.path.basename(f) for f in item["files"]]))
         keep_sample = not only_metadata
-    if tz.get_in(["metadata", "ped"], item):
+    if item.get("metadata", {}).get("ped"):
         item["metadata"] = _add_ped_metadata(item["description"], item["metadata"])
     return item if keep_sample else None
 
+def _get_file_keys(item):
+    if item.get("files"):
+        return [item["files"][0], os.path.basename(item["files"][0]),
+                utils.splitext_plus(os.path.basename(item["files"][0]))[0]]
+    else:
+        return []
+
+def _get_vrn_keys(item):
+    if item.get("vrn_file"):
+        return [item["vrn_file"], os.path.basename(item["vrn_file"]),
+                utils.splitext_plus(os.path.basename(item["vrn_file"]))[0]]
+    else:
+        return []
+
+def _handle_special_yaml_cases(v):
+    """Handle values that pass integer, boolean, list or dictionary values.
+    """
+    if isinstance(v, list):
+        return v
+    if "::" in v:
+        out = {}
+        for part in v.split("::"):
+            k_part, v_part = part.split(":")
+            out[k_part] = v_part.split(";")
+        v = out
+    elif ";" in v:
+        # split lists and remove accidental empty values
+        v = [x for x in v.split(";") if x != ""]
+    else:
+        try:
+            v = int(v)
+        except ValueError:
+            if v.lower() == "true":
+                v = True
+            elif v.lower() == "false":
+                v = False
+    return v
+
+def _add_ped_metadata(name, metadata):
+    """Add standard PED file attributes into metadata if not present.
+    """
+    ignore = set(["-9", "undefined", "unknown", "."])
+
+    def _ped_mapping(x, valmap):
+        try:
+            x = int(x)
+        except ValueError:
+            x = -1
+        return valmap.get(x)
+
+    def _ped_to_phenotype(x):
+        if x in set(["unaffected", "affected", "tumor", "normal"]):
+            return x
+        return _ped_mapping(x, {1: "unaffected", 2: "affected"})
+
+    def _ped_to_batch(x):
+        if x not in ignore and x != "0":
+            return x
+    with open(metadata["ped"]) as in_handle:
+        for line in in_handle:
+            parts = line.split("\t")[:6]
+            if len(parts) > 1 and parts[1] == str(name):
+                for index, key, convert_fn in [(4, "sex", lambda x: _ped_mapping(x, {1: "male", 2: "female"})),
+                                               (0, "batch", _ped_to_batch),
+                                               (5, "phenotype", _ped_to_phenotype)]:
+                    val = convert_fn(parts[index].strip())
+                    if val is not None and key not in metadata:
+                        metadata[key] = val
+                break
+    return metadata
+
+class MetadataIndex(object):
+    """Lookup of sample metadata by description, file name or glob pattern.
+
+    Exact keys are found with a dictionary lookup, including the base name of
+    keys given as paths. Glob keys (containing `*`) match a file when
+    `fnmatch(fname, "*/" + key)` is true. They are indexed by the literal text
+    before their first wildcard: a file can only match a key whose literal
+    prefix starts one of its path components. Each file therefore checks a
+    few candidate patterns instead of every key.
+    """
+    def __init__(self, metadata):
+        self.metadata = metadata
+        self._exact = {}
+        self._order = {}
+        self._prefixes = collections.defaultdict(list)
+        self._unprefixed = []
+        for i, key in enumerate(metadata.keys()):
+            if not isinstance(key, str):
+                continue
+            self._order[key] = i
+            if "*" in key:
+                prefix = re.split(r"[*?\[]", key, 1)[0]
+                if prefix:
+                    self._prefixes[prefix].append(key)
+                else:
+                    self._unprefixed.append(key)
+            elif "/" in key:
+                self._exact.setdefault(os.path.basename(key), key)
+        self._prefix_lens = sorted(set(len(x) for x in self._prefixes))
+
+    def __len__(self):
+        return len(self.metadata)
 
-def _prep_items_from_base(base, in_files, metadata, separators, force_single=False):
-    """Prepare a set of configuration items for input files.
+    def keys(self):
+        return self.metadata.keys()
+
+    def get(self, key, default=None):
+        if key in self.metadata:
+            return self.metadata[key]
+        if key in self._exact:
+            return self.metadata[self._exact[key]]
+        return default
+
+    def glob_keys(self, fname):
+        """Glob metadata keys matching a file, in metadata file order.
+        """
+        candidates = set(self._unprefixed)
+        if self._prefix_lens:
+            start = fname.find("/")
+            while start >= 0:
+                for size in self._prefix_lens:
+                    candidates.update(self._prefixes.get(fname[start + 1:start + 1 + size], []))
+                start = fname.find("/", start + 1)
+        return sorted((k for k in candidates if fnmatch.fnmatchcase(fname, "*/%s" % k)),
+                      key=lambda k: self._order[k])
+
+    def find_glob(self, fnames):
+        """Metadata for the first glob key matching all files, or None.
+        """
+        for key in self.glob_keys(fnames[0]):
+            if all(fnmatch.fnmatchcase(f, "*/%s" % key) for f in fnames[1:]):
+                return self.metadata[key]
+
+    def glob_groups(self, fnames):
+        """Group files by the first glob key they match, returning (unmatched, groups).
+        """
+        groups = collections.OrderedDict()
+        unmatched = []
+        for f in fnames:
+            keys = self.glob_keys(f)
+            if keys:
+                groups.setdefault(keys[0], []).append(f)
+            else:
+                unmatched.append(f)
+        return unmatched, [groups[k] for k in sorted(groups, key=lambda k: self._order[k])]
+
+
+def _prep_items_from_base(base, in_files, metadata, separators, force_single=False, recursive=False):
+    """Prepare configuration items for input files, generating one item at a time.
     """
-    details = []
-    # in_files = _expand_dirs(in_files, KNOWN_EXTS) ##将in_files 里边的目录转换成KNOWN_EXTS后缀的文件
-    # in_files = _expand_wildcards(in_files)
+    in_files = _expand_dirs(in_files, recursive)
+    in_files = _expand_wildcards(in_files)
 
     ext_groups = collections.defaultdict(list)
-    for ext, files in itertools.groupby(
-            in_files, lambda x: KNOWN_EXTS.get(utils.splitext_plus(x)[-1].lower())):
-        ext_groups[ext].extend(list(files))
+    for f in in_files:
+        ext_groups[_file_type(f)].append(f)
     for ext, files in ext_groups.items():
         if ext == "bam":
             for f in files:
-                details.append(_prep_bam_input(f, base))
+                _check_exists(f)
+            bam_info = probe.probe_files(files, "bam")
+            for f in files:
+                yield _prep_bam_input(f, base, bam_info.get(f))
         elif ext in ["fastq", "fq", "fasta"]:
+            fastq_info = probe.probe_files(files, "fastq") if ext != "fasta" else {}
             files, glob_files = _find_glob_matches(files, metadata)
             for fs in glob_files:
-                details.append(_prep_fastq_input(fs, base))
+                yield _prep_fastq_input(fs, base, fastq_info)
             for fs in fastq.combine_pairs(files, force_single, separators=separators):
-                details.append(_prep_fastq_input(fs, base))
+                yield _prep_fastq_input(fs, base, fastq_info)
         elif ext in ["vcf"]:
             for f in files:
-                details.append(_prep_vcf_input(f, base))
+                yield _prep_vcf_input(f, base)
         else:
             print("Ignoring unexpected input file types %s: %s" % (ext, list(files)))
-    return details
+
+def _file_type(fname):
+    """Classify a file by extension, as bam, fastq or vcf, using KNOWN_EXTS.
+    """
+    return KNOWN_EXTS.get(_known_ext(fname))
+
+def _known_ext(fname):
+    """Extension of a file as a KNOWN_EXTS key, or None for unknown files.
+
+    Compressed files check the combined extension (`.fq.gz`) before the
+    compression extension alone, without splitting the full path.
+    """
+    name = os.path.basename(fname).lower()
+    i = name.rfind(".")
+    if i <= 0:
+        return None
+    ext = name[i:]
+    if ext in COMPRESSED_EXTS:
+        j = name.rfind(".", 0, i)
+        if j > 0 and name[j:] in KNOWN_EXTS:
+            return name[j:]
+    return ext if ext in KNOWN_EXTS else None
+
+def _expand_dirs(in_files, recursive=False, num_threads=8):
+    """Replace directories in the inputs with the fastq, BAM, CRAM and VCF files they contain.
+
+    Only files directly in each directory are used unless `recursive`, which
+    also walks subdirectories in parallel with os.scandir. Hidden entries are
+    skipped, and files come back sorted so output does not depend on listing
+    order.
+    """
+    files = []
+    dirs = []
+    for f in in_files:
+        if os.path.isdir(os.path.expanduser(f)):
+            dirs.append(os.path.expanduser(f))
+        else:
+            files.append(f)
+    if not dirs:
+        return files
+    found = []
+    with futures.ThreadPoolExecutor(max_workers=num_threads) as executor:
+        running = set(executor.submit(_scan_dir, d) for d in dirs)
+        while running:
+            finished, running = futures.wait(running, return_when=futures.FIRST_COMPLETED)
+            for f in finished:
+                cur_files, subdirs = f.result()
+                found.extend(cur_files)
+                if recursive:
+                    running |= set(executor.submit(_scan_dir, d) for d in subdirs)
+    return files + sorted(found)
+
+def _scan_dir(dirname):
+    """List input files and subdirectories of a directory, with one scandir pass.
+    """
+    files = []
+    subdirs = []
+    for entry in os.scandir(dirname):
+        if entry.name.startswith("."):
+            continue
+        if entry.is_dir():
+            subdirs.append(entry.path)
+        elif _known_ext(entry.name) in DIR_EXTS and entry.is_file():
+            files.append(entry.path)
+    return files, subdirs
+
+def _expand_wildcards(in_files):
+    """Expand glob patterns in input file names.
+    """
+    out = []
+    for in_file in in_files:
+        if glob.has_magic(in_file):
+            out.extend(sorted(glob.glob(os.path.expanduser(in_file))))
+        else:
+            out.append(in_file)
+    return out
+
+def _find_glob_matches(in_files, metadata):
+    """Group files that match by globs for merging, rather than by explicit pairs.
+    """
+    if not isinstance(metadata, MetadataIndex):
+        metadata = MetadataIndex(metadata)
+    return metadata.glob_groups(in_files)
+
+def _check_exists(f):
+    if not os.path.exists(f):
+        raise ValueError("Could not find input file: %s" % f)
+
+def _prep_bam_input(f, base, info=None):
+    _check_exists(f)
+    cur = copy.deepcopy(base)
+    cur["files"] = [os.path.abspath(f)]
+    cur["description"] = _get_rg_name(info) or os.path.splitext(os.path.basename(f))[0]
+    return cur
+
+def _get_rg_name(info):
+    """Sample name from the first read group with one in a probed BAM header.
+    """
+    for rg in (info or {}).get("read_groups", []):
+        if rg.get("SM"):
+            return rg["SM"]
+
+def _prep_fastq_input(fs, base, fastq_info=None):
+    for f in fs:
+        _check_exists(f)
+    cur = copy.deepcopy(base)
+    cur["files"] = [os.path.abspath(f) for f in fs]
+    d = os.path.commonprefix([utils.splitext_plus(os.path.basename(f))[0] for f in fs])
+    cur["description"] = fastq.rstrip_extra(d)
+    quality_formats = set((fastq_info or {}).get(f, {}).get("quality_format") for f in fs)
+    if quality_formats == set(["illumina"]) and "quality_format" not in cur.get("algorithm", {}):
+        cur.setdefault("algorithm", {})["quality_format"] = "illumina"
+    return cur
+
+def _prep_vcf_input(f, base):
+    _check_exists(f)
+    cur = copy.deepcopy(base)
+    cur["vrn_file"] = os.path.abspath(f)
+    cur["description"] = utils.splitext_plus(os.path.basename(f))[0]
+    return cur
 
 def _pname_and_metadata(in_file):
     """Retrieve metadata and project name from the input metadata CSV file.
@@ -124,39 +492,144 @@ def _pname_and_metadata(in_file):
     Uses the input file name for the project name and for back compatibility,
     accepts the project name as an input, providing no metadata.
     """
+    if os.path.isfile(in_file):
+        with open(in_file) as in_handle:
+            md, global_vars = _parse_metadata(in_handle)
+        base = os.path.splitext(os.path.basename(in_file))[0]
+        md_file = in_file
+    else:
+        if in_file.endswith(".csv"):
+            raise ValueError("Did not find input metadata file: %s" % in_file)
+        base, md, global_vars = _safe_name(os.path.splitext(os.path.basename(in_file))[0]), {}, {}
+        md_file = None
+    return _safe_name(base), md, global_vars, md_file
 
+def _safe_name(x):
+    for prob in [" ", "."]:
+        x = x.replace(prob, "_")
+    return x
 
-    if in_file.endswith(".csv"):
-        raise ValueError("Did not find input metadata file: %s" % in_file)
-    base, md, global_vars = in_file, {}, {}
-    md_file = None
-    return base, md, global_vars, md_file
+def _parse_metadata(in_handle):
+    """Reads metadata from a simple CSV structured input file, one row at a time.
+
+    samplename,batch,phenotype
+    ERR256785,batch1,normal
+    """
+    metadata = collections.OrderedDict()
+    reader = csv.reader(in_handle)
+    header = None
+    for row in reader:
+        if row and row[0].strip() and not row[0].startswith("#"):
+            header = row
+            break
+    if header is None:
+        return metadata, {}
+    keys = [x.strip() for x in header[1:]]
+    for sinfo in reader:
+        if not sinfo or not sinfo[0].strip() or sinfo[0].startswith("#"):
+            continue
+        sinfo = [x.strip() for x in sinfo]
+        sample = sinfo[0]
+        # sanity check to avoid duplicate rows
+        if sample in metadata:
+            raise ValueError("Sample %s present multiple times in metadata file.\n"
+                             "If you need to specify multiple attributes as a list "
+                             "use a semi-colon to separate them on a single line.\n"
+                             "Duplicate line is %s" % (sample, sinfo))
+        metadata[sample] = dict(zip(keys, sinfo[1:]))
+    return metadata, {}
 
 def name_to_config(template):
     """Read template file into a dictionary to use as base for all samples.
 
-    Handles well-known template names, pulled from GitHub repository and local
-    files.
+    Handles well-known template names, from templates bundled in the
+    `config/templates` directory or pulled from GitHub repository, and local
+    files. Each template
+    is read once and parsed templates are cached by content, in memory and on
+    disk, so repeated runs skip YAML parsing.
     """
+    txt_config = _read_template(template)
+    return _parse_template(txt_config), txt_config
 
+def _read_template(template):
     base_url = "https://raw.github.com/bcbio/bcbio-nextgen/master/config/templates/%s.yaml"
     if os.path.isfile(template):
         if template.endswith(".csv"):
             raise ValueError("Expected YAML file for template and found CSV, are arguments switched? %s" % template)
         with open(template) as in_handle:
-            txt_config = in_handle.read()
-        with open(template) as in_handle:
-            config = yaml.safe_load(in_handle)
-    else:
-        try:
-            with contextlib.closing(urllib.request.urlopen(base_url % template)) as in_handle:
-                txt_config = in_handle.read().decode()
-            with contextlib.closing(urllib.request.urlopen(base_url % template)) as in_handle:
-                config = yaml.safe_load(in_handle)
-        except (urllib.error.HTTPError, urllib.error.URLError):
-            raise ValueError("Could not find template '%s' locally or in standard templates on GitHub"
-                             % template)
-    return config, txt_config
+            return in_handle.read()
+    builtin = _builtin_templates().get(template)
+    if builtin:
+        with open(builtin) as in_handle:
+            return in_handle.read()
+    try:
+        return dlcache.read(base_url % template, TEMPLATE_MAX_AGE).decode()
+    except (download.urllib_error.HTTPError, download.urllib_error.URLError):
+        raise ValueError("Could not find template '%s' locally or in standard templates on GitHub"
+                         % template)
+
+def _builtin_templates():
+    """Index of template names to YAML files bundled in the `config/templates` directory.
+    """
+    if "index" not in _BUILTIN_TEMPLATES:
+        config_dir = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))),
+                                  "config", "templates")
+        index = {}
+        if os.path.isdir(config_dir):
+            for fname in sorted(os.listdir(config_dir)):
+                if fname.endswith(".yaml"):
+                    index[fname[:-len(".yaml")]] = os.path.join(config_dir, fname)
+        _BUILTIN_TEMPLATES["index"] = index
+    return _BUILTIN_TEMPLATES["index"]
+
+def _parse_template(txt_config):
+    """Parse template YAML, reusing earlier parses of the same content.
+
+    Parses are pickled to a per-user cache directory, which is only used
+    when it is owned by this user and not writable by others. Returns a
+    fresh copy for each call so callers can modify it.
+    """
+    key = hashlib.sha256(txt_config.encode("utf-8")).hexdigest()
+    if key not in _PARSED_TEMPLATES:
+        cache_file = os.path.join(_template_cache_dir(), "%s.pickle" % key)
+        pickled = _read_template_pickle(cache_file)
+        if not pickled:
+            config = yaml.load(txt_config, Loader=getattr(yaml, "CSafeLoader", yaml.SafeLoader))
+            pickled = pickle.dumps(config, protocol=pickle.HIGHEST_PROTOCOL)
+            _write_template_pickle(cache_file, pickled)
+        _PARSED_TEMPLATES[key] = pickled
+    return pickle.loads(_PARSED_TEMPLATES[key])
+
+def _read_template_pickle(cache_file):
+    """Pickled parse of a template from the cache, or None if missing, unusable or corrupt.
+    """
+    if not utils._private_dir(os.path.dirname(cache_file)):
+        return None
+    try:
+        with open(cache_file, "rb") as in_handle:
+            pickled = in_handle.read()
+        pickle.loads(pickled)
+    except Exception:
+        return None
+    return pickled
+
+def _write_template_pickle(cache_file, pickled):
+    cache_dir = os.path.dirname(cache_file)
+    try:
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir, 0o700)
+        if not utils._private_dir(cache_dir):
+            return
+        tx_file = "%s.tx%s" % (cache_file, os.getpid())
+        with open(tx_file, "wb") as out_handle:
+            out_handle.write(pickled)
+        os.rename(tx_file, cache_file)
+    except (IOError, OSError):
+        pass
+
+def _template_cache_dir():
+    return os.environ.get("BCBIO_TEMPLATE_CACHE",
+                          os.path.join(os.path.expanduser("~"), ".cache", "bcbio", "templates"))
 
 def setup_script_logging():
     """
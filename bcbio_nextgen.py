@@ -1,18 +1,31 @@
 from __future__ import print_function
 import sys,os
 import argparse
-
-
-from bcbio import install,utils,workflow
-from bcbio.distributed import runfn,clargs
-
+import importlib
+
+# Subcommand name -> (module, function running the parsed arguments).
+# Modules are only imported for the subcommand in use, keeping startup fast
+# for short lived processes such as runfn tasks on cluster nodes.
+SUBCOMMANDS = {
+    "upgrade": ("bcbio.install", "upgrade_bcbio"),
+    "runfn": ("bcbio.distributed.runfn", "process"),
+    "worker": ("bcbio.distributed.worker", "process"),
+    "profile": ("bcbio.hostprofile", "process"),
+    "trace": ("bcbio.distributed.trace", "process"),
+}
+
+def load_subcommand(name):
+    """Import the module implementing a subcommand or workflow.
+    """
+    if name in SUBCOMMANDS:
+        return importlib.import_module(SUBCOMMANDS[name][0])
+    from bcbio import workflow
+    return workflow.get_workflow(name)
 
 def parse_cl_args(in_args):
 
-    sub_cmds = {
-        "upgrade" : install.add_subparser,
-        'runfn' : runfn.add_subparser
-    }
+    sub_cmds = dict((k, lambda subparsers, k=k: load_subcommand(k).add_subparser(subparsers))
+                    for k in SUBCOMMANDS)
     description = "Community developed high throughput sequencing analysis."
     parser = argparse.ArgumentParser(description= description)
     sub_cmd = None
@@ -36,8 +49,9 @@ def parse_cl_args(in_args):
                             help=("YAML file with details about samples to "
                                   "process (required, unless using Galaxy "
                                   "LIMS as input)")),
-        parser.add_argument("-n", "--numcores", type=int, default=1,
-                            help="Total cores to use for processing")
+        parser.add_argument("-n", "--numcores", type=int, default=None,
+                            help=("Total cores to use for processing. Defaults to the usable cores "
+                                  "found by `bcbio_nextgen.py profile` on this machine, or 1"))
         parser.add_argument("-t", "--paralleltype",
                             choices=["local", "ipython"],
                             default="local", help="Approach to parallelization")
@@ -69,6 +83,17 @@ def parse_cl_args(in_args):
                             help=("Number of retries of failed tasks during "
                                   "distributed processing. Default 0 "
                                   "(no retries)"))
+        parser.add_argument("--worker-socket",
+                            help=("Unix socket of warm worker daemons (bcbio_nextgen.py worker) "
+                                  "to run distributed tasks in, when running on each node"))
+        parser.add_argument("--task-cache", nargs="?", const=True, default=None,
+                            help=("Record finished distributed tasks in a SQLite index and skip them "
+                                  "when restarting. Optionally the index file, defaulting to "
+                                  "checkpoints_parallel/taskcache.db"))
+        parser.add_argument("--trace", nargs="?", const=True, default=None,
+                            help=("Record run time, CPU, memory, I/O and queue wait of every distributed "
+                                  "task. Optionally the trace file, defaulting to log/trace/<tag>.jsonl. "
+                                  "Summarize with `bcbio_nextgen.py trace`"))
         parser.add_argument("--workdir", default=os.getcwd(),
                             help=("Directory to process in. Defaults to "
                                   "current working directory"))
@@ -81,6 +106,7 @@ def parse_cl_args(in_args):
     args = parser.parse_args(in_args)
 
     if hasattr(args, "workdir") and args.workdir:
+        from bcbio import utils
         utils.safe_makedir(args.workdir)
 
     if hasattr(args, "global_config"):
@@ -88,6 +114,7 @@ def parse_cl_args(in_args):
         if error_msg:
             parser.error(error_msg)
 
+        from bcbio.distributed import clargs
         kwargs = {"parallel": clargs.to_parallel(args),
                   "workflow": args.workflow,
                   "workdir": args.workdir}
@@ -102,7 +129,6 @@ def parse_cl_args(in_args):
             "config_file" : None,
             sub_cmd : True
         }
-    print(args)
     return kwargs
 
 
@@ -183,15 +209,11 @@ def _sanity_check_args(args):
             return "IPython parallel requires queue (-q) and scheduler (-s) arguments."
 
 if __name__ == '__main__':
-    # sys.argv.extend(['upgrade' ,  '--tooldir', '/usr/local', '--genomes', 'GRCh37', '--aligners', 'bwa', '--aligners', 'bowtie2', '--data'])
-
-    sys.argv.extend(['-w', 'template', r'D:\python-projects\my_bcbio\config\gatk-variant.yaml', 'project1', 'sample1.bam', 'sample2_1.fq', 'sample2_2.fq'])
-    # sys.argv.extend([ '-h'])
-
     kwargs = parse_cl_args(sys.argv[1:])
-    if "upgrade" in kwargs and kwargs['upgrade']:
-        install.upgrade_bcbio(kwargs['args'])
+    sub_cmd = [k for k in SUBCOMMANDS if kwargs.get(k)]
+    if sub_cmd:
+        getattr(load_subcommand(sub_cmd[0]), SUBCOMMANDS[sub_cmd[0]][1])(kwargs["args"])
     else:
         if kwargs.get("workflow"):
+            from bcbio import workflow
             setup_info = workflow.setup(kwargs['workflow'], kwargs.pop("inputs"))
-    print (kwargs)
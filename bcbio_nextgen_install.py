@@ -1,6 +1,7 @@
 #coding:utf8
 from __future__ import print_function  ###如果是python 2.x 使用print 依然需要加上（）
 import os,sys
+import re
 import contextlib
 import shutil
 import platform
@@ -10,6 +11,10 @@ try:
     import urllib2 as urllib_request
 except ImportError:
     import urllib.request as urllib_request
+try:
+    from bcbio import dlcache
+except ImportError:
+    dlcache = None
 
 
 REMOTES = {
@@ -51,7 +56,16 @@ def _clean_args(sys_argv, args):
         base.append("--data")
     return base
 
-def write_system_config(base_url , datadir, tooldir):
+def write_system_config(base_url, datadir, tooldir):
+    """Write bcbio_system.yaml for this installation.
+
+    Reads the bundled copy next to this script when present, otherwise the
+    download cache or `base_url`. Program `dir` entries in `resources` point
+    into the tool directory and the default cores and per core memory are
+    limited to what this machine has. Only those values are edited, keeping
+    the comments and layout of the original. The file is written atomically,
+    keeping a backup of a previous version.
+    """
     out_file = os.path.join(datadir, "galaxy", os.path.basename(base_url))
     if not os.path.exists(os.path.dirname(out_file)):
         os.makedirs(os.path.dirname(out_file))
@@ -60,35 +74,167 @@ def write_system_config(base_url , datadir, tooldir):
         if tooldir is None:
             return out_file
         else:
-            bak_file = out_file + ".bak%"(datetime.datetime.now().strftime("%Y%M%d_%H%M"))
+            bak_file = out_file + ".bak%s" % (datetime.datetime.now().strftime("%Y%m%d_%H%M"))
             shutil.copy(out_file, bak_file)
-    if tooldir:
-        java_basedir = os.path.join(tooldir, "share", "java")
+    java_basedir = os.path.join(tooldir, "share", "java") if tooldir else None
+    cores, memory = _get_host_resources()
+    out_txt = _set_host_resources(_rewrite_system_config_lines(_read_system_config(base_url), java_basedir),
+                                  cores, memory)
+    tx_file = "%s.tx%s" % (out_file, os.getpid())
+    with open(tx_file, "w") as out_handle:
+        out_handle.write(out_txt)
+    os.rename(tx_file, out_file)
+    return out_file
+
+def _read_system_config(base_url):
+    local_file = os.path.join(os.path.dirname(os.path.abspath(__file__)), "config", os.path.basename(base_url))
+    if os.path.exists(local_file):
+        with open(local_file) as in_handle:
+            return in_handle.read()
+    if dlcache is not None:
+        return dlcache.read(base_url).decode("utf-8")
+    with contextlib.closing(urllib_request.urlopen(base_url, timeout=60)) as in_handle:
+        return in_handle.read().decode("utf-8")
+
+def _get_host_resources():
+    """Usable cores and memory, in Mb, of this machine from the bcbio host profile.
+
+    The profile takes cgroup CPU and memory limits into account. Returns
+    None values when bcbio is not yet importable, leaving resources as
+    they are.
+    """
+    try:
+        from bcbio import hostprofile
+    except ImportError:
+        return None, None
+    host = hostprofile.profile()
+    memory = int(host["memory"] * 1024 * hostprofile.MEMORY_FRACTION) if host.get("memory") else None
+    return host.get("cores"), memory
+
+def _to_mb(val):
+    val = str(val).strip().lower().rstrip("b")
+    scale = {"k": 1.0 / 1024, "m": 1, "g": 1024, "t": 1024 * 1024}
+    if val and val[-1] in scale:
+        return float(val[:-1]) * scale[val[-1]]
+    return float(val) * 1024
+
+def _indent(line):
+    return len(line) - len(line.lstrip(" "))
+
+def _is_content(line):
+    return line.strip() and not line.strip().startswith("#")
+
+def _default_resources_block(lines):
+    """Find the `resources: default:` block, adding empty sections when missing.
 
+    Returns the lines, the index of the `default:` line, the end of its block
+    and the indentation of its keys.
+    """
+    res_i = None
+    for i, line in enumerate(lines):
+        if line.startswith("resources:"):
+            res_i = i
+    if res_i is None:
+        if lines and not lines[-1].endswith("\n"):
+            lines[-1] += "\n"
+        lines += ["resources:\n"]
+        res_i = len(lines) - 1
+    res_end = len(lines)
+    prog_indent = None
+    default_i = None
+    for i in range(res_i + 1, len(lines)):
+        if not _is_content(lines[i]):
+            continue
+        if _indent(lines[i]) == 0:
+            res_end = i
+            break
+        prog_indent = prog_indent or _indent(lines[i])
+        if _indent(lines[i]) == prog_indent and lines[i].strip().split("#")[0].strip() == "default:":
+            default_i = i
+    if default_i is None:
+        prog_indent = prog_indent or 2
+        lines.insert(res_i + 1, "%sdefault:\n" % (" " * prog_indent))
+        default_i = res_i + 1
+        res_end += 1
+    end = res_end
+    key_indent = None
+    for i in range(default_i + 1, res_end):
+        if not _is_content(lines[i]):
+            continue
+        if _indent(lines[i]) <= prog_indent:
+            end = i
+            break
+        key_indent = key_indent or _indent(lines[i])
+    # Finish before trailing comments and blank lines, which belong to the next section
+    while end > default_i + 1 and not _is_content(lines[end - 1]):
+        end -= 1
+    return lines, default_i, end, key_indent or prog_indent + 2
+
+def _set_host_resources(in_txt, cores=None, memory=None):
+    """Limit default cores and per core memory to those available on this machine.
+
+    Edits only the `cores` and `memory` lines of `resources: default:`,
+    adding them when missing. `memory` is usable memory in Mb.
+    """
+    if not cores and not memory:
+        return in_txt
+    lines, default_i, end, key_indent = _default_resources_block(in_txt.splitlines(True))
+    key_re = re.compile(r"^(?P<start>\s+(?P<key>cores|memory):[ \t]*)(?P<val>[^\s#]+)?(?P<rest>.*)$", re.DOTALL)
+    found = {}
+    for i in range(default_i + 1, end):
+        m = key_re.match(lines[i])
+        if m and _indent(lines[i]) == key_indent:
+            found[m.group("key")] = (i, m)
+    cur_cores = found["cores"][1].group("val") if "cores" in found else None
+    cur_memory = found["memory"][1].group("val") if "memory" in found else None
+    new = {}
+    if cores:
+        new["cores"] = min(int(cur_cores or cores), cores)
+    final_cores = new.get("cores") or (int(cur_cores) if cur_cores else None)
+    if memory and final_cores:
+        per_core = int(memory / final_cores)
+        if not cur_memory or _to_mb(cur_memory) > per_core:
+            new["memory"] = "%sM" % per_core
+    for key in ["cores", "memory"]:
+        if key not in new:
+            continue
+        if key in found:
+            i, m = found[key]
+            start = m.group("start") if m.group("val") else m.group("start").rstrip(" \t") + " "
+            lines[i] = "%s%s%s" % (start, new[key], m.group("rest"))
+        else:
+            lines.insert(end, "%s%s: %s\n" % (" " * key_indent, key, new[key]))
+            end += 1
+    return "".join(lines)
+
+def _rewrite_system_config_lines(in_txt, java_basedir):
+    """Rewrite program directories line by line, commenting out the unused galaxy section.
+    """
     rewrite_ignore = ("log",)
-    with contextlib.closing(urllib_request.urlopen(base_url)) as in_handle:
-        with open(out_file, "w") as out_handle:
-            in_resources = False
+    out = []
+    in_resources = False
+    in_galaxy = False
+    in_prog = None
+    for line in in_txt.splitlines(True):
+        if not _is_content(line):
+            pass
+        elif line[0] != " ":
+            in_resources = line.startswith("resources")
+            in_galaxy = line.startswith("galaxy")
             in_prog = None
-            for line in (l.decode("utf-8") for l in in_handle):
-                if line[0] != " ":
-                    in_resources = line.startswith("resources")
-                    in_prog = None
-                elif (in_resources and line[:2] == "  " and line[2] != " "
-                    and not line.strip().startswith(rewrite_ignore)):
-                    in_prog = line.split(":")[0].strip()
-
-                elif line.strip().startswith("dir:") and in_prog and in_prog not in ["log", "tmp"]:
-                    final_dir = os.path.basename(line.split()[-1])
-                    if tooldir:
-                        line = "%s: %s\n" % (line.split(":")[0],
-                                             os.path.join(java_basedir, final_dir))
-                    in_prog = None
-                elif line.startswith("galaxy"):
-                    line = "# %s" % line
-                out_handle.write(line)
-
-        return out_file
+        elif (in_resources and line[:2] == "  " and line[2] != " "
+                and not line.strip().startswith(rewrite_ignore)):
+            in_prog = line.split(":")[0].strip()
+        elif line.strip().startswith("dir:") and in_prog and in_prog not in ["log", "tmp"]:
+            final_dir = os.path.basename(line.split()[-1])
+            if java_basedir:
+                line = "%s: %s\n" % (line.split(":")[0], os.path.join(java_basedir, final_dir))
+            in_prog = None
+        if in_galaxy and _is_content(line):
+            line = "# %s" % line
+        out.append(line)
+    return "".join(out)
+
 def install_anaconda_python(args):
     anaconda_dir = os.path.join(args.datadir, "anaconda")
     bindir = os.path.join(anaconda_dir, "bin")
@@ -98,13 +244,27 @@ def install_anaconda_python(args):
         dist = _guess_distribution()
         url = REMOTES['anaconda'] %("MacOSX" if dist.lower() == "macosx" else "Linux")
         if not os.path.exists(os.path.basename(url)):
-            subprocess.check_call(['wget', "--progress=dot:mega", "--no-check-certificate", url])
+            _download(url)
         subprocess.check_call("bash %s -b -p %s"%(os.path.basename(url), anaconda_dir), shell=True )
     return  {"conda": conda,
             "pip": os.path.join(bindir, "pip"),
             "dir": anaconda_dir}
 
 
+def _download(url):
+    """Download a URL into the current directory, through the shared download cache when available.
+    """
+    out_file = os.path.basename(url)
+    if dlcache is not None:
+        dlcache.fetch(url, out_file)
+    else:
+        tx_file = out_file + ".part"
+        with contextlib.closing(urllib_request.urlopen(url)) as in_handle:
+            with open(tx_file, "wb") as out_handle:
+                shutil.copyfileobj(in_handle, out_handle, 1024 * 1024)
+        os.rename(tx_file, out_file)
+    return out_file
+
 def install_conda_pkgs(anaconda, args):
     env = dict(os.environ)
     # Try to avoid user specific pkgs and envs directories
@@ -113,7 +273,7 @@ def install_conda_pkgs(anaconda, args):
     env['CONDA_ENVS_DIRS'] = os.path.join(anaconda['dir'], 'envs')
 
     if not os.path.exists((os.path.basename(REMOTES['requirements']))):
-        subprocess.check_call(['wget', '--no-check-certificate', REMOTES['requirements']])
+        _download(REMOTES['requirements'])
 
 
     channels = _get_conda_channels(anaconda['conda'])
@@ -3,6 +3,9 @@ import os,sys
 import yaml,json
 import collections
 import subprocess
+import re
+import threading
+from concurrent import futures
 
 
 ENV_PY_VERSIONS = collections.defaultdict(lambda: "python=3.6")
@@ -12,38 +15,183 @@ ENV_PY_VERSIONS["python3"] = "python=3.6"
 ENV_PY_VERSIONS["dv"] = "python=2"
 ENV_PY_VERSIONS["samtools0"] = "python=2"
 
-def install_in(conda_bin, system_installdir, config_file=None, packages=None):
-    if config_file is None and packages is None:
-        packeages = []
+# Parsed package YAML files, keyed by absolute path: ((mtime, size), data)
+_PARSED_YAML = {}
+
+class CondaState(object):
+    """Snapshot of conda environments, channels and installed packages.
+
+    Environments and channels come from a single `conda info --json` call and
+    packages are listed once per environment, on first use. Creates, installs
+    and removes run through this object update the snapshot in place, so
+    later checks do not need to start conda again. Packages recorded from our
+    own installs have no channel and match any channel filter.
+
+    Safe to share between threads running installs into separate environments.
+    """
+    def __init__(self, conda_bin):
+        self.conda_bin = conda_bin
+        self._lock = threading.RLock()
+        info = json.loads(subprocess.check_output("{conda_bin} info --json".format(**locals()), shell=True))
+        self.prefix = info["conda_prefix"]
+        self.channels = info.get("channels", [])
+        self.envs = [e for e in info["envs"] if e.startswith(self.prefix)]
+        self._packages = {}
+
+    def env_dir(self, env_name=None):
+        """Directory of a named environment, or the base environment for None.
+        """
+        if env_name is None:
+            return self.prefix
+        for x in self.envs:
+            if x.endswith("/%s" % env_name):
+                return x
+
+    def packages(self, env_name=None):
+        """Installed packages in an environment, as `conda list --json` dictionaries.
+        """
+        with self._lock:
+            if env_name not in self._packages:
+                env_str = "-n %s" % env_name if env_name else ""
+                conda_bin = self.conda_bin
+                self._packages[env_name] = dict((x["name"], x) for x in json.loads(
+                    subprocess.check_output("{conda_bin} list --json {env_str}".format(**locals()), shell=True)))
+            return list(self._packages[env_name].values())
+
+    def package_names(self, env_name=None, channels=None):
+        return [x["name"] for x in self.packages(env_name)
+                if channels is None or x.get("channel") is None or x.get("channel") in channels]
+
+    def create(self, env_name, specs):
+        conda_bin = self.conda_bin
+        specs_str = " ".join(["'%s'" % x for x in specs])
+        subprocess.check_call("{conda_bin} create --no-default -y --name {env_name} {specs_str}"
+                              .format(**locals()), shell=True)
+        env_dir = os.path.join(self.prefix, "envs", env_name)
+        with self._lock:
+            if env_dir not in self.envs:
+                self.envs.append(env_dir)
+            self._packages[env_name] = {}
+            self._record(env_name, specs)
+        return env_dir
+
+    def install(self, specs, env_name=None, channels=None, installer=None):
+        """Install package specs into an environment, with conda or a compatible installer.
+        """
+        installer = installer or self.conda_bin
+        env_str = "-n %s" % env_name if env_name else ""
+        channels_str = " ".join(["-c %s" % x for x in channels or []])
+        specs_str = " ".join(["'%s'" % x for x in specs])
+        subprocess.check_call("{installer} install -y {env_str} {channels_str} {specs_str}"
+                              .format(**locals()), shell=True)
+        self._record(env_name, specs)
+
+    def download(self, specs, env_name, channels=None):
+        """Download and extract the packages an environment needs into the package cache.
+
+        Nothing is installed, so later installs only link from the cache.
+        """
+        conda_bin = self.conda_bin
+        action = "install" if self.env_dir(env_name) else "create"
+        channels_str = " ".join(["-c %s" % x for x in channels or []])
+        specs_str = " ".join(["'%s'" % x for x in specs])
+        subprocess.check_call("{conda_bin} {action} --download-only -y --name {env_name} {channels_str} {specs_str}"
+                              .format(**locals()), shell=True)
+
+    def remove(self, names, env_name=None, channels=None):
+        conda_bin = self.conda_bin
+        env_str = "-n %s" % env_name if env_name else ""
+        channels_str = " ".join(["-c %s" % x for x in channels or []])
+        names_str = " ".join(names)
+        subprocess.check_call("{conda_bin} remove {env_str} {channels_str} -y {names_str}"
+                              .format(**locals()), shell=True)
+        with self._lock:
+            if env_name in self._packages:
+                for name in names:
+                    self._packages[env_name].pop(name, None)
+
+    def _record(self, env_name, specs):
+        with self._lock:
+            if env_name in self._packages:
+                for spec in specs:
+                    name = re.split(r"[=<>!\s]", spec.strip("'"))[0]
+                    self._packages[env_name][name] = {"name": name, "channel": None}
+
+def install_in(conda_bin, system_installdir, config_file=None, packages=None, max_workers=4):
+    """Install packages into the base and named conda environments.
+
+    The base environment is installed first. Packages for the named
+    environments are then downloaded into the package cache one environment
+    at a time, since environments like python2, dv and samtools0 need the same
+    packages and conda does not guard concurrent writes of one package to the
+    cache. The named environments are then installed from the cache, up to
+    `max_workers` at once.
+    """
+    if config_file is None:
+        packages = packages or []
         check_channels = []
     else:
         (packages, _) = _yaml_to_packages(config_file)
-        with open(config_file) as in_handle:
-            check_channels = yaml.safe_load(in_handle).get("channnels", [])
-    channels = " ".join(["-c %s"%x for x in check_channels ])
-    conda_envs = _create_environment(conda_bin, packeages)
-    # for env_dir in conda_envs.values():
-    #     _clean_environment(env_dir)
-    conda_info = json.loads(subprocess.check_output("{conda_bin} info --json".format(**locals()), shell=True))
+        check_channels = _load_yaml(config_file).get("channels", [])
+    state = CondaState(conda_bin)
+    env_packages = _split_by_condaenv(packages)
     problems = ["r-tximport", "py2cairo"]
-    for env_name, env_packages in _split_by_condaenv(packages):
+    for env_name, ps in env_packages:
         if env_name:
-            problems += env_packages
+            problems += ps
 
     if problems:
         print("Checking for problematic or migrated packages in default environment")
-        cur_packages = [x["name"] for x in
-                        json.loads(subprocess.check_output("%s list --json" % (conda_bin), shell=True))
-                        if x["name"] in problems and x["channel"] in check_channels]
+        cur_packages = [x for x in state.package_names(None, check_channels) if x in problems]
         if cur_packages:
             print("Found packages that moved from default environment: %s" % ", ".join(cur_packages))
-            problems = " ".join(cur_packages)
-            subprocess.check_call("{conda_bin} remove {channels} -y {problems}".format(**locals()), shell=True)
+            state.remove(cur_packages, channels=check_channels)
+
+    # Named environments are created from the base conda and mamba, so the base
+    # install finishes before they start
+    _initial_base_install(state, [ps for (n, ps) in env_packages if n is None][0], check_channels)
+    if max_workers > 1:
+        for env_name, ps in env_packages:
+            if env_name:
+                state.download(_environment_specs(state, env_name, ps), env_name, check_channels)
+    jobs = [(_install_environment, [state, env_name, ps, check_channels])
+            for env_name, ps in env_packages if env_name]
+    _run_concurrently(jobs, max_workers)
+
+
+def _run_concurrently(jobs, max_workers):
+    """Run (fn, args) jobs on a thread pool, raising the first failure once all finish.
+    """
+    if max_workers <= 1 or len(jobs) <= 1:
+        for fn, args in jobs:
+            fn(*args)
+        return
+    with futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        fs = [executor.submit(fn, *args) for fn, args in jobs]
+    for f in fs:
+        f.result()
+
+
+def _environment_specs(state, env_name, env_packages):
+    """Package specs a named environment is created and installed with.
+    """
+    specs = [ENV_PY_VERSIONS[env_name]] + sorted(env_packages)
+    if not state.env_dir(env_name):
+        specs.append("nomkl")
+    return specs
+
 
-    _initial_base_install(conda_bin, [ps for (n, ps) in _split_by_condaenv(packages) if n is None][0], check_channels)
+def _install_environment(state, env_name, env_packages, check_channels):
+    """Create a named environment if missing and install its packages.
+    """
+    if not state.env_dir(env_name):
+        print("Creating conda environment: %s" % env_name)
+        state.create(env_name, [ENV_PY_VERSIONS[env_name], "nomkl"])
+    print("Installing packages into %s environment" % env_name)
+    state.install([ENV_PY_VERSIONS[env_name]] + sorted(env_packages), env_name, check_channels)
 
 
-def _initial_base_install(conda_bin, env_packages, check_channels):
+def _initial_base_install(state, env_packages, check_channels):
     """Provide a faster initial installation of base packages, avoiding dependency issues.
 
     Uses mamba (https://github.com/QuantStack/mamba) to provide quicker package resolution
@@ -52,25 +200,18 @@ def _initial_base_install(conda_bin, env_packages, check_channels):
     """
     initial_package_targets = {None: ["r-base"]}
     env_name = None
-    env_str = ""
-    channels = " ".join(["-c %s" % x for x in check_channels])
-    cur_ps = [x["name"] for x in
-              json.loads(subprocess.check_output("{conda_bin} list --json {env_str}".format(**locals()), shell=True))
-              if x["channel"] in check_channels]
+    cur_ps = state.package_names(env_name, check_channels)
     have_package_targets = env_name in initial_package_targets and any([p for p in cur_ps
                                                                         if p in initial_package_targets[env_name]])
     if not have_package_targets:
         print("Initalling initial set of packages for %s environment with mamba" % (env_name or "default"))
         py_version = ENV_PY_VERSIONS[env_name]
-        pkgs_str = " ".join(["'%s'" % x for x in sorted(env_packages)])
         if "mamba" not in cur_ps:
-            subprocess.check_call("{conda_bin} install -y {env_str} {channels} "
-                                  "{py_version} mamba".format(**locals()), shell=True)
-        mamba_bin = os.path.join(os.path.dirname(conda_bin), "mamba")
-        pkgs_str = " ".join(["'%s'" % x for x in sorted(env_packages)])
+            state.install([py_version, "mamba"], env_name, check_channels)
+        mamba_bin = os.path.join(os.path.dirname(state.conda_bin), "mamba")
         try:
-            subprocess.check_call("{mamba_bin} install -y {env_str} {channels} "
-                                  "{py_version} {pkgs_str}".format(**locals()), shell=True)
+            state.install([py_version] + sorted(env_packages), env_name, check_channels,
+                          installer=mamba_bin)
         except subprocess.CalledProcessError:
             # Fall back to standard conda install when we have system specific issues
             # https://github.com/bcbio/bcbio-nextgen/issues/2871
@@ -80,44 +221,37 @@ def _initial_base_install(conda_bin, env_packages, check_channels):
 def _clean_environment(env_dir):
     pass
 
-def _create_environment(conda_bin, packages):
-    env_names = set([e for e,ps in _split_by_condaenv(packeages) if e])
-    out = {}
-    conda_envs = _get_conda_envs(conda_bin)
-    for addenv in ["python3", "samtools0", "dv", "python2"]:
-        if addenv in env_names:
-            if not any(x.endswith("/%s"%addenv ) for x in conda_envs):
-                print("Creating conda environment: %s"%addenv )
-                py_version = ENV_PY_VERSIONS[addenv]
-                subprocess.check_call("{conda_bin} create --no-default -y --name {addenv} {py_version} nomkl"
-                                      .format(**locals()), shell=True)
-                conda_envs = _get_conda_envs(conda_bin)
-            out[addenv] = [x for x in conda_envs if x.endswith("/%s"%addenv )][0]
-    return out
-
-def _get_conda_envs(conda_bin):
-    info = json.loads(subprocess.check_output("{conda_bin} info --envs --json".format(conda_bin = conda_bin),shell=True))
-    return [e for e in info['envs'] if e.startswith(info["conda_prefix"])]
+def _load_yaml(yaml_file):
+    """Parse a YAML file once, reusing the parsed data until the file changes.
+
+    Callers share the returned data and must not modify it.
+    """
+    key = os.path.abspath(yaml_file)
+    stat = os.stat(key)
+    stamp = (stat.st_mtime, stat.st_size)
+    cached = _PARSED_YAML.get(key)
+    if cached is None or cached[0] != stamp:
+        print("Reading packages from %s" % yaml_file)
+        with open(yaml_file) as in_handle:
+            data = yaml.load(in_handle, Loader=getattr(yaml, "CSafeLoader", yaml.SafeLoader))
+        cached = (stamp, data if data is not None else {})
+        _PARSED_YAML[key] = cached
+    return cached[1]
 
 def _yaml_to_packages(yaml_file, to_install=None, subs_yaml_file=None, namesort=True, env=None):
-    print("Reading packages from %s" % yaml_file)
-    with open(yaml_file) as in_handle:
-        full_data = yaml.load(in_handle)
-        if full_data is None:
-            full_data = {}
-    if subs_yaml_file is not None:
-        with open(subs_yaml_file) as in_handle:
-            subs = yaml.load(in_handle)
-    else:
-        subs = {}
+    full_data = _load_yaml(yaml_file)
+    subs = _load_yaml(subs_yaml_file) if subs_yaml_file is not None else {}
 
     data = [(k, v) for k,v in full_data.items()
             if (to_install is None or k in to_install) and k not in ['channels']]
     data.sort()
     packages = []
     pkg_to_group = dict()
-    while len(data) > 0:
-        cur_key , cur_info = data.pop(0)
+    # Depth first walk of nested groups. The end of the stack is the next item to
+    # process, so nested values are pushed in order and the last is handled first.
+    stack = data[::-1]
+    while stack:
+        cur_key , cur_info = stack.pop()
         if cur_info:
             if isinstance(cur_info, (list , tuple)):
                 packages.extend(_filter_subs_packages(cur_info, subs, namesort))
@@ -125,7 +259,7 @@ def _yaml_to_packages(yaml_file, to_install=None, subs_yaml_file=None, namesort=
                     pkg_to_group[p] = cur_key
             elif isinstance(cur_info, dict):
                 for key,val in cur_info.items():
-                    data.insert(0, (cur_key, val))
+                    stack.append((cur_key, val))
             else:
                 raise ValueError(cur_info)
     return packages, pkg_to_group
@@ -146,7 +280,7 @@ def _filter_subs_packages(initial, subs, namesort = True):
 def _split_by_condaenv(packages):
     out = collections.defaultdict(list)
     envs = set()
-    for p in packeages:
+    for p in packages:
         parts = p.split(";")
         package_name = parts[0]
         env_name = parts[1:]
@@ -158,11 +292,3 @@ def _split_by_condaenv(packages):
         out[condaenv].append(package_name)
     envs = [None] + sorted(x for x in list(envs) if x)
     return [(e, out[e]) for e in envs]
-
-if __name__ == '__main__':
-    # with open("packages-conda.yaml") as in_handle:
-    #     config_file = yaml.load(in_handle)
-    #     print(config_file)
-    packeages , pkg_to_group = _yaml_to_packages("packages-conda.yaml")
-    print(packeages)
-    print(pkg_to_group)
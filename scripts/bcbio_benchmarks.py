@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+"""Timing benchmarks for install and sample preparation code paths.
+
+Run from the top level of a checkout:
+
+    python scripts/bcbio_benchmarks.py conda-packages
+"""
+from __future__ import print_function
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def conda_packages(num_packages=10000, group_size=1):
+    """Time package extraction from a synthetic conda manifest with nested groups.
+
+    Compares the stack based walk with the previous list front insertion
+    approach and shows the effect of reusing the parsed file.
+    """
+    import yaml
+    from cloudbio import conda
+    manifest = {"channels": ["conda-forge", "bioconda"]}
+    for i in range(0, num_packages, group_size * 2):
+        manifest["group%05d" % i] = {"a": ["pkg%05d" % j for j in range(i, i + group_size)],
+                                     "b": {"nested": ["pkg%05d;env=python3" % j
+                                                      for j in range(i + group_size, i + 2 * group_size)]}}
+    with tempfile.NamedTemporaryFile(mode="w", suffix=".yaml", delete=False) as out_handle:
+        yaml.safe_dump(manifest, out_handle, default_flow_style=False)
+        yaml_file = out_handle.name
+
+    def old_walk(data):
+        data = list(data)
+        packages = []
+        while len(data) > 0:
+            cur_key, cur_info = data.pop(0)
+            if isinstance(cur_info, (list, tuple)):
+                packages.extend(conda._filter_subs_packages(cur_info, {}))
+            elif isinstance(cur_info, dict):
+                for val in cur_info.values():
+                    data.insert(0, (cur_key, val))
+        return packages
+    try:
+        start = time.time()
+        packages, _ = conda._yaml_to_packages(yaml_file)
+        first = time.time() - start
+        start = time.time()
+        packages, _ = conda._yaml_to_packages(yaml_file)
+        cached = time.time() - start
+        data = sorted((k, v) for k, v in conda._load_yaml(yaml_file).items() if k != "channels")
+        start = time.time()
+        assert sorted(old_walk(data)) == sorted(packages)
+        old = time.time() - start
+    finally:
+        os.remove(yaml_file)
+    print("%s packages in %s groups" % (len(packages), len(data)))
+    print("Parse and walk: %.3fs; walk with cached parse: %.4fs; previous walk: %.4fs"
+          % (first, cached, old))
+
+
+def fastq_pairs(num_samples=50000):
+    """Time fastq pair matching on synthetic Illumina style file names.
+    """
+    from bcbio.bam import fastq
+    schemes = ["{s}_S{n}_L00{lane}_R{r}_001.fastq.gz", "{s}_{r}.fq.gz", "{s}.R{r}.fastq.bz2", "{s}-{r}.fq"]
+    files = []
+    for i in range(num_samples):
+        scheme = schemes[i % len(schemes)]
+        for r in [1, 2]:
+            files.append(os.path.join("/data/run%s" % (i % 7), scheme.format(s="sample%s" % i, n=i % 96 + 1,
+                                                                            lane=i % 4 + 1, r=r)))
+    start = time.time()
+    matches = fastq.match_pairs(files)
+    elapsed = time.time() - start
+    assert len(matches.groups) == num_samples, len(matches.groups)
+    print("Matched %s files into %s pairs in %.2fs, %s orphans, %s ambiguous"
+          % (len(files), len(matches.groups), elapsed, len(matches.orphans), len(matches.ambiguous)))
+
+
+def write_config(num_samples=20000, files_per_sample=4):
+    """Compare streaming sample YAML output with building the full config then dumping it.
+    """
+    import shutil
+    import tracemalloc
+    import yaml
+    from bcbio.workflow import template
+
+    def make_items():
+        for i in range(num_samples):
+            yield {"description": "sample%s" % i, "analysis": "variant2", "genome_build": "hg38",
+                   "files": ["/data/sample%s_L00%s_R1.fq.gz" % (i, j) for j in range(files_per_sample)],
+                   "metadata": {"batch": "batch%s" % (i % 100), "phenotype": "tumor"},
+                   "algorithm": {"aligner": "bwa", "variantcaller": ["gatk-haplotype", "freebayes"]}}
+    config_template = {"details": [], "upload": {"dir": "../final"}}
+    work_dir = tempfile.mkdtemp()
+    try:
+        for name in ["stream", "full"]:
+            tracemalloc.start()
+            start = time.time()
+            if name == "stream":
+                template._write_config_file(make_items(), {}, config_template, name, work_dir)
+            else:
+                out = {"fc_name": name, "upload": {"dir": "../final"}, "details": list(make_items())}
+                with open(os.path.join(work_dir, "%s.yaml" % name), "w") as out_handle:
+                    yaml.safe_dump(out, out_handle, default_flow_style=False, allow_unicode=False)
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            print("%s: %.1fs, peak memory %.1fMb" % (name, time.time() - start, peak / 1024.0 / 1024.0))
+    finally:
+        shutil.rmtree(work_dir)
+
+
+BENCHMARKS = {"conda-packages": conda_packages,
+              "fastq-pairs": fastq_pairs,
+              "write-config": write_config}
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Timing benchmarks for bcbio code paths.")
+    parser.add_argument("benchmark", choices=sorted(BENCHMARKS.keys()))
+    args = parser.parse_args()
+    BENCHMARKS[args.benchmark]()
@@ -0,0 +1,80 @@
+import os
+import sys
+import email.utils
+import hashlib
+import threading
+from http.server import ThreadingHTTPServer, SimpleHTTPRequestHandler
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+class _RangeHandler(SimpleHTTPRequestHandler):
+    """Serve files from the server directory with Range, ETag and Last-Modified support.
+    """
+    def log_message(self, *args):
+        pass
+
+    def do_HEAD(self):
+        self._serve(send_body=False)
+
+    def do_GET(self):
+        self._serve(send_body=True)
+
+    def _serve(self, send_body):
+        server = self.server
+        with server.lock:
+            server.requests.append((self.command, self.path, dict(self.headers)))
+        fname = os.path.join(server.root, self.path.lstrip("/").split("?")[0])
+        if not os.path.isfile(fname):
+            self.send_error(404)
+            return
+        with open(fname, "rb") as in_handle:
+            data = in_handle.read()
+        etag = '"%s"' % hashlib.md5(data).hexdigest()
+        last_modified = email.utils.formatdate(os.path.getmtime(fname), usegmt=True)
+        if self.headers.get("If-None-Match") == etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+        start = 0
+        status = 200
+        range_header = self.headers.get("Range")
+        if range_header and not server.ignore_range:
+            start = int(range_header.split("=")[1].split("-")[0])
+            if start >= len(data):
+                self.send_response(416)
+                self.send_header("Content-Range", "bytes */%s" % len(data))
+                self.end_headers()
+                return
+            status = 206
+        self.send_response(status)
+        if status == 206:
+            self.send_header("Content-Range", "bytes %s-%s/%s" % (start, len(data) - 1, len(data)))
+        self.send_header("Content-Length", str(len(data) - start))
+        self.send_header("ETag", etag)
+        self.send_header("Last-Modified", last_modified)
+        self.end_headers()
+        if send_body:
+            self.wfile.write(data[start:])
+
+
+@pytest.fixture
+def http_server(tmpdir):
+    """Local HTTP server for the files in its `root` directory, recording requests.
+
+    Set `ignore_range` to answer Range requests with the whole file.
+    """
+    server = ThreadingHTTPServer(("127.0.0.1", 0), _RangeHandler)
+    server.root = str(tmpdir.mkdir("www"))
+    server.requests = []
+    server.lock = threading.Lock()
+    server.ignore_range = False
+    server.url = "http://127.0.0.1:%s" % server.server_address[1]
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
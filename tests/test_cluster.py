@@ -0,0 +1,172 @@
+"""Cluster job arrays, run with the local stand in scheduler.
+"""
+import os
+import subprocess
+import threading
+import time
+
+import pytest
+
+from bcbio.distributed import cluster
+
+
+def _parallel(**kwargs):
+    parallel = {"type": "ipython", "scheduler": "slurm", "run_local": True, "cores": 2, "tag": "test"}
+    parallel.update(kwargs)
+    return parallel
+
+
+def test_map_runs_array_elements(tmpdir):
+    with cluster.ClusterScheduler(_parallel(), work_dir=str(tmpdir.join("my cluster")),
+                                  poll_interval=0.1) as scheduler:
+        assert scheduler.map("operator:add", [[1, 2], [3, 4]]) == [3, 7]
+
+
+def test_failed_elements_raise(tmpdir):
+    with pytest.raises(cluster.ClusterTaskError):
+        with cluster.ClusterScheduler(_parallel(), work_dir=str(tmpdir), poll_interval=0.1) as scheduler:
+            scheduler.map("operator:truediv", [[1, 0]])
+
+
+def test_submission_failure_fails_tasks(tmpdir):
+    def broken_submit(script):
+        raise subprocess.CalledProcessError(1, ["sbatch", script])
+    scheduler = cluster.ClusterScheduler(_parallel(), work_dir=str(tmpdir), poll_interval=0.1)
+    scheduler.scheduler.submit = broken_submit
+    result = {}
+
+    def run():
+        try:
+            scheduler.map("operator:add", [[1, 2], [3, 4]])
+        except Exception as e:
+            result["error"] = e
+    thread = threading.Thread(target=run)
+    thread.daemon = True
+    thread.start()
+    thread.join(30)
+    assert not thread.is_alive(), "map hung after a failed submission"
+    assert isinstance(result["error"], subprocess.CalledProcessError)
+    scheduler.shutdown()
+
+
+def test_local_cancel_stops_running_elements(tmpdir):
+    local = cluster.Local(max_cores=1)
+    array_dir = str(tmpdir)
+    os.makedirs(os.path.join(array_dir, "log"))
+    script = os.path.join(array_dir, "job.sh")
+    with open(script, "w") as out_handle:
+        out_handle.write("# job size=3 cores=1 memory=0\nsleep 30\ntouch %s/done-$BCBIO_ARRAY_INDEX\n" % array_dir)
+    job_id = local.submit(script)
+    time.sleep(0.5)
+    local.cancel([job_id])
+    local._jobs[job_id].join(10)
+    assert not local.active([job_id])
+    assert not [x for x in os.listdir(array_dir) if x.startswith("done-")]
+
+
+_FAKE_BSUB = """#!{python}
+import os, re, subprocess, sys
+state_dir = os.environ["FAKE_LSF_DIR"]
+script = sys.stdin.read()
+job_id = str(101 + len([x for x in os.listdir(state_dir) if x.endswith(".state")]))
+size = int(re.search(r"\\[1-(\\d+)\\]", script).group(1))
+mode = os.environ["FAKE_LSF_MODES"].split(",")[int(job_id) - 101]
+if mode == "run":
+    for i in range(1, size + 1):
+        subprocess.check_call(["bash", "-c", script], env=dict(os.environ, LSB_JOBINDEX=str(i)))
+with open(os.path.join(state_dir, job_id + ".state"), "w") as out_handle:
+    out_handle.write({{"run": "DONE", "kill": "EXIT", "pend": "PEND"}}[mode])
+print("Job <%s> is submitted to default queue <normal>." % job_id)
+"""
+
+_FAKE_BJOBS = """#!{python}
+import os, sys
+state_dir = os.environ["FAKE_LSF_DIR"]
+missing = False
+for job_id in [x for x in sys.argv[1:] if x.isdigit()]:
+    state_file = os.path.join(state_dir, job_id + ".state")
+    if os.path.exists(state_file):
+        with open(state_file) as in_handle:
+            print("%s %s" % (job_id, in_handle.read()))
+    else:
+        sys.stderr.write("Job <%s> is not found\\n" % job_id)
+        missing = True
+sys.exit(255 if missing else 0)
+"""
+
+_FAKE_BKILL = """#!{python}
+import os, sys
+with open(os.path.join(os.environ["FAKE_LSF_DIR"], "killed"), "a") as out_handle:
+    out_handle.write(" ".join(sys.argv[1:]) + "\\n")
+"""
+
+
+def _fake_lsf(tmpdir, monkeypatch, modes):
+    import sys
+    bin_dir = tmpdir.mkdir("bin")
+    for name, text in [("bsub", _FAKE_BSUB), ("bjobs", _FAKE_BJOBS), ("bkill", _FAKE_BKILL)]:
+        bin_dir.join(name).write(text.format(python=sys.executable))
+        bin_dir.join(name).chmod(0o755)
+    state_dir = tmpdir.mkdir("lsf")
+    monkeypatch.setenv("PATH", "%s:%s" % (bin_dir, os.environ["PATH"]))
+    monkeypatch.setenv("FAKE_LSF_DIR", str(state_dir))
+    monkeypatch.setenv("FAKE_LSF_MODES", ",".join(modes))
+    return state_dir
+
+
+def _lsf_parallel(**kwargs):
+    return _parallel(scheduler="lsf", run_local=False, **kwargs)
+
+
+def test_killed_elements_are_retried(tmpdir, monkeypatch):
+    _fake_lsf(tmpdir, monkeypatch, ["kill", "run"])
+    with cluster.ClusterScheduler(_lsf_parallel(retries=1), work_dir=str(tmpdir.join("work")),
+                                  poll_interval=0.1) as scheduler:
+        fs = [scheduler.submit("operator:add", [1, 2]), scheduler.submit("operator:add", [3, 4])]
+        assert [f.result(timeout=60) for f in fs] == [3, 7]
+
+
+def test_killed_elements_fail_without_retries(tmpdir, monkeypatch):
+    _fake_lsf(tmpdir, monkeypatch, ["kill"])
+    with cluster.ClusterScheduler(_lsf_parallel(), work_dir=str(tmpdir.join("work")),
+                                  poll_interval=0.1) as scheduler:
+        f = scheduler.submit("operator:add", [1, 2])
+        with pytest.raises(cluster.ClusterTaskError):
+            f.result(timeout=60)
+
+
+def test_arrays_not_started_by_timeout_are_cancelled(tmpdir, monkeypatch):
+    state_dir = _fake_lsf(tmpdir, monkeypatch, ["pend"])
+    with cluster.ClusterScheduler(_lsf_parallel(timeout=0.02), work_dir=str(tmpdir.join("work")),
+                                  poll_interval=0.1) as scheduler:
+        f = scheduler.submit("operator:add", [1, 2])
+        with pytest.raises(cluster.ClusterTimeout):
+            f.result(timeout=60)
+    assert state_dir.join("killed").read().split() == ["101"]
+
+
+@pytest.mark.parametrize("name, out, err", [
+    ("torque", "Job ID                    Name             User            Time Use S Queue\n"
+               "------------------------- ---------------- --------------- -------- - -----\n"
+               "101[1].server             test-add-1       user            00:00:01 C batch\n"
+               "102[1].server             test-add-2       user            00:00:01 R batch\n",
+     "qstat: Unknown Job Id 103[].server\n"),
+    ("pbspro", "Job id            Name             User              Time Use S Queue\n"
+               "----------------  ---------------- ----------------  -------- - -----\n"
+               "101[].server      test-add-1       user                     0 F workq\n"
+               "102[].server      test-add-2       user                     0 B workq\n"
+               "102[1].server     test-add-2       user                     0 R workq\n",
+     "qstat: Unknown Job Id 103[].server\n"),
+    ("sge", "job-ID  prior   name       user         state submit/start at     queue  slots ja-task-ID\n"
+            "-------------------------------------------------------------------------------------\n"
+            "    101 0.50000 test-103   user         Eqw   01/01/2024 10:00:00        1 1\n"
+            "    102 0.50000 test-add-2 user         r     01/01/2024 10:00:00 all.q  1 1\n",
+     ""),
+    ("lsf", "101 EXIT\n101 DONE\n102 RUN\n102 DONE\n", "Job <103> is not found\n"),
+    ("slurm", "101 COMPLETED\n102 PENDING\n", "slurm_load_jobs error: Invalid job id specified\n")])
+def test_status_reads_job_states(name, out, err):
+    import sys
+    scheduler = cluster.SCHEDULERS[name]()
+    code = "import sys; sys.stdout.write(%r); sys.stderr.write(%r); sys.exit(1 if %r else 0)" % (out, err, err)
+    scheduler.status_cmd = lambda job_ids: [sys.executable, "-c", code]
+    assert scheduler.active(["101", "102", "103"]) == set(["102"])
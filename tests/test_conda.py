@@ -0,0 +1,198 @@
+"""Ordering of base and named conda environment installs.
+"""
+import os
+import sys
+import threading
+import time
+
+import pytest
+
+from cloudbio import conda
+
+
+class _FakeState(object):
+    def __init__(self, conda_bin):
+        self.prefix = "/fake"
+
+    def package_names(self, env_name=None, channels=None):
+        return []
+
+    def env_dir(self, env_name=None):
+        return None
+
+    def download(self, specs, env_name, channels=None):
+        pass
+
+    def remove(self, names, env_name=None, channels=None):
+        pass
+
+
+def test_base_install_finishes_before_named_environments(monkeypatch):
+    events = []
+    lock = threading.Lock()
+
+    def base_install(state, packages, channels):
+        with lock:
+            events.append(("start", None))
+        time.sleep(0.2)
+        with lock:
+            events.append(("end", None))
+
+    def env_install(state, env_name, packages, channels):
+        with lock:
+            events.append(("start", env_name))
+        time.sleep(0.1)
+        with lock:
+            events.append(("end", env_name))
+    monkeypatch.setattr(conda, "CondaState", _FakeState)
+    monkeypatch.setattr(conda, "_initial_base_install", base_install)
+    monkeypatch.setattr(conda, "_install_environment", env_install)
+    conda.install_in("conda", "/fake", packages=["samtools", "bcftools;env=python2", "pysam;env=python3"],
+                     max_workers=4)
+    assert events[:2] == [("start", None), ("end", None)]
+    assert sorted(x for _, x in events[2:]) == ["python2", "python2", "python3", "python3"]
+    # Named environments overlap with each other
+    assert [x[0] for x in events[2:4]] == ["start", "start"]
+
+
+_FAKE_CONDA = """#!{python}
+import json, os, sys, time
+args = sys.argv[1:]
+if args[0] == "info":
+    prefix = os.environ["FAKE_CONDA_PREFIX"]
+    print(json.dumps({{"conda_prefix": prefix, "channels": [], "envs": [prefix]}}))
+    sys.exit(0)
+if args[0] == "list":
+    print("[]")
+    sys.exit(0)
+flag = "--name" if "--name" in args else "-n"
+env_name = args[args.index(flag) + 1] if flag in args else "base"
+kind = "download" if "--download-only" in args else args[0]
+with open(os.environ["FAKE_CONDA_LOG"], "a") as out_handle:
+    out_handle.write("%s %s %.6f start\\n" % (kind, env_name, time.time()))
+time.sleep(0.2)
+with open(os.environ["FAKE_CONDA_LOG"], "a") as out_handle:
+    out_handle.write("%s %s %.6f end\\n" % (kind, env_name, time.time()))
+sys.exit(1 if env_name == "broken" and kind != "download" else 0)
+"""
+
+
+def _stub_conda(tmpdir, monkeypatch):
+    bin_dir = tmpdir.mkdir("bin")
+    for name in ["conda", "mamba"]:
+        bin_dir.join(name).write(_FAKE_CONDA.format(python=sys.executable))
+        bin_dir.join(name).chmod(0o755)
+    log_file = tmpdir.join("conda.log")
+    monkeypatch.setenv("FAKE_CONDA_PREFIX", str(tmpdir.mkdir("anaconda")))
+    monkeypatch.setenv("FAKE_CONDA_LOG", str(log_file))
+    return str(bin_dir.join("conda")), log_file
+
+
+def _intervals(log_file, kinds):
+    starts = {}
+    out = []
+    for line in log_file.read().splitlines():
+        kind, env_name, t, event = line.split()
+        if kind in kinds and env_name != "base":
+            if event == "start":
+                starts[(kind, env_name)] = float(t)
+            else:
+                out.append((starts.pop((kind, env_name)), float(t), env_name))
+    return out
+
+
+def _max_overlap(intervals):
+    return max(len([x for x in intervals if x[0] <= start < x[1]]) for start, _, _ in intervals)
+
+
+def test_stub_conda_honors_max_workers_after_serial_downloads(tmpdir, monkeypatch):
+    conda_bin, log_file = _stub_conda(tmpdir, monkeypatch)
+    envs = ["python2", "python3", "dv", "samtools0"]
+    conda.install_in(conda_bin, str(tmpdir), packages=["samtools"] + ["pysam;env=%s" % x for x in envs],
+                     max_workers=2)
+    downloads = _intervals(log_file, ["download"])
+    installs = _intervals(log_file, ["create", "install"])
+    assert sorted(x[2] for x in downloads) == sorted(envs)
+    assert _max_overlap(downloads) == 1
+    assert max(x[1] for x in downloads) <= min(x[0] for x in installs)
+    assert _max_overlap(installs) == 2
+
+
+def test_stub_conda_failures_propagate(tmpdir, monkeypatch):
+    conda_bin, log_file = _stub_conda(tmpdir, monkeypatch)
+    with pytest.raises(conda.subprocess.CalledProcessError):
+        conda.install_in(conda_bin, str(tmpdir), packages=["samtools", "pysam;env=broken", "pysam;env=python2"],
+                         max_workers=2)
+    # Other environments still finish installing
+    assert "python2" in [x[2] for x in _intervals(log_file, ["install"])]
+
+
+_MANIFEST = """zeta:
+  - z1
+alpha:
+  first: [a2, a1]
+  nested:
+    deep: [d1;env=python3]
+  last: [l1]
+channels: [conda-forge]
+"""
+
+
+def test_yaml_to_packages_walks_nested_groups_in_order(tmpdir):
+    yaml_file = str(tmpdir.join("packages.yaml"))
+    tmpdir.join("packages.yaml").write(_MANIFEST)
+    packages, groups = conda._yaml_to_packages(yaml_file)
+    # Groups by name, and within a group the last nested entry first
+    assert packages == ["l1", "d1;env=python3", "a1", "a2", "z1"]
+    assert groups == {"l1": "alpha", "d1;env=python3": "alpha", "a1": "alpha", "a2": "alpha", "z1": "zeta"}
+    packages, _ = conda._yaml_to_packages(yaml_file, namesort=False)
+    assert packages == ["l1", "d1;env=python3", "a2", "a1", "z1"]
+
+
+def test_yaml_to_packages_selects_and_substitutes(tmpdir):
+    tmpdir.join("packages.yaml").write(_MANIFEST)
+    tmpdir.join("subs.yaml").write("a1: a1-custom\nl1: ''\n")
+    packages, _ = conda._yaml_to_packages(str(tmpdir.join("packages.yaml")), ["alpha"],
+                                          str(tmpdir.join("subs.yaml")))
+    assert packages == ["d1;env=python3", "a1-custom", "a2"]
+    assert conda._split_by_condaenv(packages) == [(None, ["a1-custom", "a2"]), ("python3", ["d1"])]
+
+
+_CALL_LOGGING_CONDA = """#!{python}
+import json, os, sys
+args = sys.argv[1:]
+with open(os.environ["FAKE_CONDA_LOG"], "a") as out_handle:
+    out_handle.write(" ".join(args) + "\\n")
+prefix = os.environ["FAKE_CONDA_PREFIX"]
+if args[0] == "info":
+    print(json.dumps({{"conda_prefix": prefix, "channels": ["bioconda"],
+                      "envs": [prefix, prefix + "/envs/python2", "/elsewhere/envs/other"]}}))
+elif args[0] == "list":
+    print(json.dumps([{{"name": "samtools", "channel": "bioconda"}}, {{"name": "zlib", "channel": "conda-forge"}}]))
+"""
+
+
+def test_conda_state_caches_and_tracks_changes(tmpdir, monkeypatch):
+    bin_dir = tmpdir.mkdir("bin")
+    bin_dir.join("conda").write(_CALL_LOGGING_CONDA.format(python=sys.executable))
+    bin_dir.join("conda").chmod(0o755)
+    prefix = str(tmpdir.join("anaconda"))
+    monkeypatch.setenv("FAKE_CONDA_PREFIX", prefix)
+    monkeypatch.setenv("FAKE_CONDA_LOG", str(tmpdir.join("calls.log")))
+    state = conda.CondaState(str(bin_dir.join("conda")))
+    assert state.env_dir() == prefix
+    assert state.env_dir("python2") == prefix + "/envs/python2"
+    assert state.env_dir("other") is None
+    assert sorted(state.package_names()) == ["samtools", "zlib"]
+    assert state.package_names(channels=["bioconda"]) == ["samtools"]
+    state.install(["bcftools=1.9"], channels=["bioconda"])
+    state.remove(["zlib"])
+    assert sorted(state.package_names(channels=["bioconda"])) == ["bcftools", "samtools"]
+    assert state.create("python3", ["python=3.6", "pysam>=0.15"]) == prefix + "/envs/python3"
+    assert state.env_dir("python3") == prefix + "/envs/python3"
+    assert sorted(state.package_names("python3")) == ["pysam", "python"]
+    calls = tmpdir.join("calls.log").read().splitlines()
+    # One info and one list of the base environment; later checks use the snapshot
+    assert [x.split()[0] for x in calls] == ["info", "list", "install", "remove", "create"]
+    # Version specs reach conda intact rather than as shell redirections
+    assert calls[-1].endswith("python=3.6 pysam>=0.15")
@@ -0,0 +1,91 @@
+"""Pipelined stages: per-sample ordering, batch joins, failures and overlap between stages.
+"""
+import functools
+import time
+
+import pytest
+
+from bcbio.distributed import dag, multi
+
+
+def _run_sample(data, stage):
+    start = time.time()
+    time.sleep(data.get("times", {}).get(stage, 0))
+    if stage in data.get("fail", []):
+        raise ValueError("%s failed in %s" % (data["description"], stage))
+    return dict(data, log=data.get("log", []) + [(stage, start, time.time())])
+
+
+def _run_batch(datas, stage):
+    start = time.time()
+    time.sleep(max(x.get("times", {}).get(stage, 0) for x in datas))
+    return [dict(x, batch_size=len(datas), log=x.get("log", []) + [(stage, start, time.time())]) for x in datas]
+
+
+def _pipeline():
+    return dag.Pipeline([dag.Stage("align", functools.partial(_run_sample, stage="align")),
+                         dag.Stage("recalibrate", functools.partial(_run_sample, stage="recalibrate"),
+                                   when=lambda x: x.get("recalibrate")),
+                         dag.Stage("call", functools.partial(_run_batch, stage="call"), batch=True)])
+
+
+def _samples(**kwargs):
+    samples = [{"description": "s%s" % i, "metadata": {"batch": "b%s" % (i // 2)}, "recalibrate": i % 2 == 0,
+                "times": {"align": 0.05 * (4 - i)}}
+               for i in range(4)]
+    for name, extra in kwargs.items():
+        samples[int(name[1:])].update(extra)
+    return samples
+
+
+def _stages(data):
+    return [x[0] for x in data["log"]]
+
+
+def test_stages_run_in_order_per_sample():
+    with multi.LocalScheduler({"type": "local", "cores": 4}) as scheduler:
+        out = _pipeline().run(_samples(), scheduler)
+    assert [x["description"] for x in out] == ["s0", "s1", "s2", "s3"]
+    assert [_stages(x) for x in out] == [["align", "recalibrate", "call"], ["align", "call"],
+                                         ["align", "recalibrate", "call"], ["align", "call"]]
+    for data in out:
+        for (_, _, end), (_, start, _) in zip(data["log"], data["log"][1:]):
+            assert start >= end
+    assert all(x["batch_size"] == 2 for x in out)
+    # Batch stages start once every member of the batch has reached them
+    for batch in [out[:2], out[2:]]:
+        call_start = batch[0]["log"][-1][1]
+        assert all(x["log"][-1][1] == call_start for x in batch)
+        assert call_start >= max(x["log"][-2][2] for x in batch)
+
+
+def test_failure_raises():
+    with multi.LocalScheduler({"type": "local", "cores": 2}) as scheduler:
+        with pytest.raises(ValueError, match="s1 failed in align"):
+            _pipeline().run(_samples(s1={"fail": ["align"]}), scheduler)
+
+
+def test_keep_going_drops_failed_samples():
+    with multi.LocalScheduler({"type": "local", "cores": 2}) as scheduler:
+        out = _pipeline().run(_samples(s1={"fail": ["align"]}, s2={"fail": ["recalibrate"]}), scheduler,
+                              keep_going=True)
+    assert [x["description"] for x in out] == ["s0", "s3"]
+    # Batches are joined from the samples still running
+    assert [(x["batch_size"], _stages(x)) for x in out] == [(1, ["align", "recalibrate", "call"]),
+                                                            (1, ["align", "call"])]
+
+
+def test_samples_do_not_wait_for_other_samples_stages():
+    samples = [{"description": "fast", "recalibrate": True, "times": {"align": 0.1}},
+               {"description": "slow", "recalibrate": True, "times": {"align": 1.0}}]
+    with multi.LocalScheduler({"type": "local", "cores": 2}) as scheduler:
+        fast, slow = _pipeline().run(samples, scheduler)
+    assert _stages(fast) == _stages(slow) == ["align", "recalibrate", "call"]
+    slow_align_end = slow["log"][0][2]
+    assert fast["log"][1][1] < slow_align_end
+    assert fast["log"][2][1] < slow_align_end
+
+
+def test_stage_names_are_unique():
+    with pytest.raises(ValueError):
+        dag.Pipeline([dag.Stage("align", _run_sample), dag.Stage("align", _run_sample)])
@@ -0,0 +1,91 @@
+"""Download cache revalidation and eviction against a local HTTP server.
+"""
+import os
+import time
+
+from bcbio import dlcache
+
+
+def _serve(http_server, name, data):
+    with open(os.path.join(http_server.root, name), "wb") as out_handle:
+        out_handle.write(data)
+    return "%s/%s" % (http_server.url, name)
+
+
+def _gets(http_server):
+    return [x for x in http_server.requests if x[0] == "GET"]
+
+
+def test_unchanged_files_revalidate_without_transfer(tmpdir, http_server):
+    url = _serve(http_server, "genome.yaml", b"name: hg38\n")
+    cache = dlcache.DownloadCache(str(tmpdir.join("cache")))
+    first = cache.fetch(url)
+    assert cache.fetch(url) == first
+    requests = _gets(http_server)
+    assert len(requests) == 2
+    assert "If-None-Match" not in requests[0][2]
+    assert requests[1][2]["If-None-Match"] == cache._read_record(url)["etag"]
+    assert requests[1][2]["If-Modified-Since"] == cache._read_record(url)["last_modified"]
+
+
+def test_changed_files_are_downloaded_again(tmpdir, http_server):
+    url = _serve(http_server, "genome.yaml", b"name: hg38\n")
+    cache = dlcache.DownloadCache(str(tmpdir.join("cache")))
+    cache.fetch(url)
+    _serve(http_server, "genome.yaml", b"name: hg38-noalt\n")
+    assert cache.read(url) == b"name: hg38-noalt\n"
+
+
+def test_max_age_skips_revalidation(tmpdir, http_server):
+    url = _serve(http_server, "genome.yaml", b"name: hg38\n")
+    cache = dlcache.DownloadCache(str(tmpdir.join("cache")), max_age=3600)
+    cache.fetch(url)
+    cache.fetch(url)
+    assert len(_gets(http_server)) == 1
+    cache.fetch(url, max_age=0)
+    assert len(_gets(http_server)) == 2
+
+
+def test_cached_copy_used_when_offline(tmpdir, http_server):
+    url = _serve(http_server, "genome.yaml", b"name: hg38\n")
+    cache = dlcache.DownloadCache(str(tmpdir.join("cache")))
+    cache.fetch(url)
+    http_server.shutdown()
+    http_server.server_close()
+    assert cache.read(url) == b"name: hg38\n"
+
+
+def test_least_recently_used_files_are_evicted(tmpdir, http_server):
+    cache = dlcache.DownloadCache(str(tmpdir.join("cache")), max_size=2500)
+    urls = [_serve(http_server, "file-%s" % i, os.urandom(1000)) for i in range(3)]
+    cache.fetch(urls[0])
+    time.sleep(0.01)
+    cache.fetch(urls[1])
+    time.sleep(0.01)
+    # Using the first file again makes the second the least recently used
+    cache.fetch(urls[0])
+    time.sleep(0.01)
+    cache.fetch(urls[2])
+    assert cache._read_record(urls[0]) is not None
+    assert cache._read_record(urls[1]) is None
+    assert cache._read_record(urls[2]) is not None
+    assert len(os.listdir(os.path.join(cache.base_dir, "urls"))) == 2
+
+
+def test_evict_ignores_files_removed_by_another_process(tmpdir, http_server, monkeypatch):
+    cache = dlcache.DownloadCache(str(tmpdir.join("cache")), max_size=10 ** 6)
+    urls = [_serve(http_server, "file-%s" % i, os.urandom(1000)) for i in range(2)]
+    for url in urls:
+        cache.fetch(url)
+    load = dlcache.json.load
+
+    def load_then_evicted_elsewhere(in_handle):
+        # Another process evicts each entry right after this one lists it
+        record = load(in_handle)
+        os.remove(in_handle.name)
+        os.remove(cache._object_file(record["sha256"]))
+        return record
+    monkeypatch.setattr(dlcache.json, "load", load_then_evicted_elsewhere)
+    cache.max_size = 1500
+    cache.evict()
+    assert os.listdir(os.path.join(cache.base_dir, "urls")) == []
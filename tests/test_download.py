@@ -0,0 +1,217 @@
+"""Streaming tarball extraction.
+"""
+import io
+import hashlib
+import os
+import tarfile
+import time
+from concurrent import futures
+
+import pytest
+
+from bcbio import download
+
+
+def _add(tar, name, data=None, symlink=None, hardlink=None):
+    info = tarfile.TarInfo(name)
+    if symlink:
+        info.type = tarfile.SYMTYPE
+        info.linkname = symlink
+        tar.addfile(info)
+    elif hardlink:
+        info.type = tarfile.LNKTYPE
+        info.linkname = hardlink
+        tar.addfile(info)
+    else:
+        info.size = len(data)
+        info.mode = 0o644
+        tar.addfile(info, io.BytesIO(data))
+
+
+def _visible(dname):
+    return sorted(x for x in os.listdir(dname) if not x.startswith("."))
+
+
+def _tarball(tmpdir, members, name="test.tar.gz"):
+    tar_file = str(tmpdir.join(name))
+    with tarfile.open(tar_file, "w:gz") as tar:
+        for member in members:
+            _add(tar, *member[:2], **(member[2] if len(member) > 2 else {}))
+    return tar_file
+
+
+def test_large_members_are_not_held_in_memory(tmpdir, monkeypatch):
+    big = os.urandom(3 * download.MAX_BUFFERED_MEMBER)
+    tar_file = _tarball(tmpdir, [("top/seq/genome.fa", big), ("top/seq/small.txt", b"small")])
+    buffered = []
+    write_file = download._write_file
+
+    def record_write(out_file, data, mode, mtime):
+        buffered.append(len(data))
+        write_file(out_file, data, mode, mtime)
+    monkeypatch.setattr(download, "_write_file", record_write)
+    out_dir = download.extract_directory(tar_file, str(tmpdir.join("out")))
+    with open(os.path.join(out_dir, "seq", "genome.fa"), "rb") as in_handle:
+        assert in_handle.read() == big
+    assert buffered == [5]
+
+
+def test_subpaths_and_hard_links_after_stripping(tmpdir):
+    tar_file = _tarball(tmpdir, [("top/config/a.yaml", b"a"), ("top/other/b", b"b"),
+                                 ("top/config/c.yaml", None, {"hardlink": "top/config/a.yaml"}),
+                                 ("top/config/d.yaml", None, {"symlink": "a.yaml"})])
+    out_dir = download.extract_directory(tar_file, str(tmpdir.join("out")), subpaths=["config"])
+    assert sorted(os.listdir(out_dir)) == ["config"]
+    for name in ["a.yaml", "c.yaml", "d.yaml"]:
+        with open(os.path.join(out_dir, "config", name)) as in_handle:
+            assert in_handle.read() == "a"
+
+
+def test_links_escaping_after_stripping_are_rejected(tmpdir):
+    # Inside the output directory before stripping the top level, outside after
+    tar_file = _tarball(tmpdir, [("top/data/x", b"x"), ("top/data/l", None, {"symlink": "../../outside"})])
+    with pytest.raises(ValueError):
+        download.extract_directory(tar_file, str(tmpdir.join("out")))
+    assert not os.path.exists(str(tmpdir.join("out")))
+
+
+def test_extract_merges_into_installed_directories(tmpdir):
+    out_dir = tmpdir.mkdir("genome")
+    out_dir.join("seq", "genome.fa").write("installed", ensure=True)
+    out_dir.join("seq", "genome.dict").write("old", ensure=True)
+    tar_file = _tarball(tmpdir, [("seq/genome.dict", b"new"), ("seq/genome.fa.fai", b"index")])
+    download.extract_tarball(tar_file, str(out_dir))
+    assert out_dir.join("seq", "genome.fa").read() == "installed"
+    assert out_dir.join("seq", "genome.dict").read() == "new"
+    assert out_dir.join("seq", "genome.fa.fai").read() == "index"
+    assert _visible(str(out_dir)) == ["seq"]
+
+
+def test_extract_refuses_to_replace_directory_with_file(tmpdir):
+    out_dir = tmpdir.mkdir("genome")
+    out_dir.join("seq", "genome.fa").write("installed", ensure=True)
+    tar_file = _tarball(tmpdir, [("seq", b"not a directory")])
+    with pytest.raises(ValueError):
+        download.extract_tarball(tar_file, str(out_dir))
+    assert out_dir.join("seq", "genome.fa").read() == "installed"
+
+
+def _serve(http_server, name, data):
+    fname = os.path.join(http_server.root, name)
+    with open(fname, "wb") as out_handle:
+        out_handle.write(data)
+    return "%s/%s" % (http_server.url, name)
+
+
+def _gets(http_server, name):
+    return [x for x in http_server.requests if x[0] == "GET" and x[1] == "/" + name]
+
+
+def test_download_resumes_partial_file(tmpdir, http_server):
+    data = os.urandom(3 * download.CHUNK_SIZE + 17)
+    url = _serve(http_server, "genome.fa", data)
+    out_file = str(tmpdir.join("genome.fa"))
+    with open(out_file + ".part", "wb") as out_handle:
+        out_handle.write(data[:download.CHUNK_SIZE])
+    download.download(url, out_file, "md5:%s" % hashlib.md5(data).hexdigest())
+    with open(out_file, "rb") as in_handle:
+        assert in_handle.read() == data
+    assert _gets(http_server, "genome.fa")[0][2]["Range"] == "bytes=%s-" % download.CHUNK_SIZE
+    assert not os.path.exists(out_file + ".part")
+
+
+def test_download_restarts_when_range_is_ignored(tmpdir, http_server):
+    http_server.ignore_range = True
+    data = os.urandom(2 * download.CHUNK_SIZE)
+    url = _serve(http_server, "genome.fa", data)
+    out_file = str(tmpdir.join("genome.fa"))
+    with open(out_file + ".part", "wb") as out_handle:
+        out_handle.write(data[:1000])
+    download.download(url, out_file)
+    with open(out_file, "rb") as in_handle:
+        assert in_handle.read() == data
+
+
+def test_complete_partial_file_is_verified_after_416(tmpdir, http_server):
+    data = b"ACGT" * 1000
+    url = _serve(http_server, "genome.fa", data)
+    _serve(http_server, "genome.fa.md5", ("%s  genome.fa\n" % hashlib.md5(data).hexdigest()).encode())
+    out_file = str(tmpdir.join("genome.fa"))
+    with open(out_file + ".part", "wb") as out_handle:
+        out_handle.write(data)
+    download.download(url, out_file, download.get_checksum(url))
+    with open(out_file, "rb") as in_handle:
+        assert in_handle.read() == data
+    assert len(_gets(http_server, "genome.fa")) == 1
+
+
+def test_md5_sidecar_mismatch_fails(tmpdir, http_server):
+    url = _serve(http_server, "genome.fa", b"ACGT" * 1000)
+    _serve(http_server, "genome.fa.md5", b"0" * 32 + b"\n")
+    out_file = str(tmpdir.join("genome.fa"))
+    checksum = download.get_checksum(url)
+    assert checksum == "md5:" + "0" * 32
+    with pytest.raises(download.ChecksumError):
+        download.download(url, out_file, checksum, retries=1)
+    assert not os.path.exists(out_file)
+    assert not os.path.exists(out_file + ".part")
+    assert len(_gets(http_server, "genome.fa")) == 2
+
+
+def test_missing_file_fails_without_retries(tmpdir, http_server, monkeypatch):
+    monkeypatch.setattr(download.time, "sleep", lambda x: pytest.fail("retried a missing file"))
+    with pytest.raises(download.urllib_error.HTTPError):
+        download.download(http_server.url + "/missing.tar.gz", str(tmpdir.join("missing.tar.gz")))
+    with pytest.raises(download.urllib_error.HTTPError):
+        download.extract_stream(http_server.url + "/missing.tar.gz", str(tmpdir.join("out")))
+    assert len(_gets(http_server, "missing.tar.gz")) == 2
+    assert not download.url_exists(http_server.url + "/missing.tar.gz")
+
+
+def test_extract_stream_from_server(tmpdir, http_server):
+    tar_file = _tarball(tmpdir, [("bwa/hg38.fa.bwt", b"index"), ("bwa/hg38.fa.sa", os.urandom(1000))])
+    with open(tar_file, "rb") as in_handle:
+        data = in_handle.read()
+    url = _serve(http_server, "hg38-bwa.tar.gz", data)
+    _serve(http_server, "hg38-bwa.tar.gz.sha256", hashlib.sha256(data).hexdigest().encode())
+    out_dir = str(tmpdir.join("hg38"))
+    assert download.url_exists(url)
+    download.extract_stream(url, out_dir, download.get_checksum(url))
+    with open(os.path.join(out_dir, "bwa", "hg38.fa.bwt"), "rb") as in_handle:
+        assert in_handle.read() == b"index"
+    assert _visible(out_dir) == ["bwa"]
+
+
+def test_url_exists_with_head_requests(http_server):
+    url = _serve(http_server, "hg38-rnaseq.tar.gz", b"data")
+    assert download.url_exists(url)
+    assert not download.url_exists(http_server.url + "/hg38-smallrna.tar.gz")
+    assert [x[0] for x in http_server.requests] == ["HEAD", "HEAD"]
+
+
+def test_concurrent_installs_into_one_directory_merge(tmpdir, http_server, monkeypatch):
+    is_real_dir = download._is_real_dir
+
+    def slow_is_real_dir(path):
+        # Widen the window between checking an installed path and moving onto it
+        found = is_real_dir(path)
+        time.sleep(0.01)
+        return found
+    monkeypatch.setattr(download, "_is_real_dir", slow_is_real_dir)
+    urls = []
+    expected = set()
+    for i in range(8):
+        members = [("seq/part-%s.fa" % i, ("seq %s" % i).encode()), ("shared/file-%s.txt" % i, b"x"),
+                   ("shared/nested/common.txt", b"common")]
+        tar_file = _tarball(tmpdir, members, "target-%s.tar.gz" % i)
+        with open(tar_file, "rb") as in_handle:
+            urls.append(_serve(http_server, "target-%s.tar.gz" % i, in_handle.read()))
+        expected |= set(x[0] for x in members)
+    out_dir = str(tmpdir.join("genome"))
+    with futures.ThreadPoolExecutor(max_workers=8) as executor:
+        list(executor.map(lambda url: download.extract_stream(url, out_dir), urls))
+    found = set()
+    for root, dirs, files in os.walk(out_dir):
+        found |= set(os.path.relpath(os.path.join(root, f), out_dir) for f in files if not f.startswith("."))
+    assert found == expected
+    assert _visible(out_dir) == ["seq", "shared"]
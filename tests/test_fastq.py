@@ -0,0 +1,44 @@
+"""Pairing fastq files by read number in their names.
+"""
+from bcbio.bam import fastq
+
+
+def test_illumina_pairs_in_read_order():
+    files = ["s2_S2_L001_R2_001.fastq.gz", "s1_S1_L001_R2_001.fastq.gz", "s1_S1_L001_R1_001.fastq.gz",
+             "s2_S2_L001_R1_001.fastq.gz", "s3.fq"]
+    assert fastq.combine_pairs(files) == [["s1_S1_L001_R1_001.fastq.gz", "s1_S1_L001_R2_001.fastq.gz"],
+                                          ["s2_S2_L001_R1_001.fastq.gz", "s2_S2_L001_R2_001.fastq.gz"],
+                                          ["s3.fq"]]
+
+
+def test_read_sets_and_orphans():
+    matches = fastq.match_pairs(["a_R3.fq", "a_R1.fq", "a_R2.fq", "b_1.fq.gz", "c.fq"])
+    assert matches.groups == [["a_R1.fq", "a_R2.fq", "a_R3.fq"], ["b_1.fq.gz"], ["c.fq"]]
+    assert matches.orphans == ["b_1.fq.gz"]
+    assert matches.ambiguous == []
+
+
+def test_same_names_pair_within_directories():
+    files = ["/run2/s_1.fq", "/run1/s_2.fq", "/run1/s_1.fq", "/run2/s_2.fq"]
+    assert fastq.combine_pairs(files) == [["/run1/s_1.fq", "/run1/s_2.fq"], ["/run2/s_1.fq", "/run2/s_2.fq"]]
+    assert fastq.combine_pairs(files, full_name=True) == [["/run1/s_1.fq", "/run1/s_2.fq"],
+                                                          ["/run2/s_1.fq", "/run2/s_2.fq"]]
+
+
+def test_separator_order_resolves_ambiguous_names(capsys):
+    files = ["s_1_R1.fq", "s_1_R2.fq", "s_2_R1.fq", "s_2_R2.fq"]
+    assert fastq.combine_pairs(files) == [["s_1_R1.fq", "s_1_R2.fq"], ["s_2_R1.fq", "s_2_R2.fq"]]
+    assert "4 files could be paired in more than one way" in capsys.readouterr().out
+    matches = fastq.match_pairs(files)
+    assert matches.ambiguous[0] == {"file": "s_1_R1.fq", "groups": [["s_1_R1.fq", "s_1_R2.fq"],
+                                                                    ["s_1_R1.fq", "s_2_R1.fq"]]}
+    matches = fastq.match_pairs(files, separators=["_"])
+    assert matches.groups == [["s_1_R1.fq", "s_2_R1.fq"], ["s_1_R2.fq", "s_2_R2.fq"]]
+    assert matches.ambiguous == []
+
+
+def test_force_single_and_digit_runs():
+    files = ["x_R1.fq", "x_R2.fq"]
+    assert fastq.combine_pairs(files, force_single=True) == [["x_R1.fq"], ["x_R2.fq"]]
+    # Read identifiers followed by another digit are part of a longer number
+    assert fastq.combine_pairs(["lane_12.fq", "lane_22.fq"]) == [["lane_12.fq"], ["lane_22.fq"]]
@@ -0,0 +1,116 @@
+"""Host profiles from cgroup limits, and tuning system configurations to fit them.
+"""
+import pytest
+
+from bcbio import hostprofile
+from bcbio.distributed import clargs, resources
+
+
+def _cgroup_tree(tmpdir, files):
+    root = tmpdir.mkdir("cgroup")
+    for fname, contents in files.items():
+        root.join(fname).write(contents, ensure=True)
+    return str(root)
+
+
+@pytest.fixture
+def proc_cgroup(monkeypatch):
+    """Replace /proc/self/cgroup with the given contents.
+    """
+    orig = hostprofile._read
+    contents = {}
+
+    def _read(fname):
+        if fname == "/proc/self/cgroup":
+            return contents.get("text")
+        return orig(fname)
+    monkeypatch.setattr(hostprofile, "_read", _read)
+    return contents
+
+
+def test_cgroup_v2_limits_of_own_cgroup(tmpdir, proc_cgroup):
+    proc_cgroup["text"] = "0::/user.slice/job1\n"
+    root = _cgroup_tree(tmpdir, {"cgroup.controllers": "cpu memory",
+                                 "cpu.max": "max 100000", "memory.max": "max",
+                                 "user.slice/job1/cpu.max": "250000 100000",
+                                 "user.slice/job1/memory.max": str(4 * 1024 ** 3)})
+    assert hostprofile.cgroup_limits(root) == {"version": 2, "cpus": 2.5, "memory": 4.0}
+
+
+def test_cgroup_v2_namespace_root_and_unlimited(tmpdir, proc_cgroup):
+    proc_cgroup["text"] = "0::/\n"
+    root = _cgroup_tree(tmpdir, {"cgroup.controllers": "cpu memory", "cpu.max": "200000 100000",
+                                 "memory.max": str(2 * 1024 ** 3)})
+    assert hostprofile.cgroup_limits(root) == {"version": 2, "cpus": 2.0, "memory": 2.0}
+    tmpdir.join("cgroup", "cpu.max").write("max 100000")
+    tmpdir.join("cgroup", "memory.max").write("max")
+    assert hostprofile.cgroup_limits(root) == {"version": 2, "cpus": None, "memory": None}
+
+
+def test_cgroup_v1_limits(tmpdir, proc_cgroup):
+    proc_cgroup["text"] = "4:memory:/slurm/job7\n3:cpu,cpuacct:/slurm/job7\n"
+    root = _cgroup_tree(tmpdir, {"cpu/slurm/job7/cpu.cfs_quota_us": "150000",
+                                 "cpu/slurm/job7/cpu.cfs_period_us": "100000",
+                                 "memory/slurm/job7/memory.limit_in_bytes": str(3 * 1024 ** 3)})
+    assert hostprofile.cgroup_limits(root) == {"version": 1, "cpus": 1.5, "memory": 3.0}
+
+
+def test_cgroup_v1_unlimited(tmpdir, proc_cgroup):
+    proc_cgroup["text"] = "4:memory:/\n3:cpu,cpuacct:/\n"
+    root = _cgroup_tree(tmpdir, {"cpu/cpu.cfs_quota_us": "-1", "cpu/cpu.cfs_period_us": "100000",
+                                 "memory/memory.limit_in_bytes": "9223372036854771712"})
+    assert hostprofile.cgroup_limits(root) == {"version": 1, "cpus": None, "memory": None}
+
+
+def test_no_cgroups(tmpdir, proc_cgroup):
+    assert hostprofile.cgroup_limits(str(tmpdir)) == {"version": None, "cpus": None, "memory": None}
+
+
+def test_physical_memory_from_resources(monkeypatch):
+    monkeypatch.setattr(resources, "get_total_memory", lambda: 123.0)
+    assert hostprofile.physical_memory() == 123.0
+
+
+def test_profile_takes_lowest_limits(monkeypatch):
+    monkeypatch.setattr(hostprofile, "cpu_count", lambda: 16)
+    monkeypatch.setattr(hostprofile, "physical_memory", lambda: 64.0)
+    monkeypatch.setattr(hostprofile, "numa_nodes", lambda: [])
+    monkeypatch.setattr(hostprofile, "cgroup_limits", lambda: {"version": 2, "cpus": 0.5, "memory": 6.5})
+    host = hostprofile.profile()
+    assert (host["cores"], host["memory"]) == (1, 6.5)
+
+
+def _system_config():
+    return {"resources": {"default": {"cores": 16, "memory": "3G", "jvm_opts": ["-Xms750m", "-Xmx3500m"]},
+                          "gatk": {"jvm_opts": ["-Xms500m", "-Xmx20g"]},
+                          "qualimap": {"memory": "4g"},
+                          "log": {"dir": "/var/log"}}}
+
+
+def test_tune_config_keeps_within_numa_node():
+    host = {"cores": 8, "memory": 20.0, "numa": [{"cpus": 4}, {"cpus": 4}]}
+    config = hostprofile.tune_config(_system_config(), host)["resources"]
+    assert config["default"]["cores"] == 4
+    assert config["default"]["memory"] == "3G"
+    assert config["qualimap"] == {"memory": "4g"}
+    assert config["log"] == {"dir": "/var/log"}
+    heap = resources._jvm_heap(config["gatk"]["jvm_opts"])
+    assert heap <= 20.0 * hostprofile.MEMORY_FRACTION
+
+
+def test_tune_config_reduces_memory_per_core():
+    config = hostprofile.tune_config(_system_config(), {"cores": 2, "memory": 4.0})["resources"]
+    assert config["default"]["cores"] == 2
+    assert config["default"]["memory"] == "%sM" % int(4.0 * hostprofile.MEMORY_FRACTION / 2 * 1024)
+    assert config["qualimap"]["memory"] == "%sM" % int(4.0 * hostprofile.MEMORY_FRACTION / 2 * 1024)
+    assert config["default"]["jvm_opts"] == ["-Xms750m", "-Xmx3500m"]
+
+
+def test_default_cores_from_saved_profile(tmpdir, monkeypatch):
+    monkeypatch.setenv("BCBIO_HOST_PROFILE_DIR", str(tmpdir))
+    assert hostprofile.default_cores() == 1
+    assert clargs._get_cores_and_type(None, None, None) == ("local", 1)
+    hostprofile.save_profile({"hostname": hostprofile.socket.gethostname(), "cores": 6, "memory": 12.0})
+    assert hostprofile.default_cores() == 6
+    assert clargs._get_cores_and_type(None, None, None) == ("local", 6)
+    assert clargs._get_cores_and_type(2, None, None) == ("local", 2)
@@ -0,0 +1,99 @@
+"""Writing bcbio_system.yaml during installation.
+"""
+import os
+
+import yaml
+
+import bcbio_nextgen_install as bootstrap
+from bcbio import hostprofile
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+_CONFIG = """# system config
+galaxy:
+  dir: /old/galaxy
+  # tool data
+  tool_data: /old/tool-data
+resources:
+  # defaults
+
+  default:
+    cores: 16   # per program
+    jvm_opts: ["-Xms750m", "-Xmx3500m"]
+  gatk:
+    dir: /old/share/java/gatk
+    jvm_opts: ["-Xms500m", "-Xmx3500m"]
+
+# trailing comment
+log:
+  dir: /old/log
+"""
+
+
+def _bundled():
+    with open(os.path.join(REPO_DIR, "config", "bcbio_system.yaml")) as in_handle:
+        return in_handle.read()
+
+
+def test_only_resource_values_change():
+    in_txt = _bundled()
+    out_txt = bootstrap._set_host_resources(in_txt, cores=4, memory=8192)
+    changed = [(a, b) for a, b in zip(in_txt.splitlines(), out_txt.splitlines()) if a != b]
+    assert len(in_txt.splitlines()) == len(out_txt.splitlines())
+    assert changed == [("    memory: 3G", "    memory: 2048M"), ("    cores: 16", "    cores: 4")]
+
+
+def test_large_host_keeps_configured_values():
+    in_txt = _bundled()
+    assert bootstrap._set_host_resources(in_txt, cores=64, memory=512 * 1024) == in_txt
+    assert bootstrap._set_host_resources(in_txt) == in_txt
+
+
+def test_missing_values_are_added_in_place():
+    out_txt = bootstrap._set_host_resources(_CONFIG, cores=8, memory=4000)
+    config = yaml.safe_load(out_txt)
+    assert config["resources"]["default"] == {"cores": 8, "memory": "500M",
+                                              "jvm_opts": ["-Xms750m", "-Xmx3500m"]}
+    assert "    cores: 8   # per program\n" in out_txt
+    assert "    jvm_opts: [\"-Xms750m\", \"-Xmx3500m\"]\n    memory: 500M\n  gatk:" in out_txt
+    assert "\n# trailing comment\nlog:" in out_txt
+
+
+def test_missing_sections_are_added():
+    config = yaml.safe_load(bootstrap._set_host_resources("log:\n  dir: /tmp/log", cores=2, memory=1000))
+    assert config["resources"]["default"] == {"cores": 2, "memory": "500M"}
+    config = yaml.safe_load(bootstrap._set_host_resources("resources:\n  gatk:\n    memory: 2g\n",
+                                                          cores=2, memory=1000))
+    assert config["resources"] == {"default": {"cores": 2, "memory": "500M"}, "gatk": {"memory": "2g"}}
+
+
+def test_tool_dirs_and_galaxy_rewritten_by_line():
+    out_txt = bootstrap._rewrite_system_config_lines(_CONFIG, "/tools/share/java")
+    config = yaml.safe_load(out_txt)
+    assert "galaxy" not in config
+    assert config["resources"]["gatk"]["dir"] == "/tools/share/java/gatk"
+    assert config["log"] == {"dir": "/old/log"}
+    assert "# galaxy:\n#   dir: /old/galaxy\n  # tool data\n#   tool_data" in out_txt
+
+
+def test_host_resources_respect_cgroup_limits(monkeypatch):
+    monkeypatch.setattr(hostprofile, "cpu_count", lambda: 32)
+    monkeypatch.setattr(hostprofile, "numa_nodes", lambda: [])
+    monkeypatch.setattr(hostprofile, "cgroup_limits",
+                        lambda: {"version": 2, "cpus": 2.5, "memory": 4.0})
+    assert bootstrap._get_host_resources() == (2, int(4 * 1024 * hostprofile.MEMORY_FRACTION))
+
+
+def test_write_system_config_keeps_comments(tmpdir, monkeypatch):
+    monkeypatch.setattr(bootstrap, "_get_host_resources", lambda: (2, 3000))
+    datadir = str(tmpdir.join("data"))
+    out_file = bootstrap.write_system_config(bootstrap.REMOTES["system_config"], datadir, str(tmpdir.join("tools")))
+    with open(out_file) as in_handle:
+        out_txt = in_handle.read()
+    assert out_txt.startswith("# Configuration file specifying system details")
+    assert out_txt.count("\n#") == _bundled().count("\n#")
+    assert yaml.safe_load(out_txt)["resources"]["default"]["cores"] == 2
+    assert yaml.safe_load(out_txt)["resources"]["default"]["memory"] == "1500M"
+    # Reinstalling keeps a backup of the previous configuration
+    bootstrap.write_system_config(bootstrap.REMOTES["system_config"], datadir, str(tmpdir.join("tools")))
+    assert len([x for x in os.listdir(os.path.dirname(out_file)) if ".bak" in x]) == 1
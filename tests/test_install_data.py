@@ -0,0 +1,52 @@
+"""Genome data install task graphs and installs from a local HTTP server.
+"""
+import argparse
+import io
+import os
+import tarfile
+
+from bcbio import download, install_data
+
+URL = "https://example.org/{genome}-{target}.tar.gz"
+
+
+def test_available_targets_skip_missing_tarballs(monkeypatch):
+    present = set(["hg38-variation.tar.gz", "hg38-rnaseq.tar.gz", "sacCer3-rnaseq.tar.gz"])
+    monkeypatch.setattr(download, "url_exists", lambda url: url.split("/")[-1] in present)
+    targets = install_data.available_targets(["hg38", "sacCer3"], ["variation", "rnaseq"], URL)
+    assert targets == {"hg38": ["variation", "rnaseq"], "sacCer3": ["rnaseq"]}
+
+
+def test_build_tasks_adds_genome_targets_after_seq():
+    tasks = install_data.build_tasks(["hg38", "sacCer3"], ["seq", "bwa"], {"sacCer3": ["rnaseq"]})
+    assert tasks == {("hg38", "seq"): [], ("hg38", "bwa"): [("hg38", "seq")],
+                     ("sacCer3", "seq"): [], ("sacCer3", "bwa"): [("sacCer3", "seq")],
+                     ("sacCer3", "rnaseq"): [("sacCer3", "seq")]}
+
+
+def _tarball(fname, members):
+    with tarfile.open(fname, "w:gz") as tar:
+        for name, data in members:
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            tar.addfile(info, io.BytesIO(data))
+
+
+def test_upgrade_data_from_local_server(tmpdir, http_server):
+    _tarball(os.path.join(http_server.root, "hg38-seq.tar.gz"), [("seq/hg38.fa", b">chr1\nACGT\n")])
+    _tarball(os.path.join(http_server.root, "hg38-bwa.tar.gz"), [("bwa/hg38.fa.bwt", b"index")])
+    _tarball(os.path.join(http_server.root, "hg38-variation.tar.gz"), [("variation/dbsnp.vcf.gz", b"vcf")])
+    args = argparse.Namespace(genomes=["hg38"], aligners=["bwa"], datatarget=["variation", "rnaseq"],
+                              connections=2, cores=2)
+    remotes = {"genome_data": http_server.url + "/{genome}-{target}.tar.gz"}
+    data_dir = str(tmpdir.join("data"))
+    done = install_data.upgrade_data(args, data_dir, remotes, ["bwa"])
+    assert done == [("hg38", "bwa"), ("hg38", "seq"), ("hg38", "variation")]
+    genome_dir = os.path.join(data_dir, "genomes", "Hsapiens", "hg38")
+    for fname in ["seq/hg38.fa", "bwa/hg38.fa.bwt", "variation/dbsnp.vcf.gz"]:
+        assert os.path.exists(os.path.join(genome_dir, fname))
+    assert not [x for x in os.listdir(genome_dir) if x.endswith(".tar.gz") or x.startswith(".tx")]
+    # Installed targets are skipped on the next run
+    gets = len([x for x in http_server.requests if x[0] == "GET"])
+    install_data.upgrade_data(args, data_dir, remotes, ["bwa"])
+    assert len([x for x in http_server.requests if x[0] == "GET"]) == gets
@@ -0,0 +1,104 @@
+"""Local multicore scheduling: ordering, core accounting and retries.
+"""
+import os
+import time
+
+import pytest
+
+from bcbio.distributed import multi
+
+
+def _square(x):
+    return x * x
+
+
+def _span(x):
+    start = time.time()
+    time.sleep(0.2)
+    return start, time.time()
+
+
+def _fail_first(counter_file):
+    with open(counter_file, "a") as out_handle:
+        out_handle.write("x")
+    with open(counter_file) as in_handle:
+        if len(in_handle.read()) < 2:
+            raise ValueError("first attempt fails")
+    return "ok"
+
+
+def _fail(x):
+    raise ValueError("failed %s" % x)
+
+
+def test_map_returns_results_in_order():
+    with multi.LocalScheduler({"type": "local", "cores": 3}) as scheduler:
+        assert scheduler.map(_square, [[x] for x in range(10)]) == [x * x for x in range(10)]
+
+
+def test_tasks_using_all_cores_do_not_overlap():
+    with multi.LocalScheduler({"type": "local", "cores": 2}) as scheduler:
+        spans = sorted(scheduler.map(_span, [[x] for x in range(3)], {"cores": 2}))
+    for (_, end), (start, _) in zip(spans, spans[1:]):
+        assert start >= end
+
+
+def test_failed_tasks_are_retried(tmpdir):
+    counter_file = str(tmpdir.join("count"))
+    with multi.LocalScheduler({"type": "local", "cores": 2, "retries": 1}) as scheduler:
+        assert scheduler.map(_fail_first, [[counter_file]]) == ["ok"]
+    assert os.path.getsize(counter_file) == 2
+
+
+def test_failure_after_retries_raises():
+    with pytest.raises(ValueError):
+        with multi.LocalScheduler({"type": "local", "cores": 2}) as scheduler:
+            scheduler.map(_fail, [[1], [2]])
+
+
+def _long_span(x):
+    start = time.time()
+    time.sleep(0.6)
+    return start, time.time()
+
+
+def _overlap(spans):
+    return max(len([1 for start, end in spans if start <= cur < end]) for cur, _ in spans)
+
+
+def test_memory_limits_concurrent_tasks():
+    with multi.LocalScheduler({"type": "local", "cores": 4, "mem": "4G"}) as scheduler:
+        fs = [scheduler.submit(_long_span, [i], cores=1, memory="2G") for i in range(4)]
+        spans = [f.result() for f in fs]
+    assert _overlap(spans) == 2
+
+
+def test_cores_limit_concurrent_tasks():
+    with multi.LocalScheduler({"type": "local", "cores": 4, "mem": 64}) as scheduler:
+        spans = scheduler.map(_long_span, [[x] for x in range(4)], {"cores": 2, "memory": 1})
+    assert _overlap(spans) == 2
+
+
+class _CancellingPool(object):
+    def submit(self, fn, *args):
+        f = multi.futures.Future()
+        f.cancel()
+        return f
+
+    def shutdown(self, wait=True):
+        pass
+
+
+def test_cancelled_pool_tasks_release_cores():
+    import threading
+    scheduler = multi.LocalScheduler({"type": "local", "cores": 2})
+    scheduler._pool = _CancellingPool()
+    f = scheduler.submit(_square, [2], cores=2)
+    with pytest.raises(multi.futures.CancelledError):
+        f.result(timeout=10)
+    assert scheduler._free_cores == 2
+    thread = threading.Thread(target=scheduler.shutdown)
+    thread.daemon = True
+    thread.start()
+    thread.join(10)
+    assert not thread.is_alive(), "shutdown hung waiting for cores of a cancelled task"
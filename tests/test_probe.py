@@ -0,0 +1,79 @@
+"""Probing BAM and fastq inputs on a thread pool, with the on-disk probe cache.
+"""
+import gzip
+import os
+import struct
+import threading
+import time
+
+from bcbio.bam import probe
+
+
+def _fastq(fname, quals):
+    with gzip.open(fname, "wb") as out_handle:
+        for i, qual in enumerate(quals):
+            out_handle.write(("@r%s\n%s\n+\n%s\n" % (i, "A" * len(qual), qual)).encode())
+    return fname
+
+
+def _bam(fname, header):
+    text = header.encode() + b"\x00"
+    with gzip.open(fname, "wb") as out_handle:
+        out_handle.write(b"BAM\x01" + struct.pack("<i", len(text)) + text)
+    return fname
+
+
+def test_fastq_and_bam_probes(tmpdir):
+    standard = _fastq(str(tmpdir.join("standard.fq.gz")), ["IIII#", "III"])
+    illumina = _fastq(str(tmpdir.join("illumina.fq.gz")), ["hhhhhh", "hhBh"])
+    assert probe.fastq_info(standard) == {"quality_format": "standard", "read_length": 5, "records": 2}
+    assert probe.fastq_info(illumina)["quality_format"] == "illumina"
+    bam = _bam(str(tmpdir.join("s1.bam")), "@HD\tVN:1.6\n@RG\tID:rg1\tSM:s1\tPL:illumina\n@RG\tID:rg2\tSM:s1\n")
+    assert probe.bam_read_groups(bam) == [{"ID": "rg1", "SM": "s1", "PL": "illumina"}, {"ID": "rg2", "SM": "s1"}]
+
+
+def test_probe_files_caches_until_files_change(tmpdir, monkeypatch):
+    monkeypatch.setenv("BCBIO_PROBE_CACHE", str(tmpdir.join("cache", "probe.json")))
+    files = [_fastq(str(tmpdir.join("s%s.fq.gz" % i)), ["IIII"]) for i in range(3)]
+    first = probe.probe_files(files, "fastq")
+    assert sorted(first) == sorted(files)
+    assert os.path.exists(str(tmpdir.join("cache", "probe.json")))
+    probed = []
+    orig = probe.PROBES["fastq"]
+
+    def counting(f):
+        probed.append(f)
+        return orig(f)
+    monkeypatch.setitem(probe.PROBES, "fastq", counting)
+    assert probe.probe_files(files, "fastq") == first
+    assert probed == []
+    _fastq(files[1], ["IIIIIIII"])
+    second = probe.probe_files(files, "fastq")
+    assert probed == [files[1]]
+    assert second[files[1]]["read_length"] == 8
+    # Cached results are per kind of probe
+    assert probe.ProbeCache().get(files[0], "bam") is None
+
+
+def test_probe_files_runs_in_parallel_and_skips_unreadable(tmpdir, monkeypatch, capsys):
+    files = [str(tmpdir.join("s%s.fq" % i)) for i in range(6)]
+    for f in files:
+        open(f, "w").close()
+    lock = threading.Lock()
+    running = [0, 0]
+
+    def slow(f):
+        with lock:
+            running[0] += 1
+            running[1] = max(running)
+        time.sleep(0.1)
+        with lock:
+            running[0] -= 1
+        if f.endswith("s5.fq"):
+            raise ValueError("truncated")
+        return {"read_length": 1}
+    monkeypatch.setitem(probe.PROBES, "fastq", slow)
+    out = probe.probe_files(files, "fastq", num_threads=3, cache_file=str(tmpdir.join("probe.json")))
+    assert sorted(out) == files[:5]
+    assert running[1] == 3
+    assert "could not read fastq header from %s: truncated" % files[5] in capsys.readouterr().out
@@ -0,0 +1,67 @@
+"""Genomic region shards and ordered merging of shard outputs.
+"""
+import gzip
+
+import pytest
+
+from bcbio.pipeline import region
+
+
+def _write(tmpdir, name, lines):
+    fname = str(tmpdir.join(name))
+    with open(fname, "w") as out_handle:
+        out_handle.write("".join("\t".join(str(x) for x in line) + "\n" for line in lines))
+    return fname
+
+
+def _sizes(shards):
+    return [sum(r.end - r.start for r in shard) for shard in shards]
+
+
+@pytest.mark.parametrize("num_shards", [2, 3, 4, 6, 7, 8])
+def test_fai_shards_cut_at_exact_boundaries(tmpdir, num_shards):
+    fai = _write(tmpdir, "genome.fa.fai", [["chr1", 1000, 6, 60, 61], ["chr2", 1000, 1030, 60, 61]])
+    shards = region.shard_regions(fai, num_shards)
+    assert len(shards) == num_shards
+    assert max(_sizes(shards)) - min(_sizes(shards)) <= 1
+    assert sum(_sizes(shards)) == 2000
+
+
+def test_fai_shards_span_many_chromosomes(tmpdir):
+    fai = _write(tmpdir, "genome.fa.fai", [["chr%s" % i, size, 0, 60, 61]
+                                           for i, size in enumerate([2490, 2430, 1980, 480, 16])])
+    shards = region.shard_regions(fai, 8)
+    assert len(shards) == 8
+    assert max(_sizes(shards)) - min(_sizes(shards)) <= 1
+    # Shards keep genome order, covering every base once
+    regions = [r for shard in shards for r in shard]
+    for prev, cur in zip(regions, regions[1:]):
+        assert (prev.chrom, prev.end) == (cur.chrom, cur.start) or cur.start == 0
+
+
+def test_bed_targets_are_not_cut(tmpdir):
+    bed = _write(tmpdir, "targets.bed", [["chr1", i * 100, i * 100 + 50] for i in range(40)] +
+                 [["chr1", 3995, 4100], ["chr1", 4050, 4200]])
+    shards = region.shard_regions(bed, 5)
+    assert [r for shard in shards for r in shard] == region.read_regions(bed)
+    assert region.Region("chr1", 3995, 4200) in shards[-1]
+    assert max(_sizes(shards)) <= 2 * min(_sizes(shards))
+
+
+def test_coverage_weights_balance_shards(tmpdir):
+    bed = _write(tmpdir, "targets.bed", [["chr1", i * 100, i * 100 + 50] for i in range(100)])
+    coverage = _write(tmpdir, "coverage.bed", [["chr1", 0, 1000, 90], ["chr1", 1000, 10000, 10]])
+    shards = region.shard_regions(bed, 2, coverage)
+    assert _sizes(shards) == [500, 4500]
+
+
+def test_concatenate_keeps_first_header_in_order(tmpdir):
+    in_files = []
+    for i in range(3):
+        fname = str(tmpdir.join("shard-%s.vcf.gz" % i))
+        with gzip.open(fname, "wt") as out_handle:
+            out_handle.write("##fileformat=VCFv4.2\n#CHROM\tPOS\nchr1\t%s\n" % (i + 1))
+        in_files.append(fname)
+    out_file = region.concatenate([in_files[0], None, in_files[1], in_files[2]], str(tmpdir.join("out.vcf.gz")))
+    with gzip.open(out_file, "rt") as in_handle:
+        assert in_handle.read() == "##fileformat=VCFv4.2\n#CHROM\tPOS\nchr1\t1\nchr1\t2\nchr1\t3\n"
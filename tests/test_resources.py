@@ -0,0 +1,62 @@
+"""Task sizing from program resources.
+"""
+import subprocess
+import sys
+import os
+
+from bcbio.distributed import multi, resources
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def test_resources_imports_without_schedulers():
+    code = ("import sys; from bcbio.distributed import resources; "
+            "assert 'bcbio.distributed.multi' not in sys.modules")
+    subprocess.check_call([sys.executable, "-c", code], cwd=REPO_DIR)
+
+
+def test_parse_memory():
+    assert resources.parse_memory("3G") == 3.0
+    assert resources.parse_memory("3500M") == 3500 / 1024.0
+    assert resources.parse_memory("3.5") == 3.5
+    assert resources.parse_memory(None, 0.0) == 0.0
+
+
+def test_local_scheduler_memory_specifications():
+    with multi.LocalScheduler({"type": "local", "cores": 1, "mem": "64G"}) as scheduler:
+        assert scheduler.memory == 64.0
+    with multi.LocalScheduler({"type": "local", "cores": 1, "mem": 8}) as scheduler:
+        assert scheduler.memory == 8.0
+
+
+def _calculate(cores, mem, num_tasks, progs, config):
+    return resources.calculate({"cores": cores, "mem": mem, "progs": progs}, [[]] * num_tasks,
+                               {"resources": config})
+
+
+def test_multicore_tasks_pack_onto_cores():
+    parallel = _calculate(16, "64G", 8, ["bwa"], {"bwa": {"cores": 4, "memory": "2G"}})
+    assert (parallel["num_jobs"], parallel["cores_per_job"], parallel["mem_per_job"]) == (4, 4, 8.0)
+
+
+def test_tasks_using_all_cores_run_one_at_a_time():
+    parallel = _calculate(16, "64G", 2, ["bwa"], {"bwa": {"cores": 16, "memory": "2G"}})
+    assert (parallel["num_jobs"], parallel["cores_per_job"], parallel["mem_per_job"]) == (1, 16, 32.0)
+
+
+def test_memory_limits_running_tasks():
+    parallel = _calculate(16, "32G", 16, ["vardict"], {"vardict": {"cores": 1, "memory": "8G"}})
+    assert (parallel["num_jobs"], parallel["cores_per_job"], parallel["mem_per_job"]) == (4, 1, 8.0)
+
+
+def test_jvm_heap_scaled_to_task_memory():
+    config = {"gatk": {"cores": 1, "memory": "2G", "jvm_opts": ["-Xms500m", "-Xmx3500m"]}}
+    parallel = _calculate(4, "16G", 4, ["gatk"], config)
+    # -Xmx3500m needs 3500M / JVM_HEAP_FRACTION per task, so three fit in 16G
+    assert (parallel["num_jobs"], parallel["cores_per_job"], parallel["mem_per_job"]) == (3, 1, 4.02)
+    data = {"description": "s1", "config": {"resources": config}}
+    updated = resources.update_items([[data]], parallel)[0][0]["config"]
+    assert updated["algorithm"]["num_cores"] == 1
+    assert updated["resources"]["gatk"]["jvm_opts"] == ["-Xms500m", "-Xmx3499m"]
+    assert updated["resources"]["gatk"]["memory"] == "4116M"
+    assert resources.scale_jvm_opts(["-Xms4g"], 2.0) == ["-Xms1740m", "-Xmx1740m"]
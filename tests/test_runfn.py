@@ -0,0 +1,43 @@
+"""Running distributed functions by name in fresh processes.
+"""
+import subprocess
+import sys
+import os
+
+import pytest
+
+from bcbio.distributed import multitasks, runfn
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def _local_fn(a, b):
+    return a - b
+
+
+def test_get_imports_module_paths_without_registration():
+    import operator
+    assert multitasks.get("operator:add") is operator.add
+
+
+def test_get_unknown_name():
+    with pytest.raises(AttributeError):
+        multitasks.get("not_registered_anywhere")
+
+
+def test_import_path():
+    multitasks.register("test_add", "operator:add")
+    assert multitasks.import_path("test_add") == "operator:add"
+    assert multitasks.import_path(_local_fn) == "test_runfn:_local_fn"
+    with pytest.raises(ValueError):
+        multitasks.import_path(lambda x: x)
+
+
+@pytest.mark.parametrize("ext", [".json", ".pkl"])
+def test_runfn_in_fresh_process(tmpdir, ext):
+    argfile = str(tmpdir.join("task-1%s" % ext))
+    outfile = str(tmpdir.join("task-1-out%s" % ext))
+    runfn.write_out(argfile, [2, 3])
+    subprocess.check_call([sys.executable, os.path.join(REPO_DIR, "bcbio_nextgen.py"), "runfn",
+                           "operator:add", argfile, "-o", outfile])
+    assert runfn.read_args(outfile) == 5
@@ -0,0 +1,39 @@
+"""Lazily loaded bcbio_nextgen.py subcommands.
+"""
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+
+import bcbio_nextgen
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+@pytest.mark.parametrize("name", sorted(bcbio_nextgen.SUBCOMMANDS))
+def test_every_subcommand_resolves(name):
+    module_name, fn_name = bcbio_nextgen.SUBCOMMANDS[name]
+    module = bcbio_nextgen.load_subcommand(name)
+    assert module.__name__ == module_name
+    assert callable(getattr(module, fn_name))
+    assert callable(module.add_subparser)
+    out = subprocess.check_output([sys.executable, os.path.join(REPO_DIR, "bcbio_nextgen.py"), name, "--help"],
+                                  cwd=REPO_DIR).decode()
+    assert out.startswith("usage: bcbio_nextgen.py %s" % name)
+
+
+def test_subcommand_modules_load_on_demand():
+    modules = sorted(set(x for x, _ in bcbio_nextgen.SUBCOMMANDS.values()))
+    script = ("import sys, json, bcbio_nextgen\n"
+              "mods = %r\n"
+              "before = [m for m in mods if m in sys.modules]\n"
+              "kwargs = bcbio_nextgen.parse_cl_args(['trace', 'run.jsonl'])\n"
+              "after = [m for m in mods if m in sys.modules]\n"
+              "print(json.dumps([before, after, kwargs['args'].trace_file, kwargs['trace']]))\n" % modules)
+    out = subprocess.check_output([sys.executable, "-c", script], cwd=REPO_DIR).decode()
+    before, after, trace_file, selected = json.loads(out)
+    assert before == []
+    assert after == ["bcbio.distributed.trace"]
+    assert (trace_file, selected) == ("run.jsonl", True)
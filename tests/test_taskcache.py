@@ -0,0 +1,98 @@
+"""Task cache keys and reuse of finished results across restarts.
+"""
+import os
+import time
+
+from bcbio.distributed import multi, taskcache
+
+
+def _write_output(in_file, out_file):
+    with open(in_file) as in_handle:
+        data = in_handle.read()
+    with open(out_file, "a") as out_handle:
+        out_handle.write(data.upper())
+    return out_file
+
+
+def _run(tmpdir, items):
+    parallel = {"type": "local", "cores": 2, "task_cache": str(tmpdir.join("cache.db"))}
+    with multi.LocalScheduler(parallel) as scheduler:
+        return scheduler.map(_write_output, items)
+
+
+def _rows(tmpdir):
+    cache = taskcache.TaskCache(str(tmpdir.join("cache.db")))
+    try:
+        return cache._conn.execute("SELECT COUNT(*) FROM tasks").fetchone()[0]
+    finally:
+        cache.close()
+
+
+def _inputs(tmpdir, n=4):
+    items = []
+    for i in range(n):
+        in_file = str(tmpdir.join("in-%s.txt" % i))
+        with open(in_file, "w") as out_handle:
+            out_handle.write("sample %s\n" % i)
+        items.append([in_file, str(tmpdir.join("out-%s.txt" % i))])
+    return items
+
+
+def test_restart_reuses_results_with_output_arguments(tmpdir):
+    items = _inputs(tmpdir)
+    first = _run(tmpdir, items)
+    mtimes = [os.path.getmtime(x) for x in first]
+    # Output paths passed as arguments now exist, and must not change the key
+    assert _run(tmpdir, items) == first
+    assert [os.path.getmtime(x) for x in first] == mtimes
+    assert _rows(tmpdir) == len(items)
+    with open(first[0]) as in_handle:
+        assert in_handle.read() == "SAMPLE 0\n"
+
+
+def test_changed_input_reruns(tmpdir):
+    items = _inputs(tmpdir, 2)
+    _run(tmpdir, items)
+    time.sleep(0.01)
+    with open(items[0][0], "w") as out_handle:
+        out_handle.write("changed sample\n")
+    _run(tmpdir, items)
+    with open(items[0][1]) as in_handle:
+        assert in_handle.read().endswith("CHANGED SAMPLE\n")
+    with open(items[1][1]) as in_handle:
+        assert in_handle.read() == "SAMPLE 1\n"
+    assert _rows(tmpdir) == 2
+
+
+def test_missing_output_reruns(tmpdir):
+    items = _inputs(tmpdir, 2)
+    _run(tmpdir, items)
+    os.remove(items[1][1])
+    _run(tmpdir, items)
+    assert os.path.exists(items[1][1])
+
+
+def test_rerun_after_changed_input_is_cached_again(tmpdir):
+    items = _inputs(tmpdir, 1)
+    _run(tmpdir, items)
+    time.sleep(0.01)
+    with open(items[0][0], "w") as out_handle:
+        out_handle.write("changed sample\n")
+    # The output written by the first run exists at submission of the rerun
+    _run(tmpdir, items)
+    with open(items[0][1]) as in_handle:
+        rerun = in_handle.read()
+    assert rerun == "SAMPLE 0\nCHANGED SAMPLE\n"
+    _run(tmpdir, items)
+    with open(items[0][1]) as in_handle:
+        assert in_handle.read() == rerun
+
+
+def test_partial_output_from_restart_is_not_an_input(tmpdir):
+    items = _inputs(tmpdir, 1)
+    with open(items[0][1], "w") as out_handle:
+        out_handle.write("partial\n")
+    _run(tmpdir, items)
+    _run(tmpdir, items)
+    with open(items[0][1]) as in_handle:
+        assert in_handle.read() == "partial\nSAMPLE 0\n"
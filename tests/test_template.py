@@ -0,0 +1,220 @@
+"""Template lookup and the download cache used for standard templates.
+"""
+import io
+import os
+
+import pytest
+
+from bcbio import dlcache, download
+from bcbio.workflow import template
+
+
+class _Response(io.BytesIO):
+    def info(self):
+        return {"ETag": "abc"}
+
+
+def _count_requests(monkeypatch, text=b"details: []\n"):
+    calls = []
+
+    def open_url(url, headers=None):
+        calls.append((url, headers))
+        return _Response(text)
+    monkeypatch.setattr(download, "open_url", open_url)
+    return calls
+
+
+def test_builtin_templates_exclude_system_config():
+    index = template._builtin_templates()
+    assert "gatk-variant" in index
+    assert "bcbio_system" not in index
+
+
+def test_system_config_is_not_read_as_template(tmpdir, monkeypatch):
+    def open_url(url, headers=None):
+        raise download.urllib_error.URLError("offline")
+    monkeypatch.setattr(download, "open_url", open_url)
+    monkeypatch.setenv("BCBIO_DOWNLOAD_CACHE", str(tmpdir))
+    with pytest.raises(ValueError):
+        template._read_template("bcbio_system")
+
+
+def test_fresh_cached_download_is_not_revalidated(tmpdir, monkeypatch):
+    calls = _count_requests(monkeypatch)
+    cache = dlcache.DownloadCache(str(tmpdir))
+    url = "https://example.org/template.yaml"
+    assert cache.read(url, max_age=60) == b"details: []\n"
+    assert cache.read(url, max_age=60) == b"details: []\n"
+    assert len(calls) == 1
+    cache.read(url)
+    assert len(calls) == 2
+    assert calls[-1][1] == {"If-None-Match": "abc"}
+
+
+def _touch(tmpdir, *names):
+    for name in names:
+        tmpdir.join(name).ensure()
+
+
+def test_expand_dirs_uses_top_level_read_files(tmpdir):
+    _touch(tmpdir, "s1_R1.fq.gz", "s1_R2.fq.gz", "s2.bam", "notes.txt", "calls.vcf.gz", "index.gz",
+           "old/s3.fastq", ".hidden.fq")
+    found = template._expand_dirs([str(tmpdir)])
+    assert [os.path.basename(x) for x in found] == ["calls.vcf.gz", "s1_R1.fq.gz", "s1_R2.fq.gz", "s2.bam"]
+
+
+def test_expand_dirs_recursive(tmpdir):
+    _touch(tmpdir, "s1.fq", "run1/s2.cram", "run1/lane/s3.fastq.bz2", "run1/readme.txt")
+    found = template._expand_dirs([str(tmpdir)], recursive=True)
+    assert [os.path.relpath(x, str(tmpdir)) for x in found] == \
+        ["run1/lane/s3.fastq.bz2", "run1/s2.cram", "s1.fq"]
+
+
+def test_mixed_input_directory_groups_by_type(tmpdir, monkeypatch):
+    _touch(tmpdir, "s1_R1.fastq.gz", "s1_R2.fastq.gz", "s2.cram", "s3.vcf", "s4.vcf.gz", "notes.txt",
+           "checksums.gz")
+    monkeypatch.setattr(template.probe, "probe_files", lambda files, kind: {})
+    seen = []
+    for name in ["_prep_bam_input", "_prep_fastq_input", "_prep_vcf_input"]:
+        monkeypatch.setattr(template, name, lambda f, base, *args, name=name: seen.append((name, f)))
+    list(template._prep_items_from_base({}, [str(tmpdir)], {}, ["R", "_", "-", "."]))
+    by_type = {}
+    for name, f in seen:
+        by_type.setdefault(name, []).append(f if isinstance(f, str) else sorted(os.path.basename(x) for x in f))
+    assert [os.path.basename(x) for x in by_type["_prep_bam_input"]] == ["s2.cram"]
+    assert by_type["_prep_fastq_input"] == [["s1_R1.fastq.gz", "s1_R2.fastq.gz"]]
+    assert sorted(os.path.basename(x) for x in by_type["_prep_vcf_input"]) == ["s3.vcf", "s4.vcf.gz"]
+
+
+def test_explicit_files_keep_known_types(tmpdir):
+    in_file = str(tmpdir.join("reads.txt"))
+    assert template._expand_dirs([in_file]) == [in_file]
+    assert template._file_type(in_file) == "fastq"
+    assert template._file_type("sample.fastq.gz") == "fastq"
+    assert template._file_type("calls.vcf.gz") == "vcf"
+
+
+_TEMPLATE = "details:\n- algorithm: {aligner: bwa}\n  analysis: variant2\n"
+
+
+def _template_key(text):
+    import hashlib
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def test_parsed_templates_are_cached_privately(tmpdir, monkeypatch):
+    cache_dir = tmpdir.join("templates")
+    monkeypatch.setenv("BCBIO_TEMPLATE_CACHE", str(cache_dir))
+    monkeypatch.setattr(template, "_PARSED_TEMPLATES", {})
+    config = template._parse_template(_TEMPLATE)
+    assert config["details"][0]["algorithm"] == {"aligner": "bwa"}
+    assert os.stat(str(cache_dir)).st_mode & 0o777 == 0o700
+    assert os.listdir(str(cache_dir)) == ["%s.pickle" % _template_key(_TEMPLATE)]
+
+
+def test_shared_template_cache_is_not_unpickled(tmpdir, monkeypatch):
+    import pickle
+    cache_dir = tmpdir.mkdir("templates")
+    cache_dir.chmod(0o777)
+    planted = cache_dir.join("%s.pickle" % _template_key(_TEMPLATE))
+    planted.write_binary(pickle.dumps({"details": ["planted"]}))
+    monkeypatch.setenv("BCBIO_TEMPLATE_CACHE", str(cache_dir))
+    monkeypatch.setattr(template, "_PARSED_TEMPLATES", {})
+    assert template._parse_template(_TEMPLATE)["details"][0]["analysis"] == "variant2"
+
+
+def test_corrupt_template_pickle_is_a_cache_miss(tmpdir, monkeypatch):
+    cache_dir = tmpdir.mkdir("templates")
+    cache_dir.chmod(0o700)
+    cache_dir.join("%s.pickle" % _template_key(_TEMPLATE)).write_binary(b"not a pickle")
+    monkeypatch.setenv("BCBIO_TEMPLATE_CACHE", str(cache_dir))
+    monkeypatch.setattr(template, "_PARSED_TEMPLATES", {})
+    assert template._parse_template(_TEMPLATE)["details"][0]["analysis"] == "variant2"
+
+
+def test_write_config_file_streams_items(tmpdir):
+    import yaml
+    out_dir = str(tmpdir)
+    written = []
+
+    def items():
+        for i in range(4):
+            # Each earlier sample is already on disk when the next is generated
+            tx_files = [x for x in os.listdir(os.path.join(out_dir, "config")) if ".tx" in x]
+            written.append(os.path.getsize(os.path.join(out_dir, "config", tx_files[0])))
+            yield {"description": "s%s" % i, "files": ["/data/s%s_%s.fq" % (i, j) for j in range(2000)],
+                   "algorithm": {"aligner": "bwa"}}
+    config_template = {"details": [{"algorithm": {}}], "upload": {"dir": "/override"}, "resources": {"a": 1}}
+    out_file = template._write_config_file(items(), {"ref": "hg38"}, config_template, "proj", out_dir)
+    assert all(cur - prev > 30000 for prev, cur in zip(written, written[1:]))
+    with open(out_file) as in_handle:
+        config = yaml.safe_load(in_handle)
+    assert list(config.keys()) == ["fc_name", "upload", "globals", "resources", "details"]
+    assert config["fc_name"] == "proj"
+    assert config["upload"] == {"dir": "/override"}
+    assert config["globals"] == {"ref": "hg38"}
+    assert [x["description"] for x in config["details"]] == ["s0", "s1", "s2", "s3"]
+    assert config["details"][3]["files"][-1] == "/data/s3_1999.fq"
+    assert os.listdir(os.path.join(out_dir, "config")) == ["proj.yaml"]
+
+
+def test_write_config_file_without_items(tmpdir):
+    out_dir = str(tmpdir)
+    template._write_config_file(iter([{"description": "s1"}]), {}, {}, "proj", out_dir)
+    with pytest.raises(ValueError):
+        template._write_config_file(iter([]), {}, {}, "proj", out_dir)
+    # The previous configuration is untouched and no partial output is left
+    assert os.listdir(os.path.join(out_dir, "config")) == ["proj.yaml"]
+    template._write_config_file(iter([{"description": "s2"}]), {}, {}, "proj", out_dir)
+    assert sorted(x.split(".bak")[0] for x in os.listdir(os.path.join(out_dir, "config"))) == \
+        ["proj.yaml", "proj.yaml"]
+
+
+_METADATA_CSV = """# sample sheet
+samplename,description,batch,aligner,variantcaller
+
+/data/run1/NA12878_R1.fq.gz, NA12878 ,b1,bwa,gatk-haplotype;freebayes
+run2/*_tumor_*.fq.gz,tumor,b2,bowtie2,
+*_normal_R*,normal,b2,,
+"""
+
+
+def test_metadata_csv_lookup_by_name_path_and_glob():
+    metadata, _ = template._parse_metadata(io.StringIO(_METADATA_CSV))
+    assert list(metadata.keys()) == ["/data/run1/NA12878_R1.fq.gz", "run2/*_tumor_*.fq.gz", "*_normal_R*"]
+    assert metadata["/data/run1/NA12878_R1.fq.gz"]["description"] == "NA12878"
+    index = template.MetadataIndex(metadata)
+    assert len(index) == 3
+    assert index.get("NA12878_R1.fq.gz")["batch"] == "b1"
+    assert index.get("missing.fq.gz") is None
+    assert index.glob_keys("/in/run2/s1_tumor_R1.fq.gz") == ["run2/*_tumor_*.fq.gz"]
+    assert index.glob_keys("/in/run3/s1_tumor_R1.fq.gz") == []
+    assert index.glob_keys("/in/run2/s1_normal_R1.fq.gz") == ["*_normal_R*"]
+    assert index.find_glob(["/in/run2/s1_tumor_R1.fq.gz", "/in/run2/s1_tumor_R2.fq.gz"])["batch"] == "b2"
+    assert index.find_glob(["/in/run2/s1_tumor_R1.fq.gz", "/in/run2/s1_normal_R2.fq.gz"]) is None
+    unmatched, groups = index.glob_groups(["/in/s2_normal_R1.fq", "/in/x.fq", "/in/run2/s1_tumor_R1.fq.gz",
+                                           "/in/s2_normal_R2.fq"])
+    assert unmatched == ["/in/x.fq"]
+    assert groups == [["/in/run2/s1_tumor_R1.fq.gz"], ["/in/s2_normal_R1.fq", "/in/s2_normal_R2.fq"]]
+
+
+def test_metadata_added_to_items():
+    metadata, _ = template._parse_metadata(io.StringIO(_METADATA_CSV))
+    index = template.MetadataIndex(metadata)
+
+    def item(description, files):
+        return {"description": description, "files": files, "algorithm": {}}
+    exact = template._add_metadata(item("NA12878_R1", ["/data/run1/NA12878_R1.fq.gz"]), index, {})
+    assert exact["description"] == "NA12878"
+    assert exact["algorithm"] == {"aligner": "bwa", "variantcaller": ["gatk-haplotype", "freebayes"]}
+    assert exact["metadata"] == {"batch": "b1"}
+    tumor = template._add_metadata(item("s1", ["/in/run2/s1_tumor_R1.fq.gz", "/in/run2/s1_tumor_R2.fq.gz"]),
+                                   index, {})
+    assert (tumor["description"], tumor["algorithm"], tumor["metadata"]) == ("tumor", {"aligner": "bowtie2"},
+                                                                             {"batch": "b2"})
+    assert template._add_metadata(item("other", ["/in/other.fq.gz"]), index, {}, only_metadata=True) is None
+
+
+def test_duplicate_metadata_rows():
+    with pytest.raises(ValueError, match="present multiple times"):
+        template._parse_metadata(io.StringIO("samplename,batch\ns1,b1\ns1,b2\n"))
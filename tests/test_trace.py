@@ -0,0 +1,156 @@
+"""Task traces: recorded attempts, per task memory, Chrome export and the critical path.
+"""
+import json
+import os
+
+import pytest
+
+from bcbio.distributed import cluster, multi, runfn, trace
+
+
+def _allocate(mb):
+    block = bytearray(mb * 1024 * 1024)
+    for i in range(0, len(block), 4096):
+        block[i] = 1
+    return len(block)
+
+
+def _fail_first(counter_file):
+    with open(counter_file, "a") as out_handle:
+        out_handle.write("x")
+    with open(counter_file) as in_handle:
+        if len(in_handle.read()) < 2:
+            raise ValueError("first attempt fails")
+    return "ok"
+
+
+def test_peak_memory_is_per_task():
+    _, big = trace.measure(_allocate, [200])
+    _, small = trace.measure(_allocate, [1])
+    if big["max_rss_mb"] is None:
+        pytest.skip("Peak memory not available on this platform")
+    assert big["max_rss_mb"] > 200
+    # A reused process reports the later task's own peak, not the earlier high water mark
+    assert small["max_rss_mb"] is None or small["max_rss_mb"] < big["max_rss_mb"] - 150
+
+
+def test_failed_measure_keeps_stats():
+    with pytest.raises(ZeroDivisionError) as excinfo:
+        trace.measure(lambda x: x / 0, [1])
+    stats = excinfo.value.trace_stats
+    assert stats["status"] == "error"
+    assert stats["error"].startswith("ZeroDivisionError")
+    assert stats["end"] >= stats["start"]
+
+
+@pytest.mark.parametrize("cores", [1, 2])
+def test_local_failed_attempts_are_recorded(tmpdir, cores):
+    trace_file = str(tmpdir.join("trace.jsonl"))
+    parallel = {"type": "local", "cores": cores, "retries": 1, "trace": trace_file, "tag": "run1"}
+    with multi.LocalScheduler(parallel) as scheduler:
+        assert scheduler.map(_fail_first, [[str(tmpdir.join("count"))]]) == ["ok"]
+    events = trace.read_trace(trace_file)
+    assert [(e["attempt"], e["status"]) for e in events] == [(1, "error"), (2, "ok")]
+    assert events[0]["error"] == "ValueError: first attempt fails"
+    for e in events:
+        assert e["fn"] == "_fail_first"
+        assert e["tag"] == "run1"
+        assert e["queue_wait"] >= 0
+        assert e["submitted"] <= e["start"] <= e["end"]
+    # The retry is submitted once the failed attempt finishes
+    assert events[1]["submitted"] >= events[0]["end"]
+
+
+def test_killed_worker_is_recorded(tmpdir):
+    trace_file = str(tmpdir.join("trace.jsonl"))
+    with pytest.raises(Exception):
+        with multi.LocalScheduler({"type": "local", "cores": 2, "trace": trace_file}) as scheduler:
+            scheduler.map(os._exit, [[1]])
+    events = trace.read_trace(trace_file)
+    assert [(e["fn"], e["status"]) for e in events] == [("_exit", "error")]
+
+
+def test_runfn_writes_stats_for_failures(tmpdir):
+    argfile = str(tmpdir.join("task-1.pkl"))
+    runfn.write_out(argfile, [1, 0])
+    stats_file = str(tmpdir.join("task-1-trace.json"))
+    with pytest.raises(ZeroDivisionError):
+        runfn.run("operator:truediv", argfile, str(tmpdir.join("task-1-out.pkl")), trace_file=stats_file)
+    stats = trace.read_stats(stats_file)
+    assert (stats["fn"], stats["status"]) == ("operator:truediv", "error")
+
+
+def test_cluster_failed_attempts_are_recorded(tmpdir):
+    trace_file = str(tmpdir.join("trace.jsonl"))
+    parallel = {"type": "ipython", "scheduler": "slurm", "run_local": True, "cores": 2, "tag": "test",
+                "trace": trace_file}
+    with pytest.raises(cluster.ClusterTaskError):
+        with cluster.ClusterScheduler(parallel, work_dir=str(tmpdir.join("work")),
+                                      poll_interval=0.1) as scheduler:
+            scheduler.map("operator:truediv", [[1, 0]])
+    events = trace.read_trace(trace_file)
+    assert len(events) == 1
+    assert events[0]["fn"].endswith("operator:truediv")
+    assert (events[0]["status"], events[0]["attempt"]) == ("error", 1)
+    assert events[0]["error"].startswith("ZeroDivisionError")
+    assert events[0]["job_id"].endswith("[1]")
+
+
+def _write_trace(tmpdir, events):
+    trace_file = str(tmpdir.join("trace.jsonl"))
+    with open(trace_file, "w") as out_handle:
+        for e in events:
+            out_handle.write(json.dumps(e) + "\n")
+    return trace_file
+
+
+def _event(fn, submitted, start, end, host="node1", pid=100, **kwargs):
+    e = {"fn": fn, "submitted": submitted, "start": start, "end": end, "wall": end - start,
+         "queue_wait": start - submitted, "host": host, "pid": pid, "status": "ok"}
+    e.update(kwargs)
+    return e
+
+
+def test_chrome_trace_uses_numeric_ids(tmpdir):
+    trace_file = _write_trace(tmpdir, [_event("align", 100.0, 100.0, 101.5),
+                                       _event("align", 100.0, 100.5, 102.0, host="node2", pid=7,
+                                              status="error", error="ValueError: bad"),
+                                       _event("call", 102.0, 102.0, 103.0, pid=101)])
+    out_file = trace.to_chrome(trace_file, str(tmpdir.join("chrome.json")))
+    with open(out_file) as in_handle:
+        events = json.load(in_handle)["traceEvents"]
+    names = dict((e["pid"], e["args"]["name"]) for e in events if e["ph"] == "M")
+    assert names == {1: "node1", 2: "node2"}
+    tasks = [e for e in events if e["ph"] == "X"]
+    assert [(e["name"], e["pid"], e["tid"], e["ts"], e["dur"]) for e in tasks] == \
+        [("align", 1, 100, 0, 1500000), ("align", 2, 7, 500000, 1500000), ("call", 1, 101, 2000000, 1000000)]
+    assert all(isinstance(e["pid"], int) and isinstance(e["tid"], int) for e in events if "tid" in e)
+    assert tasks[1]["cname"] == "terrible" and "cname" not in tasks[0]
+    assert tasks[1]["args"]["error"] == "ValueError: bad"
+
+
+def test_critical_path_follows_dependencies():
+    events = [_event("align", 0.0, 0.0, 3.0, pid=1),
+              _event("align", 0.0, 0.0, 1.0, pid=2),
+              # Submitted when the short alignment finished, but not on the path
+              _event("recalibrate", 1.0, 1.0, 2.0, pid=2),
+              _event("recalibrate", 3.0, 3.5, 4.0, pid=1),
+              _event("variantcall", 4.0, 4.0, 6.0, pid=1)]
+    path = trace.critical_path(events)
+    assert [(s["task"]["fn"], s["task"]["start"]) for s in path] == \
+        [("align", 0.0), ("recalibrate", 3.5), ("variantcall", 4.0)]
+    assert [s["waited"] for s in path] == [0.0, 0.5, 0.0]
+    assert trace.critical_path([]) == []
+
+
+def test_summary_reports_failures_and_path(tmpdir):
+    trace_file = _write_trace(tmpdir, [_event("align", 0.0, 0.0, 1.0, status="error", error="OSError: disk",
+                                              attempt=1),
+                                       _event("align", 1.0, 1.0, 2.0, attempt=2),
+                                       _event("call", 2.0, 2.0, 3.0)])
+    report = trace.summarize(trace_file)
+    assert report.startswith("3 task attempts, 1 failed, 3.0s elapsed")
+    assert "attempt 1 on node1:100: OSError: disk" in report
+    path = report.split("Critical path:")[1].strip().splitlines()
+    assert [x.split()[0] for x in path] == ["align", "align", "call"]
+    assert path[0].endswith("(failed)")
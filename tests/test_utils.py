@@ -0,0 +1,63 @@
+"""Cached YAML loading.
+"""
+import os
+import pickle
+
+from bcbio import utils
+
+
+def _yaml(tmpdir, text="a: 1\n"):
+    yaml_dir = tmpdir.mkdir("config")
+    fname = str(yaml_dir.join("system.yaml"))
+    with open(fname, "w") as out_handle:
+        out_handle.write(text)
+    return fname
+
+
+def test_load_yaml_caches_outside_the_yaml_directory(tmpdir, monkeypatch):
+    cache_dir = str(tmpdir.join("cache"))
+    monkeypatch.setenv("BCBIO_YAML_CACHE", cache_dir)
+    fname = _yaml(tmpdir)
+    assert utils.load_yaml(fname) == {"a": 1}
+    assert os.listdir(os.path.dirname(fname)) == ["system.yaml"]
+    assert len(os.listdir(cache_dir)) == 1
+    assert os.stat(cache_dir).st_mode & 0o777 == 0o700
+
+
+def test_load_yaml_reuses_pickle_across_processes(tmpdir, monkeypatch):
+    monkeypatch.setenv("BCBIO_YAML_CACHE", str(tmpdir.join("cache")))
+    fname = _yaml(tmpdir)
+    utils.load_yaml(fname)
+    utils._YAML_CACHE.clear()
+    pickle_file = utils._yaml_pickle_file(os.path.abspath(fname))
+    with open(pickle_file, "rb") as in_handle:
+        cur = pickle.load(in_handle)
+    cur["data"] = {"a": "from cache"}
+    with open(pickle_file, "wb") as out_handle:
+        pickle.dump(cur, out_handle)
+    assert utils.load_yaml(fname) == {"a": "from cache"}
+
+
+def test_load_yaml_ignores_cache_writable_by_others(tmpdir, monkeypatch):
+    cache_dir = str(tmpdir.join("cache"))
+    monkeypatch.setenv("BCBIO_YAML_CACHE", cache_dir)
+    fname = _yaml(tmpdir)
+    utils.load_yaml(fname)
+    utils._YAML_CACHE.clear()
+    pickle_file = utils._yaml_pickle_file(os.path.abspath(fname))
+    with open(pickle_file, "rb") as in_handle:
+        cur = pickle.load(in_handle)
+    cur["data"] = {"a": "planted"}
+    with open(pickle_file, "wb") as out_handle:
+        pickle.dump(cur, out_handle)
+    os.chmod(cache_dir, 0o777)
+    assert utils.load_yaml(fname) == {"a": 1}
+
+
+def test_load_yaml_reparses_changed_files(tmpdir, monkeypatch):
+    monkeypatch.setenv("BCBIO_YAML_CACHE", str(tmpdir.join("cache")))
+    fname = _yaml(tmpdir)
+    utils.load_yaml(fname)
+    with open(fname, "w") as out_handle:
+        out_handle.write("a: 22\n")
+    assert utils.load_yaml(fname) == {"a": 22}
@@ -0,0 +1,83 @@
+"""Warm worker daemon requests over its Unix socket.
+"""
+import os
+import stat
+import subprocess
+import sys
+import time
+
+import pytest
+
+from bcbio.distributed import runfn, worker
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+_TASK_MODULE = """import os
+with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), "imports.log"), "a") as out_handle:
+    out_handle.write("%s\\n" % os.getpid())
+
+def describe(sample, n):
+    return {"sample": sample.upper(), "n": n * 2, "pid": os.getpid()}
+"""
+
+
+@pytest.fixture
+def daemon(tmpdir):
+    mod_dir = tmpdir.mkdir("mods")
+    mod_dir.join("warmtask.py").write(_TASK_MODULE)
+    socket_path = str(tmpdir.join("worker.sock"))
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join([str(mod_dir), REPO_DIR]))
+    proc = subprocess.Popen([sys.executable, os.path.join(REPO_DIR, "bcbio_nextgen.py"), "worker", socket_path,
+                             "-n", "2"], env=env, cwd=str(tmpdir))
+    for _ in range(200):
+        if os.path.exists(socket_path):
+            break
+        time.sleep(0.05)
+    yield socket_path, mod_dir, env
+    proc.terminate()
+    proc.wait()
+
+
+def test_socket_is_private(daemon):
+    socket_path, _, _ = daemon
+    assert stat.S_IMODE(os.stat(socket_path).st_mode) == 0o600
+
+
+def test_socket_round_trip_matches_runfn(tmpdir, daemon):
+    socket_path, mod_dir, env = daemon
+    argfile = str(tmpdir.join("task-1.pkl"))
+    runfn.write_out(argfile, ["s1", 21])
+    worker_out = str(tmpdir.join("task-1-worker.pkl"))
+    local_out = str(tmpdir.join("task-1-local.pkl"))
+    assert worker.run_on(socket_path, "warmtask:describe", argfile, worker_out)
+    subprocess.check_call([sys.executable, os.path.join(REPO_DIR, "bcbio_nextgen.py"), "runfn",
+                           "warmtask:describe", argfile, "--outfile", local_out], env=env)
+    from_worker = runfn.read_args(worker_out)
+    from_runfn = runfn.read_args(local_out)
+    assert from_worker.pop("pid") != from_runfn.pop("pid")
+    assert from_worker == from_runfn == {"sample": "S1", "n": 42}
+
+
+def test_parent_imports_task_modules_once(tmpdir, daemon):
+    socket_path, mod_dir, _ = daemon
+    argfile = str(tmpdir.join("task-1.pkl"))
+    runfn.write_out(argfile, ["s1", 1])
+    pids = set()
+    for i in range(3):
+        outfile = str(tmpdir.join("task-1-out%s.pkl" % i))
+        assert worker.run_on(socket_path, "warmtask:describe", argfile, outfile)
+        pids.add(runfn.read_args(outfile)["pid"])
+    imports = mod_dir.join("imports.log").read().split()
+    # Imported once, in the parent, and inherited by every forked child
+    assert len(imports) == 1
+    assert imports[0] not in set(str(x) for x in pids)
+
+
+def test_failed_task_reports_error(tmpdir, daemon):
+    socket_path, _, _ = daemon
+    argfile = str(tmpdir.join("task-1.pkl"))
+    runfn.write_out(argfile, [1, 0])
+    with pytest.raises(ValueError):
+        worker.run_on(socket_path, "operator:truediv", argfile, str(tmpdir.join("task-1-out.pkl")))
+    with pytest.raises(ValueError):
+        worker.run_on(socket_path, "no_such_module_here:fn", argfile, str(tmpdir.join("task-1-out.pkl")))